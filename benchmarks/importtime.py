@@ -0,0 +1,97 @@
+""" Benchmark of import cost for `import merkl` and the `merkl cache` command, as measured by `python -X importtime`.
+
+Usage: python benchmarks/importtime.py [--repeat N] [--top N]
+"""
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+from collections import defaultdict
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only be imported when actually used, not by `import merkl` or `merkl cache`
+LAZY_MODULES = [
+    'clize', 'sigtools', 'dill', 'stdlib_list', 'pstats', 'cProfile', 'tarfile', 'urllib.request', 'http.client',
+    'concurrent.futures',
+]
+
+
+def parse_importtime(stderr):
+    """ Parses `-X importtime` output into a list of (name, self_us, cumulative_us, level) """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), level))
+
+    return imports
+
+
+def run_importtime(args, cwd):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in [REPO_ROOT, env.get('PYTHONPATH')] if p)
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', *args], cwd=cwd, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f'Command {args} failed:\n{proc.stderr}')
+
+    return parse_importtime(proc.stderr)
+
+
+def benchmark(name, args, cwd, repeat, top, startup_modules=frozenset()):
+    totals = []
+    self_times = defaultdict(list)
+    for _ in range(repeat):
+        imports = run_importtime(args, cwd)
+        # Top level imports are the ones not triggered by other imports, so their sum is the total cost. Modules
+        # imported on interpreter start-up are excluded
+        imports = [imp for imp in imports if imp[0] not in startup_modules]
+        totals.append(sum(cumulative for _, _, cumulative, level in imports if level == 0))
+        for module, self_us, _, _ in imports:
+            self_times[module].append(self_us)
+
+    if name is None:
+        return set(self_times.keys())
+
+    print(f'{name}: {median(totals) / 1000:.1f}ms (median of {repeat})')
+
+    slowest = sorted(self_times.items(), key=lambda x: median(x[1]), reverse=True)[:top]
+    for module, times in slowest:
+        print(f'\t{median(times) / 1000:.2f}ms\t{module}')
+
+    lazy_imported = [module for module in LAZY_MODULES if module in self_times]
+    if lazy_imported:
+        print(f'\tWARNING: imported modules that should be lazy: {", ".join(lazy_imported)}')
+
+    return median(totals), lazy_imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Number of runs per command')
+    parser.add_argument('-t', '--top', type=int, default=10, help='Number of slowest modules to list')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        subprocess.run(
+            [sys.executable, '-m', 'merkl', 'init'], cwd=tmp_dir, check=True,
+            env={**os.environ, 'PYTHONPATH': REPO_ROOT},
+        )
+        startup_modules = benchmark(None, ['-c', 'pass'], tmp_dir, 1, 0)
+        _, lazy_import = benchmark('import merkl', ['-c', 'import merkl'], tmp_dir, args.repeat, args.top, startup_modules)
+        _, lazy_cache = benchmark('merkl cache', ['-m', 'merkl', 'cache'], tmp_dir, args.repeat, args.top, startup_modules)
+
+    if lazy_import or lazy_cache:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
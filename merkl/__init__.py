@@ -1,5 +1,19 @@
-from merkl.cli.cli import main
 from merkl.task import task, batch, pipeline, Future, HashMode
-from merkl.io import read_future, write_future, path_future, FileRef, DirRef, IdentitySerializer, WrappedSerializer, migrate_output_files
-from merkl.util_tasks import combine_file_refs
+from merkl.io import read_future, write_future, path_future, FileRef, DirRef, IdentitySerializer, BufferSerializer, WrappedSerializer, migrate_output_files
+from merkl.serializers import Pickle5Serializer, TypedSerializer
 from merkl.utils import Eval
+
+
+def main():
+    # NOTE: the CLI is imported lazily so that `import merkl` doesn't pay for it
+    from merkl.cli.cli import main
+    main()
+
+
+def __getattr__(name):
+    # `combine_file_refs` is a task, so defining it requires sigtools. Load it on first access instead of on import
+    if name == 'combine_file_refs':
+        from merkl.util_tasks import combine_file_refs
+        globals()[name] = combine_file_refs
+        return combine_file_refs
+    raise AttributeError(f"module 'merkl' has no attribute '{name}'")
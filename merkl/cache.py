@@ -1,54 +1,208 @@
+import io
 import os
+import re
+import sys
+import json
+import mmap
+import time
+import atexit
 import shutil
+import hashlib
 import sqlite3
+import tempfile
+import weakref
+import warnings
+import threading
+import contextvars
+from contextlib import contextmanager
 from typing import NamedTuple
+from urllib.parse import quote
 
 import merkl
 from merkl.logger import logger, short_hash
+from merkl.exceptions import ReadOnlyCacheError
+from merkl.compression import compress, decompress
+from merkl.memory_cache import MemoryCache
+from merkl.transfer import transfer_file, transfer_dir
 from merkl.utils import collect_dag_futures, nested_collect, function_descriptive_name
 
-MEMORY_CACHE = {}
+# Budget of the in-memory cache for tasks with `cache_in_memory=True`, see MemoryCache to change it or the eviction
+MEMORY_CACHE_MAX_BYTES = 1024 ** 3
+
+MEMORY_CACHE = MemoryCache(max_bytes=MEMORY_CACHE_MAX_BYTES)
 
 NO_CACHE = False
 
 BLOB_DB_SIZE_LIMIT_BYTES = 100000  # see link further down on page and blob sizes
 
+# With ADAPTIVE_PLACEMENT, SqliteCache measures how long reads of inline blobs and of blobs in files take, and once it
+# has ADAPTIVE_PLACEMENT_MIN_READS of each, stores blobs inline up to the size at which files are estimated to become
+# faster instead of up to BLOB_DB_SIZE_LIMIT_BYTES, within INLINE_MIN_BYTES and INLINE_MAX_BYTES
+ADAPTIVE_PLACEMENT = True
+ADAPTIVE_PLACEMENT_MIN_READS = 100
+INLINE_MIN_BYTES = 16 * 1024
+INLINE_MAX_BYTES = 1024 ** 2
+
+# Version of the SqliteCache database schema, stored in `PRAGMA user_version`. Databases created by older versions of
+# merkl are migrated when connected to
+SCHEMA_VERSION = 9
+
+# Number of hashes deleted per statement by `gc`, and per transaction by `clear_all_except`, below SQLite's limit on
+# the number of parameters
+GC_DELETE_CHUNK_SIZE = 500
+
+# Caches with `packs=True`, or all caches if PACK_BLOBS is set, append blobs larger than BLOB_DB_SIZE_LIMIT_BYTES and up
+# to PACK_MAX_BLOB_BYTES to pack files instead of writing a file per blob, which saves inodes and `open` calls when
+# there are many of them. A new pack file is started when the current one reaches PACK_MAX_BYTES
+PACK_BLOBS = False
+PACK_MAX_BLOB_BYTES = 16 * 1024 ** 2
+PACK_MAX_BYTES = 1024 ** 3
+
+# `repack` rewrites the pack files in which at least this fraction of the bytes no longer belongs to a blob
+PACK_REPACK_MIN_DEAD_RATIO = 0.25
+
+# Tasks with `auto_cache=True`, or all tasks if AUTO_CACHE is set, don't persist their outputs once the TaskStats of the
+# function show that calling it is less than AUTO_CACHE_MIN_SPEEDUP times slower than loading its outputs would be, e.g.
+# for string formatting. Outputs are persisted until the function has been called AUTO_CACHE_MIN_CALLS times. Loads
+# that haven't been measured are estimated from the bytes written, as AUTO_CACHE_LOAD_SECONDS per value plus
+# AUTO_CACHE_LOAD_BYTES_PER_SECOND
+AUTO_CACHE = False
+AUTO_CACHE_MIN_CALLS = 3
+AUTO_CACHE_MIN_SPEEDUP = 2.0
+AUTO_CACHE_LOAD_SECONDS = 1e-3
+AUTO_CACHE_LOAD_BYTES_PER_SECOND = 200 * 1024 ** 2
+
+# Bundles written by `export_bundle` start with a manifest member BUNDLE_MANIFEST holding the BUNDLE_VERSION, followed by
+# the ref files/dirs (under refs/) and the value (under values/) of each entry
+BUNDLE_MANIFEST = 'merkl-bundle.json'
+BUNDLE_VERSION = 2
+
+# Merkle hashes, which the names of bundle members must start with
+_HASH_RE = re.compile('[0-9a-f]{64}')
+
+# Files in the cache directories that were changed more recently than this many seconds ago are not removed by
+# `sweep_orphans`, since they may belong to a write in progress
+ORPHAN_MIN_AGE = 60 * 60
+
 
 def get_merkl_path():
     from merkl.io import cwd
     return f'{cwd}.merkl/'
 
 
-def get_tmp_dir():
-    return f'{get_merkl_path()}tmp/'
+def get_tmp_dir(merkl_path=None):
+    return f'{merkl_path or get_merkl_path()}tmp/'
 
 
-def get_db_path():
-    return f'{get_merkl_path()}cache.sqlite3'
+def get_db_path(merkl_path=None):
+    return f'{merkl_path or get_merkl_path()}cache.sqlite3'
 
 
-def get_cache_dir_path(hash=None):
-    base = f'{get_merkl_path()}cache/'
+def get_cache_dir_path(hash=None, merkl_path=None):
+    base = f'{merkl_path or get_merkl_path()}cache/'
     if hash is not None:
         return f'{base}{hash[:2]}/'
     return base
 
 
-def get_cache_file_path(hash, ext='bin', makedirs=False):
-    cache_dir = get_cache_dir_path(hash)
+def get_cache_file_path(hash, ext='bin', makedirs=False, merkl_path=None):
+    cache_dir = get_cache_dir_path(hash, merkl_path)
     if makedirs:
         os.makedirs(cache_dir, exist_ok=True)
     return f'{cache_dir}{hash}.{ext}'
 
 
-def get_cache_out_dir_path(hash, makedirs=False):
-    cache_dir = get_cache_dir_path(hash)
+def get_cache_out_dir_path(hash, makedirs=False, merkl_path=None):
+    cache_dir = get_cache_dir_path(hash, merkl_path)
     if makedirs:
         os.makedirs(cache_dir, exist_ok=True)
     cache_dir = f'{cache_dir}{hash}/'
     return cache_dir
 
 
+def get_blob_file_path(content_hash, makedirs=False, merkl_path=None):
+    blob_dir = f'{merkl_path or get_merkl_path()}blobs/{content_hash[:2]}/'
+    if makedirs:
+        os.makedirs(blob_dir, exist_ok=True)
+    return f'{blob_dir}{content_hash}.bin'
+
+
+def get_packs_dir(merkl_path=None):
+    return f'{merkl_path or get_merkl_path()}packs/'
+
+
+def get_pack_path(pack_id, merkl_path=None):
+    return f'{get_packs_dir(merkl_path)}{pack_id}.pack'
+
+
+def choose_inline_max_bytes(inline_reads, file_reads):
+    """ Returns the blob size up to which reading a blob inline is estimated to be faster than reading it from a file,
+    by fitting a line of seconds over size to the reads of each. The reads are given as totals: (count, sum of sizes,
+    sum of seconds, sum of squared sizes, sum of size times seconds) """
+    fits = []
+    for count, sum_size, sum_seconds, sum_size2, sum_size_seconds in [inline_reads, file_reads]:
+        denominator = count * sum_size2 - sum_size ** 2
+        if count < ADAPTIVE_PLACEMENT_MIN_READS or denominator <= 0:
+            return BLOB_DB_SIZE_LIMIT_BYTES  # not enough reads, or all of the same size
+
+        slope = (count * sum_size_seconds - sum_size * sum_seconds) / denominator
+        fits.append(((sum_seconds - slope * sum_size) / count, slope))
+
+    (inline_intercept, inline_slope), (file_intercept, file_slope) = fits
+    if inline_slope <= file_slope:
+        # The lines don't cross at a positive size, so one is faster at every size
+        return INLINE_MAX_BYTES if inline_intercept <= file_intercept else INLINE_MIN_BYTES
+
+    crossover = (file_intercept - inline_intercept) / (inline_slope - file_slope)
+    return int(min(max(crossover, INLINE_MIN_BYTES), INLINE_MAX_BYTES))
+
+
+def get_content_hash(content_bytes):
+    return hashlib.sha256(content_bytes).hexdigest()
+
+
+def write_file_atomic(path, content_bytes):
+    """ Writes to a temporary file and renames it into place, so that concurrent readers never see a partial file """
+    tmp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content_bytes)
+    os.replace(tmp_path, path)
+
+
+class HashingWriter:
+    """ Writable file object that passes what is written on to `f`, while computing the content hash and counting the
+    bytes, so that the value written by a serializer's `dump` never has to be in memory as a whole. Strings are encoded
+    as UTF-8 like the result of `dumps` is, for serializers such as json that write text """
+
+    def __init__(self, f):
+        self.f = f
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = bytes(data, 'utf-8')
+        self.hasher.update(data)
+        self.size += memoryview(data).nbytes
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    @property
+    def content_hash(self):
+        return self.hasher.hexdigest()
+
+
+def map_file(path, offset=0):
+    """ Returns a read-only memoryview of the file from `offset`, backed by mmap so that the data is paged in from the
+    page cache on demand instead of being copied into memory. The mapping is closed when the view is garbage collected,
+    and stays valid if the file is removed or replaced """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped)[offset:]
+
+
 def get_modified_time(path):
     try:
         return os.stat(path).st_mtime
@@ -64,64 +218,1260 @@ def clear(outs, keep=False, keep_outs=False):
     for future in futures:
         collect_dag_futures(future, dag_futures, include_parent_pipelines=True)
 
-    if keep:
-        future_hashes = [future.hash for future in dag_futures]
-        SqliteCache.clear_all_except(future_hashes)
-    elif keep_outs:
-        outs_future_hashes = [future.hash for future in futures]
-        SqliteCache.clear_all_except(outs_future_hashes)
+    if keep or keep_outs:
+        keep_futures = dag_futures if keep else futures
+        keep_hashes = [future.hash for future in keep_futures]
+        caches = {future.cache for future in dag_futures if future.cache is not None} or {get_default_cache()}
+        for cache in caches:
+            cache.clear_all_except(keep_hashes)
     else:
         for future in dag_futures:
             future.clear_cache()
 
 
-class SqliteCache:
-    connection = None
-    no_commit = False
+def pin(name, outs):
+    """ Pins the values of `outs` and all their dependencies under `name`, so that `gc` doesn't evict them. Replaces
+    anything previously pinned under the same name """
+    from merkl.future import Future
+    futures = nested_collect(outs, lambda x: isinstance(x, Future))
 
-    @classmethod
-    def connect(cls):
-        if cls.connection is None:
-            try:
-                cls.connection = sqlite3.connect(get_db_path())
-            except sqlite3.OperationalError:
-                if not os.path.exists(get_merkl_path()):
-                    print(".merkl doesn't exist, did you run 'merkl init'?")
-                    exit(1)
-                raise
-            cls.cursor = cls.connection.cursor()
-
-    @classmethod
-    def commit(cls):
-        cls.connection.commit()
-
-    @classmethod
-    def create_cache(cls):
-        if os.path.exists(get_db_path()):
-            return
+    dag_futures = set()
+    for future in futures:
+        collect_dag_futures(future, dag_futures, include_parent_pipelines=True)
 
-        logger.debug(f'Creating cache')
-        os.makedirs(get_merkl_path(), exist_ok=True)
-        os.makedirs(get_tmp_dir(), exist_ok=True)
-        os.makedirs(get_cache_dir_path(), exist_ok=True)
-        cls.connect()
+    hashes = [future.hash for future in dag_futures]
+    caches = {future.cache for future in dag_futures if future.cache is not None} or {get_default_cache()}
+    for cache in caches:
+        cache.pin(name, hashes)
 
-        # Increase page size for faster BLOB performance:
-        # https://www.sqlite.org/intern-v-extern-blob.html#:~:text=A%20database%20page%20size%20of,a%20separate%20file%20are%20faster.
-        cls.cursor.execute("PRAGMA page_size = 16384;")
 
-        cls.cursor.execute("""
-            CREATE TABLE cache (
-                hash CHARACTER(64) PRIMARY KEY,
+class TaskStats(NamedTuple):
+    """ Usage of the cache by the outputs of one function, as recorded by `BaseCache.record_stats`. A hit is an output
+    loaded from the cache, and a miss is a call of the function. `load_seconds` is the time spent reading and
+    deserializing the hits, and `compute_seconds` the time spent in the function calls. `writes` is the number of calls
+    whose outputs were persisted, which `bytes_written` was written by """
+    module_function: str
+    hits: int = 0
+    misses: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    load_seconds: float = 0.0
+    compute_seconds: float = 0.0
+    writes: int = 0
+
+
+def is_worth_caching(stats):
+    """ Returns whether the outputs of the function with TaskStats `stats` (or None if it has none) are worth
+    persisting, see AUTO_CACHE """
+    if stats is None or stats.misses < AUTO_CACHE_MIN_CALLS:
+        return True
+
+    compute_seconds = stats.compute_seconds / stats.misses
+    if stats.hits > 0:
+        load_seconds = stats.load_seconds / stats.hits
+    elif stats.writes > 0:
+        # NOTE: calls whose outputs weren't persisted wrote nothing, so they don't tell the size of the outputs
+        load_seconds = AUTO_CACHE_LOAD_SECONDS + stats.bytes_written / stats.writes / AUTO_CACHE_LOAD_BYTES_PER_SECOND
+    else:
+        return True
+    return compute_seconds >= AUTO_CACHE_MIN_SPEEDUP * load_seconds
+
+
+# The TaskStats of each cache by module function as of their first use by `auto_cache` in this process, so that the
+# decisions don't read the stats for every output, and don't change in the middle of a run: {cache: {module_function: TaskStats}}
+_task_stats_snapshots = {}
+_task_stats_snapshots_lock = threading.Lock()
+
+
+def get_task_stats_snapshot(cache):
+    with _task_stats_snapshots_lock:
+        snapshot = _task_stats_snapshots.get(cache)
+        if snapshot is None:
+            snapshot = _task_stats_snapshots[cache] = {stats.module_function: stats for stats in cache.get_task_stats()}
+        return snapshot
+
+
+def prefetch_has(outs):
+    """ Queries which of `outs` and their dependencies are cached with one `has_many` per cache, so that e.g.
+    HttpCache can answer the `in_cache` checks of the evaluation without a round trip each """
+    from merkl.future import Future
+    futures = nested_collect(outs, lambda x: isinstance(x, Future))
+
+    dag_futures = set()
+    for future in futures:
+        collect_dag_futures(future, dag_futures)
+
+    cache_hashes = {}
+    for future in dag_futures:
+        if future.cache is not None:
+            cache_hashes.setdefault(future.cache, []).append(future.hash)
+
+    for cache, hashes in cache_hashes.items():
+        cache.has_many(hashes)
+
+
+def _open_bundle(path, mode):
+    """ Opens the tar archive `path`, or stdin/stdout if '-', as a stream. Written bundles are gzipped if the path ends
+    with .gz or .tgz, and read bundles are decompressed as needed """
+    import tarfile
+    if mode == 'w':
+        mode = 'w|gz' if str(path).endswith(('.gz', '.tgz')) else 'w|'
+    else:
+        mode = 'r|*'
+
+    if str(path) == '-':
+        fileobj = sys.stdout.buffer if mode.startswith('w') else sys.stdin.buffer
+        return tarfile.open(fileobj=fileobj, mode=mode, format=tarfile.PAX_FORMAT)
+    return tarfile.open(path, mode, format=tarfile.PAX_FORMAT)
+
+
+class BufferReader:
+    """ File object that reads a buffer, such as a memory mapped value from `get_buffer`, in slices instead of copying
+    it as a whole like io.BytesIO does """
+
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast('B')
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else min(self.pos + size, len(self.view))
+        chunk = self.view[self.pos:end]
+        self.pos = end
+        return chunk
+
+
+def export_bundle(outs, path):
+    """ Writes the cached values of `outs` and all their dependencies, including FileRef/DirRef outputs, to the tar
+    archive `path` ('-' for stdout), so that another machine can load them with `import_bundle` instead of computing
+    them. The archive is written sequentially, so it can be piped to e.g. ssh. Returns the number of entries written """
+    import tarfile
+    from merkl.future import Future
+    futures = nested_collect(outs, lambda x: isinstance(x, Future))
+
+    dag_futures = set()
+    for future in futures:
+        collect_dag_futures(future, dag_futures, include_parent_pipelines=True)
+
+    cache_hashes = {}
+    for future in dag_futures:
+        # Inputs are read from their source files, and are not cached
+        if future.cache is not None and not future.is_input:
+            cache_hashes.setdefault(future.cache, set()).add(future.hash)
+
+    entries = []
+    for cache, hashes in cache_hashes.items():
+        entries += [(cache, hash) for hash in sorted(cache.has_many(hashes))]
+
+    with _open_bundle(path, 'w') as tar:
+        manifest = json.dumps({'version': BUNDLE_VERSION, 'entries': len(entries)}).encode('utf-8')
+        info = tarfile.TarInfo(BUNDLE_MANIFEST)
+        info.size = len(manifest)
+        tar.addfile(info, io.BytesIO(manifest))
+
+        for cache, hash in entries:
+            # NOTE: values stored uncompressed in files are mapped, so they are streamed into the archive
+            content_buffer = BufferReader(cache.get_buffer(hash))
+            headers = {}
+            fn_name = cache.get_module_function(hash)
+            if fn_name is not None:
+                headers['merkl.module_function'] = fn_name
+            format = cache.get_format(hash)
+            if format is not None:
+                headers['merkl.format'] = format
+
+            ref_path, ref_is_dir = cache.get_ref_path(hash)
+            if ref_path is not None:
+                # The ref is written before the value, so that importing can move it into the cache as it reads the value
+                ref_name = hash if ref_is_dir else f'{hash}{os.path.splitext(ref_path)[1]}'
+                tar.add(ref_path, arcname=f'refs/{ref_name}')
+                headers.update({'merkl.ref_path': ref_path, 'merkl.ref_name': ref_name, 'merkl.ref_is_dir': str(int(ref_is_dir))})
+
+            info = tarfile.TarInfo(f'values/{hash}')
+            info.size = len(content_buffer.view)
+            info.mtime = time.time()
+            info.pax_headers = headers
+            tar.addfile(info, content_buffer)
+
+    logger.debug(f'Exported {len(entries)} cache entries to {path}')
+    return len(entries)
+
+
+def _rebase_ref_value(content_bytes, ref, format):
+    """ Returns the serialized FileRef/DirRef `content_bytes` with the path of `ref` instead, for refs imported into a
+    cache at another path than they were exported from, and its format. Refs are serialized with the default
+    serializer, in the given `format`, or with dill if None """
+    from merkl.serializers import TypedSerializer
+    if isinstance(ref, merkl.io.DirRef):
+        old_ref = TypedSerializer.loads(content_bytes) if format is None else TypedSerializer.deserialize(format, content_bytes)
+        ref = merkl.io.DirRef(ref, files=old_ref._files)
+
+    if format is None:
+        return TypedSerializer.dumps(ref), None
+    format, chunks = TypedSerializer.serialize(ref)
+    return b''.join(chunks), format
+
+
+def import_bundle(path, cache=None):
+    """ Loads the entries of a bundle written by `export_bundle` from `path` ('-' for stdin) into `cache`, by default
+    the default cache. Entries that are already cached are skipped, so importing a bundle again only adds what is
+    missing. Returns the number of entries imported and skipped """
+    import tarfile
+    cache = cache or get_default_cache()
+    tmp_dir = get_tmp_dir(getattr(cache, 'merkl_path', None))
+    os.makedirs(tmp_dir, exist_ok=True)
+    refs_dir = tempfile.mkdtemp(dir=tmp_dir)
+
+    # Python versions with extraction filters reject e.g. absolute paths and links out of the destination
+    extract_kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+    num_imported = num_skipped = 0
+    present = {}
+    ref_names = {}
+    try:
+        with _open_bundle(path, 'r') as tar, cache.transaction():
+            for i, member in enumerate(tar):
+                if i == 0:
+                    if member.name != BUNDLE_MANIFEST:
+                        raise ValueError(f'{path} is not a merkl bundle')
+                    version = json.loads(tar.extractfile(member).read())['version']
+                    if version > BUNDLE_VERSION:
+                        raise ValueError(f'{path} is a bundle of version {version}, upgrade merkl to import it')
+                    continue
+
+                kind, _, name = member.name.partition('/')
+                if kind not in ('refs', 'values') or member.name.startswith('/') or '..' in member.name.split('/'):
+                    raise ValueError(f'Unexpected member {member.name} in bundle {path}')
+
+                # Member names, rather than headers, determine where refs are extracted to, as the bundle may not be
+                # trusted
+                ref_name = name.split('/')[0]
+                hash, dot, ext = ref_name.partition('.')
+                if not _HASH_RE.fullmatch(hash) or (kind == 'values' and (dot or ref_name != name)):
+                    raise ValueError(f'Unexpected member {member.name} in bundle {path}')
+                if hash not in present:
+                    present[hash] = cache.has(hash)
+                if present[hash]:
+                    num_skipped += kind == 'values'
+                    continue
+
+                if kind == 'refs':
+                    if not extract_kwargs and not (member.isfile() or member.isdir()):
+                        # Without extraction filters, links could be used to write outside of the destination
+                        raise ValueError(f'Unexpected {member.name} in bundle {path}, refs may only have files and directories')
+                    tar.extract(member, refs_dir, **extract_kwargs)
+                    ref_names[hash] = ref_name
+                    continue
+
+                fileobj = tar.extractfile(member)
+                fn_name = member.pax_headers.get('merkl.module_function')
+                format = member.pax_headers.get('merkl.format')
+                ref_path = member.pax_headers.get('merkl.ref_path')
+                if ref_path is None:
+                    cache.add_stream(hash, lambda f: shutil.copyfileobj(fileobj, f), fn_name=fn_name, format=format)
+                else:
+                    extracted_path = os.path.join(refs_dir, 'refs', ref_names.get(hash, hash))
+                    if not os.path.realpath(extracted_path).startswith(os.path.join(os.path.realpath(refs_dir), '')):
+                        raise ValueError(f'Ref of {member.name} in bundle {path} is outside of the extracted refs')
+                    if not os.path.lexists(extracted_path):
+                        raise ValueError(f'Missing ref of {member.name} in bundle {path}')
+                    ref_class = merkl.io.DirRef if os.path.isdir(extracted_path) else merkl.io.FileRef
+                    ref = cache.transfer_ref(ref_class(extracted_path, rm_after_caching=True), hash)
+                    content_bytes = fileobj.read()
+                    if str(ref) != ref_path:
+                        content_bytes, format = _rebase_ref_value(content_bytes, ref, format)
+                    cache.add(hash, content_bytes, ref=ref, fn_name=fn_name, format=format)
+
+                num_imported += 1
+    finally:
+        shutil.rmtree(refs_dir, ignore_errors=True)
+
+    logger.debug(f'Imported {num_imported} cache entries from {path}, skipped {num_skipped}')
+    return num_imported, num_skipped
+
+
+class BaseCache:
+    """ Interface of cache backends, i.e. the `cache` argument of tasks. Values are bytes stored by the Merkle hash of
+    the future that produced them, or FileRef/DirRef outputs moved into the cache by `transfer_ref`. Backends also keep
+    track of files read and written by merkl, so that their md5 hashes don't have to be recomputed.
+
+    Backend instances may be shared between threads and processes (and are pickled along with futures), so any
+    connections or other runtime state should be created lazily and not be part of the pickled state.
+    See merkl/tests/test_cache_backends.py for the conformance tests that a backend should pass. """
+
+    # Whether values can only be read, in which case TieredCache doesn't write to, clear or promote into the backend
+    read_only = False
+
+    # Whether `get_many` fetches values in fewer round trips than a `get` each, in which case the values of futures
+    # prefetched together are fetched with it, see `merkl.future.prefetch`
+    bulk_get = False
+
+    def create_cache(self):
+        """ Creates the storage for the cache if it doesn't exist """
+
+    def close(self):
+        """ Releases connections and other resources held by this process """
+
+    @contextmanager
+    def transaction(self):
+        """ Scope in which the writes of the current thread may be batched, they are all done when the outermost scope
+        exits, or discarded if an exception is raised. Scopes can be nested """
+        yield
+
+    def has(self, hash):
+        raise NotImplementedError
+
+    def has_many(self, hashes):
+        """ Returns the set of `hashes` that are in the cache. Backends for which every `has` is a round trip should
+        query them in bulk, and may answer `has` from the result for a while """
+        return {hash for hash in hashes if self.has(hash)}
+
+    def get(self, hash):
+        """ Returns the bytes stored for `hash`, or None if not in the cache """
+        raise NotImplementedError
+
+    def get_many(self, hashes):
+        """ Returns a dict of hash -> bytes for the `hashes` that are in the cache """
+        values = {}
+        for hash in hashes:
+            content_bytes = self.get(hash)
+            if content_bytes is not None:
+                values[hash] = content_bytes
+        return values
+
+    def get_buffer(self, hash):
+        """ Like `get`, but may return a read-only buffer such as a memoryview instead of bytes, to avoid copying large
+        values. Used for serializers with `accepts_buffers = True` """
+        return self.get(hash)
+
+    def add(self, hash, content_bytes=None, ref=None, fn_name=None, compression=None, format=None):
+        """ Stores `content_bytes` for `hash`. If the output is a FileRef/DirRef, `ref` is the ref returned by
+        `transfer_ref`. `fn_name` is the descriptive name of the function that produced the value, used for stats.
+        `compression` is the `compression` argument of the task, see merkl.compression, which backends may ignore.
+        `format` is the name of the format the value was serialized in, if the serializer picked one (see
+        merkl.serializers.TypedSerializer), which backends return from `get_format` """
+        raise NotImplementedError
+
+    def add_stream(self, hash, dump, fn_name=None, compression=None, format=None):
+        """ Like `add`, but the value is written by `dump(fileobj)`, e.g. a serializer's `dump`, and the number of bytes
+        written is returned. Backends that store values in files should stream them there, rather than into memory as
+        this does """
+        buffer = io.BytesIO()
+        dump(HashingWriter(buffer))
+        content_bytes = buffer.getvalue()
+        self.add(hash, content_bytes, fn_name=fn_name, compression=compression, format=format)
+        return len(content_bytes)
+
+    def clear(self, hash):
+        """ Removes the value for `hash`, including any files """
+        raise NotImplementedError
+
+    def clear_all_except(self, hashes):
+        raise NotImplementedError
+
+    def clear_module_function(self, module_function):
+        raise NotImplementedError
+
+    def get_stats(self, module_function=None):
+        """ Returns (count, size) for `module_function`, or if None a list of (module_function, count, size) """
+        raise NotImplementedError
+
+    def get_module_function(self, hash):
+        """ Returns the `fn_name` that `hash` was added with, or None """
+        return None
+
+    def get_codec(self, hash):
+        """ Returns the codec the value of `hash` is stored compressed with (see merkl.compression), or None """
+        return None
+
+    def get_format(self, hash):
+        """ Returns the `format` that `hash` was added with, or None """
+        return None
+
+    def get_ref_path(self, hash):
+        """ Returns (path, is_dir) of the FileRef/DirRef output stored for `hash`, or (None, False) if the value is not
+        a ref. Backends that don't store refs always return (None, False) """
+        return None, False
+
+    def record_stats(self, module_function, hits=0, misses=0, bytes_read=0, bytes_written=0, load_seconds=0.0, compute_seconds=0.0, writes=0):
+        """ Adds to the TaskStats of `module_function`. Backends that don't keep statistics ignore them """
+
+    def get_task_stats(self):
+        """ Returns a list of TaskStats """
+        return []
+
+    def pin(self, name, hashes):
+        """ Protects the entries for `hashes` from `gc`, replacing the hashes previously pinned under `name` """
+        raise NotImplementedError
+
+    def unpin(self, name):
+        raise NotImplementedError
+
+    def get_pins(self):
+        """ Returns a list of (name, number of pinned hashes) """
+        raise NotImplementedError
+
+    def sweep_orphans(self, dry_run=False):
+        """ Removes files of the cache that no entry references, e.g. left behind by a crash. Returns the number of
+        files removed and their size in bytes """
+        raise NotImplementedError
+
+    def repack(self):
+        """ Reorganizes how values are stored, for faster reads and to reclaim the space of deleted values. Returns the
+        number of values moved and the number of bytes freed """
+        raise NotImplementedError
+
+    def gc(self, max_bytes=None, max_age=None, dry_run=False):
+        """ Evicts entries that haven't been accessed in `max_age` seconds, and then the least recently used entries
+        until the cache takes at most `max_bytes`. Pinned entries are never evicted. Returns the number of entries
+        evicted and the number of bytes freed """
+        raise NotImplementedError
+
+    def get_ref_file_path(self, hash, ext):
+        """ Path in the cache where a FileRef output is stored """
+        raise NotImplementedError
+
+    def get_ref_dir_path(self, hash):
+        """ Path in the cache where a DirRef output is stored """
+        raise NotImplementedError
+
+    def transfer_ref(self, ref, hash, transfer=None):
+        """ Transfers a FileRef/DirRef from the original place in the file system to the merkl cache, and returns
+        the new ref with the new path. `transfer` is the `transfer` argument of the task, see merkl.transfer """
+        logger.debug(f'Transferring {ref}')
+        if isinstance(ref, merkl.io.FileRef):
+            splits = ref.split('.')
+            ext = None if len(splits) == 1 else splits[-1]
+            cache_file_path = self.get_ref_file_path(hash, ext)
+            transfer_file(ref, cache_file_path, transfer, move=ref.rm_after_caching)
+            new_file_out = merkl.io.FileRef(cache_file_path)
+            return new_file_out
+        elif isinstance(ref, merkl.io.DirRef):
+            cache_dir_path = self.get_ref_dir_path(hash)
+            transfer_dir(ref, cache_dir_path, transfer, move=ref.rm_after_caching)
+            ref = merkl.io.DirRef(cache_dir_path, files=ref._files)
+            return ref
+
+    def track_file(self, path, modified=None, merkl_hash=None, md5_hash=None):
+        """ Records the md5 hash of a file read by merkl, or the merkl hash of a file written by merkl, for the
+        file's modified time """
+        raise NotImplementedError
+
+    def get_file_mod_hash(self, path, modified=None):
+        """ Returns (md5_hash, merkl_hash) tracked for `path` at the `modified` time, or (None, None) """
+        raise NotImplementedError
+
+    def get_latest_file(self, path):
+        """ Returns (md5_hash, merkl_hash, modified) for the latest tracked version of `path`, or (None, None, None) """
+        raise NotImplementedError
+
+    def has_file(self, hash):
+        """ Returns whether any file with md5 hash `hash` is tracked """
+        raise NotImplementedError
+
+
+_default_caches = {}
+
+
+def resolve_cache(cache):
+    """ Returns the cache instance for a `cache` argument. A BaseCache subclass resolves to a shared instance of it
+    constructed with default arguments """
+    if isinstance(cache, type):
+        if cache not in _default_caches:
+            _default_caches[cache] = cache()
+        return _default_caches[cache]
+    return cache
+
+
+def get_default_cache():
+    return resolve_cache(SqliteCache)
+
+
+class _PendingWrites:
+    """ Rows buffered by `SqliteCache.transaction()`, kept by key so that reads within the transaction can find them.
+    Each row gets a sequence number, so that the rows added in a failed nested scope can be discarded. Threads that
+    join the transaction add rows concurrently, so changes and flushes hold `lock` """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.cache_rows = {}  # hash -> (seq, row)
+        self.blobs = {}  # content_hash -> (seq, row, tmp_path)
+        self.file_rows = {}  # (path, modified) -> (seq, row)
+        self.num_bytes = 0
+        self.next_seq = 0
+
+    def _take_seq(self):
+        seq = self.next_seq
+        self.next_seq += 1
+        return seq
+
+    def add_cache_row(self, hash, row):
+        with self.lock:
+            if hash not in self.cache_rows:
+                self.cache_rows[hash] = (self._take_seq(), row)
+
+    def add_blob(self, content_hash, row, tmp_path=None):
+        """ `tmp_path` is the temporary file holding the content of large blobs, which have no data in `row`. If
+        another thread added the blob first, the file is removed """
+        with self.lock:
+            if content_hash not in self.blobs:
+                self.blobs[content_hash] = (self._take_seq(), row, tmp_path)
+                self.num_bytes += len(row[1] or b'')
+                return
+
+        if tmp_path is not None:
+            os.remove(tmp_path)
+
+    def add_file_row(self, path, modified, row):
+        with self.lock:
+            self.file_rows[(path, modified)] = (self._take_seq(), row)
+
+    def get_cache_row(self, hash):
+        seq_row = self.cache_rows.get(hash)
+        return None if seq_row is None else seq_row[1]
+
+    def get_blob(self, content_hash):
+        seq_row_path = self.blobs.get(content_hash)
+        return None if seq_row_path is None else seq_row_path[1:]
+
+    def pop_cache_row(self, hash):
+        with self.lock:
+            seq_row = self.cache_rows.pop(hash, None)
+        return None if seq_row is None else seq_row[1]
+
+    def discard_from(self, seq):
+        """ Discards rows added since `seq`. Rows that have already been flushed are not affected """
+        with self.lock:
+            self.cache_rows = {key: val for key, val in self.cache_rows.items() if val[0] < seq}
+            self.file_rows = {key: val for key, val in self.file_rows.items() if val[0] < seq}
+            for content_hash, (blob_seq, _, tmp_path) in list(self.blobs.items()):
+                if blob_seq >= seq:
+                    _, row, _ = self.blobs.pop(content_hash)
+                    self.num_bytes -= len(row[1] or b'')
+                    if tmp_path is not None:
+                        os.remove(tmp_path)
+
+    def clear(self):
+        with self.lock:
+            self.cache_rows = {}
+            self.blobs = {}
+            self.file_rows = {}
+            self.num_bytes = 0
+
+
+# The `_PendingWrites` of the open `SqliteCache.transaction()`s by database path, along with the pid, since a forked
+# child doesn't continue its parent's transactions: (pid, {db_path: _PendingWrites}). It's a context variable rather
+# than thread state, so that threads running in a copy of the context, like the workers that write the sibling outputs
+# of a task, add their rows to the transaction of the thread that started them
+_pending_writes = contextvars.ContextVar('merkl_pending_writes', default=None)
+
+
+# Cache entries reference their value by content hash, so that identical values produced by different Merkle hashes are
+# only stored once, in the blobs table or in a file for large values. The triggers keep count of the entries
+# referencing each blob, so that unreferenced blobs can be deleted when entries are cleared. `format` is the name of
+# the format the value was serialized in, for serializers that pick one per value, see merkl.serializers.TypedSerializer
+_CACHE_TABLE_SQL = """
+    CREATE TABLE cache (
+        hash CHARACTER(64) PRIMARY KEY,
+        content_hash CHARACTER(64),
+        size INTEGER,
+        ref_path TEXT,
+        ref_is_dir BOOL,
+        module_function TEXT NULL,
+        last_access REAL NOT NULL DEFAULT 0,
+        format TEXT NULL
+    )
+"""
+
+# Hashes protected from `gc`, by the name they were pinned under
+_PINS_TABLE_SQL = """
+    CREATE TABLE pins (
+        name TEXT,
+        hash CHARACTER(64),
+        PRIMARY KEY (name, hash)
+    )
+"""
+
+# `size` is the size of the stored data, which has been compressed with `codec` unless NULL. The data is either inline,
+# at `pack_offset` in pack file `pack`, or else in a file of its own
+_BLOBS_TABLE_SQL = """
+    CREATE TABLE blobs (
+        content_hash CHARACTER(64) PRIMARY KEY,
+        data BLOB,
+        size INTEGER,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        codec TEXT NULL,
+        pack INTEGER NULL,
+        pack_offset INTEGER NULL
+    )
+"""
+
+_PACK_INDEX_SQL = "CREATE INDEX blobs_pack ON blobs(pack, pack_offset) WHERE pack IS NOT NULL"
+
+_REFCOUNT_SQL = [
+    """
+    CREATE TRIGGER cache_insert AFTER INSERT ON cache BEGIN
+        UPDATE blobs SET refcount = refcount + 1 WHERE content_hash = NEW.content_hash;
+    END
+    """,
+    """
+    CREATE TRIGGER cache_delete AFTER DELETE ON cache BEGIN
+        UPDATE blobs SET refcount = refcount - 1 WHERE content_hash = OLD.content_hash;
+    END
+    """,
+    "CREATE INDEX blobs_unreferenced ON blobs(content_hash) WHERE refcount <= 0",
+]
+
+_LAST_ACCESS_INDEX_SQL = "CREATE INDEX cache_last_access ON cache(last_access)"
+
+# Files to remove once the transaction that deleted their entries or blobs has committed, see `_empty_trash`. `name`
+# is the content hash if `kind` is 'blob', otherwise the ref path of a 'file' or 'dir'
+_TRASH_SQL = [
+    """
+    CREATE TABLE trash (
+        name TEXT PRIMARY KEY,
+        kind TEXT
+    )
+    """,
+    """
+    CREATE TRIGGER cache_delete_ref AFTER DELETE ON cache WHEN OLD.ref_path IS NOT NULL BEGIN
+        INSERT OR IGNORE INTO trash VALUES (OLD.ref_path, CASE WHEN OLD.ref_is_dir THEN 'dir' ELSE 'file' END);
+    END
+    """,
+]
+
+_MODULE_FUNCTION_INDEX_SQL = "CREATE INDEX cache_module_function ON cache(module_function)"
+
+# Totals of the reads of blobs stored 'inline' and in a 'file' (or pack file), see `choose_inline_max_bytes`
+_READ_LATENCIES_TABLE_SQL = """
+    CREATE TABLE read_latencies (
+        kind TEXT PRIMARY KEY,
+        count INTEGER NOT NULL DEFAULT 0,
+        sum_size REAL NOT NULL DEFAULT 0,
+        sum_seconds REAL NOT NULL DEFAULT 0,
+        sum_size2 REAL NOT NULL DEFAULT 0,
+        sum_size_seconds REAL NOT NULL DEFAULT 0
+    )
+"""
+
+# Totals of TaskStats by module function
+_TASK_STATS_TABLE_SQL = """
+    CREATE TABLE task_stats (
+        module_function TEXT PRIMARY KEY,
+        hits INTEGER NOT NULL DEFAULT 0,
+        misses INTEGER NOT NULL DEFAULT 0,
+        bytes_read INTEGER NOT NULL DEFAULT 0,
+        bytes_written INTEGER NOT NULL DEFAULT 0,
+        load_seconds REAL NOT NULL DEFAULT 0,
+        compute_seconds REAL NOT NULL DEFAULT 0,
+        writes INTEGER NOT NULL DEFAULT 0
+    )
+"""
+
+
+class SqliteCache(BaseCache):
+    # Seconds to wait for a lock held by another connection (thread or process) before raising 'database is locked'
+    timeout = 60.0
+
+    # Rows buffered in a transaction are flushed early when their inline data exceeds this, to bound memory use
+    max_pending_bytes = 64 * 1024 * 1024
+
+    # Access times of entries are only updated if they are older than this many seconds, and the updates are buffered
+    # until the next write, `close()` or the end of the process, or until there are `max_pending_accesses` of them
+    access_time_resolution = 60.0
+    max_pending_accesses = 1000
+
+    # Connections can't be shared between threads, or be used in a forked child process, so each thread in each
+    # process gets its own, stored in `_local` by database path and shared by all instances for the same database. They
+    # are also registered in `_connections` with their process and thread, so that `close()` can close them from any
+    # thread, after which the bumped generation number makes threads open new ones. The connections of threads that
+    # have exited, e.g. of the prefetch and writer pools, are closed when another thread connects
+    _local = threading.local()
+    _connections = []
+    _generations = {}
+    _lock = threading.Lock()
+
+    # Buffered access times by .merkl path, shared by all threads: {merkl_path: {hash: time}}
+    _pending_accesses = {}
+
+    # Buffered TaskStats by .merkl path, written along with the access times: {merkl_path: {module_function: [totals]}}
+    _pending_stats = {}
+
+    # Buffered totals of blob reads by .merkl path, written along with the TaskStats: {merkl_path: {kind: [totals]}}
+    _pending_reads = {}
+
+    # The `inline_max_bytes` chosen from the reads so far, by .merkl path
+    _inline_max_bytes = {}
+
+    def __init__(self, path=None, compression=None, max_bytes=None, max_age=None, packs=None, read_only=False, immutable=False):
+        """ `path` is the .merkl directory of the cache, by default the one in the current working directory.
+        `compression` is used for tasks that don't set their own, see merkl.compression. `max_bytes` and `max_age` are
+        the default limits for `gc`. `packs` is whether to write medium sized blobs to pack files, see PACK_BLOBS.
+
+        A `read_only` cache opens the database with mode=ro and raises ReadOnlyCacheError on writes, e.g. for a base
+        cache on shared storage that is used below a local one, see TieredCache. Access times and stats aren't recorded
+        for it. If the database also never changes while in use, `immutable` opens it with immutable=1, so that SQLite
+        takes no locks and reads no WAL, which works on read-only media too """
+        self.path = path
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.packs = packs
+        self.read_only = read_only or immutable
+        self.immutable = immutable
+
+    @property
+    def uses_packs(self):
+        return self.packs if self.packs is not None else PACK_BLOBS
+
+    @property
+    def inline_max_bytes(self):
+        """ Size up to which blobs are stored inline in the database, see ADAPTIVE_PLACEMENT """
+        if not ADAPTIVE_PLACEMENT:
+            return BLOB_DB_SIZE_LIMIT_BYTES
+
+        inline_max_bytes = SqliteCache._inline_max_bytes.get(self.merkl_path)
+        if inline_max_bytes is None:
+            reads = {kind: totals for kind, *totals in self.connect().execute("SELECT * FROM read_latencies")}
+            inline_max_bytes = choose_inline_max_bytes(reads.get('inline', [0] * 5), reads.get('file', [0] * 5))
+            SqliteCache._inline_max_bytes[self.merkl_path] = inline_max_bytes
+        return inline_max_bytes
+
+    @property
+    def merkl_path(self):
+        if self.path is None:
+            return get_merkl_path()
+        return self.path if self.path.endswith('/') else f'{self.path}/'
+
+    @property
+    def db_path(self):
+        return get_db_path(self.merkl_path)
+
+    def _thread_state(self):
+        local = SqliteCache._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.connections = {}
+        return local
+
+    def connect(self):
+        """ Returns the connection for the current thread and process, opening it if needed """
+        local = self._thread_state()
+        db_path = self.db_path
+        generation = SqliteCache._generations.get(db_path, 0)
+        generation_connection = local.connections.get(db_path)
+        if generation_connection is not None and generation_connection[0] == generation:
+            return generation_connection[1]
+
+        database = db_path
+        if self.read_only:
+            database = f'file:{quote(os.path.abspath(db_path))}?mode=ro{"&immutable=1" if self.immutable else ""}'
+
+        try:
+            # NOTE: isolation_level=None disables the implicit transactions of the sqlite3 module, transactions are
+            # instead opened explicitly by `transaction()`
+            connection = sqlite3.connect(database, timeout=self.timeout, isolation_level=None, check_same_thread=False, uri=self.read_only)
+        except sqlite3.OperationalError:
+            if not os.path.exists(self.merkl_path):
+                print(".merkl doesn't exist, did you run 'merkl init'?")
+                exit(1)
+            raise
+
+        if not self.read_only:
+            # WAL lets readers run concurrently with a writer, and with synchronous=NORMAL a commit doesn't fsync
+            # https://www.sqlite.org/wal.html
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+        if list(connection.execute('PRAGMA user_version'))[0][0] < SCHEMA_VERSION:
+            if self.read_only:
+                connection.close()
+                raise ReadOnlyCacheError(f'Cache {self.merkl_path} is from an older version of merkl, open it writable once to migrate it')
+            self._migrate(connection)
+
+        local.connections[db_path] = (generation, connection)
+        pid = os.getpid()
+        with SqliteCache._lock:
+            remaining = []
+            for connection_pid, connection_db_path, connection_thread, other_connection in SqliteCache._connections:
+                thread = connection_thread()
+                if connection_pid == pid and (thread is None or not thread.is_alive()):
+                    other_connection.close()
+                else:
+                    remaining.append((connection_pid, connection_db_path, connection_thread, other_connection))
+            remaining.append((pid, db_path, weakref.ref(threading.current_thread()), connection))
+            SqliteCache._connections = remaining
+
+        return connection
+
+    def close(self):
+        """ Closes the connections to this cache's database opened by this process, in any thread """
+        is_buffered = any(self.merkl_path in pending for pending in [
+            SqliteCache._pending_accesses, SqliteCache._pending_stats, SqliteCache._pending_reads,
+        ])
+        if is_buffered and not self.read_only and os.path.exists(self.db_path):
+            with self._write() as connection:
+                self._write_accesses(connection)
+                self._write_stats(connection)
+
+        pid = os.getpid()
+        db_path = self.db_path
+        with SqliteCache._lock:
+            SqliteCache._generations[db_path] = SqliteCache._generations.get(db_path, 0) + 1
+            SqliteCache._inline_max_bytes.pop(self.merkl_path, None)
+            remaining = []
+            for connection_pid, connection_db_path, connection_thread, connection in SqliteCache._connections:
+                if connection_pid == pid and connection_db_path == db_path:
+                    connection.close()
+                else:
+                    remaining.append((connection_pid, connection_db_path, connection_thread, connection))
+            SqliteCache._connections = remaining
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ReadOnlyCacheError(f'Cache {self.merkl_path} is read-only')
+
+    @contextmanager
+    def _write(self, connection=None):
+        """ Scope for writes that are executed immediately, in a transaction of their own """
+        self._check_writable()
+        connection = connection or self.connect()
+        # Take the write lock up front, as upgrading a read transaction to a write one can fail immediately with
+        # 'database is locked' regardless of the busy timeout
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _migrate(self, connection):
+        """ Upgrades the schema of a database created by an older version of merkl to SCHEMA_VERSION. Tables are
+        created with their current schema, so later steps only alter them if the database had them already """
+        files_to_remove = []
+        with self._write(connection):
+            # NOTE: check again now that we have the lock, another process may have migrated already
+            version = list(connection.execute('PRAGMA user_version'))[0][0]
+            if version < 1:
+                logger.warning('Migrating cache to deduplicate values by content hash')
+                files_to_remove += self._migrate_content_hashes(connection)
+            if version < 2:
+                connection.execute("ALTER TABLE blobs ADD COLUMN codec TEXT NULL")
+            if version < 3:
+                connection.execute("ALTER TABLE cache ADD COLUMN last_access REAL NOT NULL DEFAULT 0")
+                connection.execute("UPDATE cache SET last_access=?", (time.time(),))
+                connection.execute(_LAST_ACCESS_INDEX_SQL)
+                connection.execute(_PINS_TABLE_SQL)
+            if version < 4:
+                connection.execute(_MODULE_FUNCTION_INDEX_SQL)
+                connection.execute(_TASK_STATS_TABLE_SQL)
+            if version < 5:
+                for sql in _TRASH_SQL:
+                    connection.execute(sql)
+            if version < 6:
+                connection.execute("ALTER TABLE blobs ADD COLUMN pack INTEGER NULL")
+                connection.execute("ALTER TABLE blobs ADD COLUMN pack_offset INTEGER NULL")
+                connection.execute(_PACK_INDEX_SQL)
+            if version < 7:
+                connection.execute(_READ_LATENCIES_TABLE_SQL)
+            if 4 <= version < 8:
+                connection.execute("ALTER TABLE task_stats ADD COLUMN writes INTEGER NOT NULL DEFAULT 0")
+                # Until outputs could be left out of the cache, every call persisted its outputs
+                connection.execute("UPDATE task_stats SET writes = misses")
+            if version < 9:
+                connection.execute("ALTER TABLE cache ADD COLUMN format TEXT NULL")
+
+            connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+        for path in files_to_remove:
+            os.remove(path)
+
+    def _migrate_content_hashes(self, connection):
+        """ Moves values from the cache table, and from files named by Merkle hash, to blobs by content hash. Returns
+        the old files, to be removed once the migration is committed """
+        # NOTE: the schema as of version 1, later migrations take it from there
+        connection.execute("""
+            CREATE TABLE blobs (
+                content_hash CHARACTER(64) PRIMARY KEY,
                 data BLOB,
                 size INTEGER,
+                refcount INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        connection.execute("""
+            CREATE TABLE cache_new (
+                hash CHARACTER(64) PRIMARY KEY,
+                content_hash CHARACTER(64),
+                size INTEGER,
                 ref_path TEXT,
                 ref_is_dir BOOL,
                 module_function TEXT NULL
             )
         """)
+        old_files = []
+        rows = connection.execute("SELECT hash, data, size, ref_path, ref_is_dir, module_function FROM cache")
+        for hash, data, size, ref_path, ref_is_dir, module_function in rows:
+            if data is not None:
+                content_hash = get_content_hash(data)
+                blob_size = len(data)
+            else:
+                old_path = get_cache_file_path(hash, merkl_path=self.merkl_path)
+                try:
+                    with open(old_path, 'rb') as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    logger.warning(f'Dropping {short_hash(hash)} from cache, its file is missing')
+                    continue
+
+                content_hash = get_content_hash(data)
+                blob_size = len(data)
+                blob_path = get_blob_file_path(content_hash, makedirs=True, merkl_path=self.merkl_path)
+                if not os.path.exists(blob_path):
+                    write_file_atomic(blob_path, data)
+                old_files.append(old_path)
+                data = None
+
+            connection.execute(
+                "INSERT OR IGNORE INTO blobs (content_hash, data, size) VALUES (?, ?, ?)",
+                (content_hash, data, blob_size),
+            )
+            connection.execute("UPDATE blobs SET refcount = refcount + 1 WHERE content_hash=?", (content_hash,))
+            connection.execute(
+                "INSERT INTO cache_new VALUES (?, ?, ?, ?, ?, ?)",
+                (hash, content_hash, size, ref_path, ref_is_dir, module_function),
+            )
+
+        connection.execute("DROP TABLE cache")
+        connection.execute("ALTER TABLE cache_new RENAME TO cache")
+        for sql in _REFCOUNT_SQL:
+            connection.execute(sql)
+
+        return old_files
+
+    def _pending(self):
+        pid_pendings = _pending_writes.get()
+        if pid_pendings is None or pid_pendings[0] != os.getpid():
+            return None
+        return pid_pendings[1].get(self.db_path)
 
-        cls.cursor.execute("""
+    def _is_packed(self, blob_size):
+        """ Whether a blob of `blob_size` bytes is written to a pack file. Until then its data is kept in memory """
+        return self.uses_packs and self.inline_max_bytes < blob_size <= PACK_MAX_BLOB_BYTES
+
+    def _prepare_blob(self, pending, content_bytes, compression):
+        """ Compresses `content_bytes` into a blob row unless `pending` already has one, and returns the content hash,
+        the row and the temporary file of its content. Done before taking the lock of `pending`, so that threads that
+        joined the transaction compress in parallel """
+        content_hash = get_content_hash(content_bytes)
+        blob_row = tmp_path = None
+        if pending.get_blob(content_hash) is None:
+            codec, blob_data = compress(content_bytes, compression)
+            blob_size = len(blob_data)
+            if blob_size > self.inline_max_bytes and not self._is_packed(blob_size):
+                # Faster to store data in a file. It's written to a temporary file now so that it doesn't have to be
+                # kept in memory, and moved into place when the rows are written
+                tmp_path = f'{get_tmp_dir(self.merkl_path)}{content_hash}.{os.getpid()}-{threading.get_ident()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(blob_data)
+                blob_data = None
+
+            blob_row = (content_hash, blob_data, blob_size, codec)
+
+        return content_hash, blob_row, tmp_path
+
+    def _record_access(self, hash):
+        if self.read_only:
+            return
+
+        with SqliteCache._lock:
+            accesses = SqliteCache._pending_accesses.setdefault(self.merkl_path, {})
+            accesses[hash] = time.time()
+            is_full = len(accesses) >= self.max_pending_accesses
+
+        if is_full and self._pending() is None:
+            with self._write() as connection:
+                self._write_accesses(connection)
+
+    def _write_accesses(self, connection):
+        """ Writes the buffered access times, must be called in a write transaction """
+        with SqliteCache._lock:
+            accesses = SqliteCache._pending_accesses.pop(self.merkl_path, None)
+
+        if accesses:
+            connection.executemany(
+                "UPDATE cache SET last_access=? WHERE hash=? AND last_access<?",
+                [(access_time, hash, access_time) for hash, access_time in accesses.items()],
+            )
+
+    def record_stats(self, module_function, hits=0, misses=0, bytes_read=0, bytes_written=0, load_seconds=0.0, compute_seconds=0.0, writes=0):
+        if module_function is None or self.read_only:
+            return
+
+        with SqliteCache._lock:
+            stats = SqliteCache._pending_stats.setdefault(self.merkl_path, {})
+            totals = stats.setdefault(module_function, [0, 0, 0, 0, 0.0, 0.0, 0])
+            for i, val in enumerate([hits, misses, bytes_read, bytes_written, load_seconds, compute_seconds, writes]):
+                totals[i] += val
+
+    def _record_read(self, kind, size, seconds):
+        if self.read_only:
+            return
+
+        with SqliteCache._lock:
+            reads = SqliteCache._pending_reads.setdefault(self.merkl_path, {})
+            totals = reads.setdefault(kind, [0, 0.0, 0.0, 0.0, 0.0])
+            for i, val in enumerate([1, size, seconds, size * size, size * seconds]):
+                totals[i] += val
+
+    def _write_stats(self, connection):
+        """ Writes the buffered TaskStats and blob reads, must be called in a write transaction """
+        with SqliteCache._lock:
+            stats = SqliteCache._pending_stats.pop(self.merkl_path, None)
+            reads = SqliteCache._pending_reads.pop(self.merkl_path, None)
+
+        if reads:
+            connection.executemany(
+                """
+                INSERT INTO read_latencies VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (kind) DO UPDATE SET
+                    count = count + excluded.count,
+                    sum_size = sum_size + excluded.sum_size,
+                    sum_seconds = sum_seconds + excluded.sum_seconds,
+                    sum_size2 = sum_size2 + excluded.sum_size2,
+                    sum_size_seconds = sum_size_seconds + excluded.sum_size_seconds
+                """,
+                [(kind, *totals) for kind, totals in reads.items()],
+            )
+            SqliteCache._inline_max_bytes.pop(self.merkl_path, None)
+
+        if stats:
+            connection.executemany(
+                """
+                INSERT INTO task_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (module_function) DO UPDATE SET
+                    hits = hits + excluded.hits,
+                    misses = misses + excluded.misses,
+                    bytes_read = bytes_read + excluded.bytes_read,
+                    bytes_written = bytes_written + excluded.bytes_written,
+                    load_seconds = load_seconds + excluded.load_seconds,
+                    compute_seconds = compute_seconds + excluded.compute_seconds,
+                    writes = writes + excluded.writes
+                """,
+                [(module_function, *totals) for module_function, totals in stats.items()],
+            )
+
+    def get_task_stats(self):
+        if not self.read_only:
+            with self._write() as connection:
+                self._write_stats(connection)
+        return [TaskStats(*row) for row in self.connect().execute("SELECT * FROM task_stats ORDER BY module_function")]
+
+    @staticmethod
+    def _write_all_accesses():
+        for merkl_path in set(SqliteCache._pending_accesses) | set(SqliteCache._pending_stats) | set(SqliteCache._pending_reads):
+            SqliteCache(merkl_path).close()
+
+    def _delete_unreferenced_blobs(self, connection):
+        """ Deletes the blobs that no cache entry references anymore, and moves their files to the trash. Must be
+        called in a write transaction """
+        connection.execute(
+            "INSERT OR IGNORE INTO trash SELECT content_hash, 'blob' FROM blobs WHERE refcount <= 0 AND data IS NULL AND pack IS NULL"
+        )
+        connection.execute("DELETE FROM blobs WHERE refcount <= 0")
+
+    def _has_trash(self, connection):
+        return list(connection.execute("SELECT EXISTS (SELECT 1 FROM trash)"))[0][0] == 1
+
+    def _empty_trash(self):
+        """ Removes the files in the trash, and returns how many there were. Files are only moved to the trash in the
+        transaction that deletes their entries or blobs, so a crash can't leave entries without their files. They are
+        removed holding the write lock, and writes that reference a file again take it out of the trash, so that a file
+        is never removed while referenced """
+        with self._write() as connection:
+            trash = list(connection.execute("SELECT name, kind FROM trash"))
+            for name, kind in trash:
+                try:
+                    if kind == 'blob':
+                        os.remove(get_blob_file_path(name, merkl_path=self.merkl_path))
+                    elif kind == 'dir':
+                        shutil.rmtree(name)
+                    else:
+                        os.remove(name)
+                except FileNotFoundError:
+                    pass
+            connection.execute("DELETE FROM trash")
+
+        if len(trash) > 0:
+            logger.debug(f'Removed {len(trash)} files or directories from cache')
+        return len(trash)
+
+    def _select_stored_blobs(self, connection, content_hashes, in_db_only=False):
+        """ Returns the `content_hashes` that have a blob, or with `in_db_only` a blob stored inline or in a pack """
+        stored = set()
+        condition = " AND (data IS NOT NULL OR pack IS NOT NULL)" if in_db_only else ""
+        for i in range(0, len(content_hashes), GC_DELETE_CHUNK_SIZE):
+            chunk = content_hashes[i:i+GC_DELETE_CHUNK_SIZE]
+            stored.update(content_hash for content_hash, in connection.execute(
+                f"SELECT content_hash FROM blobs WHERE content_hash IN ({','.join('?' * len(chunk))}){condition}", chunk
+            ))
+        return stored
+
+    def _write_packs(self, rows, min_pack_id=0):
+        """ Appends the data of the blob `rows` to the last pack file, or to new ones once it's full, and returns the
+        rows with their data replaced by their location. Must be called in a write transaction, which is what keeps
+        other processes from appending at the same time. If the transaction fails, the appended data is left as dead
+        space to be reclaimed by `repack` """
+        packs_dir = get_packs_dir(self.merkl_path)
+        os.makedirs(packs_dir, exist_ok=True)
+        pack_ids = [int(name.split('.')[0]) for name in os.listdir(packs_dir) if name.endswith('.pack')]
+        pack_id = max(pack_ids + [min_pack_id])
+
+        packed_rows = []
+        f = None
+        try:
+            for content_hash, data, size, codec in rows:
+                if f is None:
+                    f = open(get_pack_path(pack_id, self.merkl_path), 'ab')
+                if f.tell() > 0 and f.tell() + size > PACK_MAX_BYTES:
+                    f.close()
+                    pack_id += 1
+                    f = open(get_pack_path(pack_id, self.merkl_path), 'ab')
+
+                packed_rows.append((content_hash, None, size, codec, pack_id, f.tell()))
+                f.write(data)
+        finally:
+            if f is not None:
+                f.close()
+
+        return packed_rows
+
+    def _flush(self, pending):
+        with pending.lock:
+            self._flush_locked(pending)
+
+    def _flush_locked(self, pending):
+        if len(pending.cache_rows) > 0 or len(pending.blobs) > 0 or len(pending.file_rows) > 0:
+            with self._write() as connection:
+                # Move files into place while holding the lock, so that a concurrent clear can't remove the file of a
+                # blob that is about to be referenced. If the content is cached in a file already, the file is replaced
+                # by an identical one. If it's stored inline or in a pack, the blob row isn't replaced, so the file
+                # would never be referenced
+                file_hashes = [content_hash for content_hash, (_, _, tmp_path) in pending.blobs.items() if tmp_path is not None]
+                stored_in_db = self._select_stored_blobs(connection, file_hashes, in_db_only=True)
+                for content_hash in file_hashes:
+                    tmp_path = pending.blobs[content_hash][2]
+                    if content_hash in stored_in_db:
+                        os.remove(tmp_path)
+                    else:
+                        blob_path = get_blob_file_path(content_hash, makedirs=True, merkl_path=self.merkl_path)
+                        os.replace(tmp_path, blob_path)
+
+                blob_rows = []
+                packed_rows = []
+                for _, row, _ in pending.blobs.values():
+                    if row[1] is not None and self._is_packed(row[2]):
+                        packed_rows.append(row)
+                    else:
+                        blob_rows.append(row + (None, None))
+
+                if len(packed_rows) > 0:
+                    # NOTE: data appended for a blob that is stored already would only take up space
+                    stored = self._select_stored_blobs(connection, [row[0] for row in packed_rows])
+                    blob_rows += self._write_packs(row for row in packed_rows if row[0] not in stored)
+
+                connection.executemany(
+                    "INSERT OR IGNORE INTO blobs (content_hash, data, size, codec, pack, pack_offset) VALUES (?, ?, ?, ?, ?, ?)",
+                    blob_rows,
+                )
+                # NOTE: another process may have cached the same hash since we checked, in which case keep that entry
+                connection.executemany(
+                    """
+                    INSERT OR IGNORE INTO cache (hash, content_hash, size, ref_path, ref_is_dir, module_function, last_access, format)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [row for _, row in pending.cache_rows.values()],
+                )
+                connection.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                    [row for _, row in pending.file_rows.values()],
+                )
+                # Files written again since they were moved to the trash
+                connection.executemany(
+                    "DELETE FROM trash WHERE name=?",
+                    [(content_hash,) for content_hash in file_hashes if content_hash not in stored_in_db]
+                    + [(row[3],) for _, row in pending.cache_rows.values() if row[3] is not None],
+                )
+                # Blobs of entries that were ignored, or cleared before the flush
+                self._delete_unreferenced_blobs(connection)
+                self._write_accesses(connection)
+                self._write_stats(connection)
+                has_trash = self._has_trash(connection)
+
+            if has_trash:
+                self._empty_trash()
+        pending.clear()
+
+    @contextmanager
+    def transaction(self):
+        """ Scope in which `add` and `track_file` calls of the current thread are buffered, and then written with
+        executemany in a single commit when the outermost scope exits. Scopes can be nested, and an exception discards
+        the rows added in the scopes it propagates out of. Threads running in a copy of the current context (see
+        `_pending_writes`) join the transaction, and must be done before it exits """
+        pid_pendings = _pending_writes.get()
+        token = None
+        if pid_pendings is None or pid_pendings[0] != os.getpid():
+            pid_pendings = (os.getpid(), {})
+            token = _pending_writes.set(pid_pendings)
+
+        pendings = pid_pendings[1]
+        db_path = self.db_path
+        pending = pendings.get(db_path)
+        is_outermost = pending is None
+        if is_outermost:
+            pending = pendings[db_path] = _PendingWrites()
+
+        seq = pending.next_seq
+        try:
+            yield
+        except BaseException:
+            pending.discard_from(seq)
+            raise
+        finally:
+            if is_outermost:
+                del pendings[db_path]
+            if token is not None:
+                _pending_writes.reset(token)
+
+        if is_outermost:
+            self._flush(pending)
+
+    def create_cache(self):
+        if self.read_only or os.path.exists(self.db_path):
+            return
+
+        logger.debug(f'Creating cache')
+        os.makedirs(self.merkl_path, exist_ok=True)
+        os.makedirs(get_tmp_dir(self.merkl_path), exist_ok=True)
+        os.makedirs(get_cache_dir_path(merkl_path=self.merkl_path), exist_ok=True)
+        os.makedirs(f'{self.merkl_path}blobs/', exist_ok=True)
+        os.makedirs(get_packs_dir(self.merkl_path), exist_ok=True)
+
+        # NOTE: use a separate connection, since page_size can't be changed once the database is in WAL mode
+        connection = sqlite3.connect(self.db_path, isolation_level=None)
+
+        # Increase page size for faster BLOB performance:
+        # https://www.sqlite.org/intern-v-extern-blob.html#:~:text=A%20database%20page%20size%20of,a%20separate%20file%20are%20faster.
+        connection.execute("PRAGMA page_size = 16384;")
+
+        connection.execute(_CACHE_TABLE_SQL)
+        connection.execute(_BLOBS_TABLE_SQL)
+        connection.execute(_PACK_INDEX_SQL)
+        connection.execute(_PINS_TABLE_SQL)
+        connection.execute(_TASK_STATS_TABLE_SQL)
+        connection.execute(_READ_LATENCIES_TABLE_SQL)
+        for sql in _REFCOUNT_SQL + _TRASH_SQL + [_LAST_ACCESS_INDEX_SQL, _MODULE_FUNCTION_INDEX_SQL]:
+            connection.execute(sql)
+
+        connection.execute("""
             CREATE TABLE files (
                 path TEXT,
                 modified INTEGER,
@@ -131,118 +1481,216 @@ class SqliteCache:
             )
         """)
 
-    @classmethod
-    def transfer_ref(cls, ref, hash):
-        """ Transfers a FileRef/DirRef from the original place in the file system to the merkl cache, and returns
-        the new ref with the new path """
-        logger.debug(f'Transferring {ref}')
-        if isinstance(ref, merkl.io.FileRef):
-            splits = ref.split('.')
-            ext = None if len(splits) == 1 else splits[-1]
-            cache_file_path = get_cache_file_path(hash, ext, makedirs=True)
-            if os.path.exists(cache_file_path):
-                os.remove(cache_file_path)
+        connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
 
-            if ref.rm_after_caching:
-                os.rename(ref, cache_file_path)
-            else:
-                shutil.copy(ref, cache_file_path)
+        # The journal mode is persistent, so all later connections use WAL too
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.close()
 
-            new_file_out = merkl.io.FileRef(cache_file_path)
-            return new_file_out
-        elif isinstance(ref, merkl.io.DirRef):
-            cache_dir_path = get_cache_out_dir_path(hash, makedirs=True)
-            if ref.rm_after_caching:
-                os.rename(ref, cache_dir_path)
-            else:
-                shutil.copytree(ref, cache_dir_path)
+    def get_ref_file_path(self, hash, ext):
+        return get_cache_file_path(hash, ext, makedirs=True, merkl_path=self.merkl_path)
 
-            ref = merkl.io.DirRef(cache_dir_path, files=ref._files)
-            return ref
+    def get_ref_dir_path(self, hash):
+        return get_cache_out_dir_path(hash, makedirs=True, merkl_path=self.merkl_path)
 
-    @classmethod
-    def add(cls, hash, content_bytes=None, ref=None, fn_name=None):
-        content_len = len(content_bytes) if content_bytes is not None else 0
+    def add(self, hash, content_bytes=None, ref=None, fn_name=None, compression=None, format=None):
+        self._check_writable()
+        content_len = len(content_bytes)
         if ref is not None:
             content_len = os.stat(ref).st_size
 
         ref_path = None if ref is None else str(ref)
         ref_is_dir = isinstance(ref, merkl.io.DirRef)
 
-        if ref is None and content_len > BLOB_DB_SIZE_LIMIT_BYTES:
-            # Faster to store data in a file
-            cache_file_path = get_cache_file_path(hash, makedirs=True)
-            with open(cache_file_path, 'wb') as f:
-                f.write(content_bytes)
-            content_bytes = None
+        pending = self._pending()
+        is_buffered = pending is not None
+        if not is_buffered:
+            pending = _PendingWrites()
 
-        cls.connect()
-        cls.cursor.execute("INSERT INTO cache VALUES (?, ?, ?, ?, ?, ?)", (hash, content_bytes, content_len, ref_path, ref_is_dir, fn_name))
-        if not cls.no_commit:
-            cls.connection.commit()
+        content_hash, blob_row, tmp_path = self._prepare_blob(pending, content_bytes, compression or self.compression)
+        # NOTE: the blob and the row referencing it are added together, since a flush deletes unreferenced blobs
+        with pending.lock:
+            if blob_row is not None:
+                pending.add_blob(content_hash, blob_row, tmp_path)
+            pending.add_cache_row(hash, (hash, content_hash, content_len, ref_path, ref_is_dir, fn_name, time.time(), format))
+            if not is_buffered or pending.num_bytes > self.max_pending_bytes:
+                self._flush(pending)
 
-    @classmethod
-    def clear(cls, hash):
-        logger.debug(f'Clearing {short_hash(hash)}')
-        cls.connect()
-        result = list(cls.cursor.execute("SELECT ref_path, ref_is_dir, data FROM cache WHERE hash=?", (hash,)))
-        if len(result) == 0:
-            return
+    def add_stream(self, hash, dump, fn_name=None, compression=None, format=None):
+        self._check_writable()
+        compression = compression or self.compression
+        if compression is not None:
+            # The codecs compress the whole value at once
+            return super().add_stream(hash, dump, fn_name=fn_name, compression=compression, format=format)
+
+        # The value is written to a temporary file and hashed at the same time, and the file is moved into place when
+        # the rows are written, like the file of a large blob staged by `add`
+        tmp_path = f'{get_tmp_dir(self.merkl_path)}{hash}.{os.getpid()}-{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                writer = HashingWriter(f)
+                dump(writer)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        pending = self._pending()
+        is_buffered = pending is not None
+        if not is_buffered:
+            pending = _PendingWrites()
+
+        content_hash = writer.content_hash
+        blob_row = None
+        if pending.get_blob(content_hash) is not None:
+            os.remove(tmp_path)
+        elif writer.size <= self.inline_max_bytes or self._is_packed(writer.size):
+            with open(tmp_path, 'rb') as f:
+                blob_data = f.read()
+            os.remove(tmp_path)
+            blob_row, tmp_path = (content_hash, blob_data, writer.size, None), None
+        else:
+            blob_row = (content_hash, None, writer.size, None)
 
-        ref_path, ref_is_dir, data = result[0]
+        with pending.lock:
+            if blob_row is not None:
+                pending.add_blob(content_hash, blob_row, tmp_path)
+            pending.add_cache_row(hash, (hash, content_hash, writer.size, None, False, fn_name, time.time(), format))
+            if not is_buffered or pending.num_bytes > self.max_pending_bytes:
+                self._flush(pending)
+        return writer.size
+
+    def _remove_ref(self, ref_path, ref_is_dir):
         if ref_path is not None:
             if ref_is_dir:
                 shutil.rmtree(ref_path)
             else:
                 os.remove(ref_path)
 
-        if data is None:
-            # Data stored on file, remove it
-            os.remove(get_cache_file_path(hash))
+    def clear(self, hash):
+        logger.debug(f'Clearing {short_hash(hash)}')
+        pending = self._pending()
+        pending_row = pending.pop_cache_row(hash) if pending is not None else None
+        if pending_row is not None:
+            # NOTE: the blob is deleted on flush if no other entry references it
+            self._remove_ref(*pending_row[3:5])
+            return
+
+        with self._write() as connection:
+            connection.execute("DELETE FROM cache WHERE hash=?", (hash,))
+            self._delete_unreferenced_blobs(connection)
+            has_trash = self._has_trash(connection)
 
-        cls.cursor.execute("DELETE FROM cache WHERE hash=?", (hash,))
-        if not cls.no_commit:
-            cls.connection.commit()
+        if has_trash:
+            self._empty_trash()
 
-    @classmethod
-    def clear_all_except(cls, hashes):
-        num_items_in_cache = list(cls.cursor.execute('SELECT COUNT(*) FROM cache'))[0][0]
-        num_deleted = num_items_in_cache - len(hashes)
-        if num_deleted > 0:
-            logger.warning(f'Deleting approximately {num_deleted} items from cache')
+    def clear_all_except(self, hashes):
+        """ Mark and sweep: the hashes to keep are marked in a temporary table, and the other entries are then deleted
+        in chunks, each in a transaction of its own so that other writers aren't blocked for long """
+        connection = self.connect()
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS live (hash CHARACTER(64) PRIMARY KEY)")
+        with self._write() as connection:
+            connection.execute("DELETE FROM live")
+            connection.executemany("INSERT OR IGNORE INTO live VALUES (?)", ((hash,) for hash in hashes))
+            dead = [hash for hash, in connection.execute("SELECT hash FROM cache WHERE hash NOT IN (SELECT hash FROM live)")]
 
-        quoted_hashes = [f'"{hash}"' for hash in hashes]
-        hashes_with_files = list(
-            cls.cursor.execute(f"SELECT hash, ref_path, ref_is_dir FROM cache WHERE hash NOT IN ({','.join(quoted_hashes)}) AND (data IS NULL OR ref_path IS NOT NULL)")
-        )
-        cls.cursor.execute(f"DELETE FROM cache WHERE hash NOT IN ({','.join(quoted_hashes)})", )
+        if len(dead) > 0:
+            logger.warning(f'Deleting {len(dead)} items from cache')
 
-        if len(hashes_with_files) > 0:
-            logger.warning(f'Deleting {len(hashes_with_files)} files or directories from cache')
+        for i in range(0, len(dead), GC_DELETE_CHUNK_SIZE):
+            chunk = dead[i:i+GC_DELETE_CHUNK_SIZE]
+            with self._write() as connection:
+                # NOTE: the entries may have been cleared, or added again, since they were selected
+                connection.execute(f"DELETE FROM cache WHERE hash IN ({','.join('?' * len(chunk))})", chunk)
+                self._delete_unreferenced_blobs(connection)
 
-        for hash, ref_path, ref_is_dir in hashes_with_files:
-            if ref_path is not None:
-                if ref_is_dir:
-                    shutil.rmtree(ref_path)
+        connection.execute("DELETE FROM live")
+        num_files = self._empty_trash()
+        if num_files > 0:
+            logger.warning(f'Deleted {num_files} files or directories from cache')
+
+    def sweep_orphans(self, dry_run=False):
+        """ Removes files in the cache directories that no entry references, e.g. left behind by a crash or by older
+        versions of merkl, along with any files in the trash. Files changed in the last ORPHAN_MIN_AGE seconds are left
+        alone. Returns the number of files or directories removed and their size in bytes """
+        if not dry_run:
+            self._empty_trash()
+
+        min_changed = time.time() - ORPHAN_MIN_AGE
+
+        def get_size(path):
+            if not os.path.isdir(path):
+                return os.stat(path).st_size
+            return sum(os.stat(os.path.join(dir_path, file_name)).st_size for dir_path, _, file_names in os.walk(path) for file_name in file_names)
+
+        def find_old(dir_path):
+            """ Yields the paths in the shard directories of `dir_path` that are older than ORPHAN_MIN_AGE """
+            for shard in os.listdir(dir_path) if os.path.exists(dir_path) else []:
+                shard_path = os.path.join(dir_path, shard)
+                for name in os.listdir(shard_path) if os.path.isdir(shard_path) else [shard]:
+                    path = os.path.join(shard_path, name) if os.path.isdir(shard_path) else shard_path
+                    stat = os.stat(path)
+                    # NOTE: ctime is updated by renames too, e.g. of a ref moved into the cache
+                    if max(stat.st_mtime, stat.st_ctime) < min_changed:
+                        yield path
+
+        def find_orphans(connection):
+            ref_paths = {
+                os.path.abspath(ref_path) for ref_path, in connection.execute("SELECT ref_path FROM cache WHERE ref_path IS NOT NULL")
+            }
+            orphans = [path for path in find_old(get_cache_dir_path(merkl_path=self.merkl_path)) if os.path.abspath(path) not in ref_paths]
+
+            for path in find_old(f'{self.merkl_path}blobs/'):
+                content_hash = os.path.basename(path).split('.')[0]
+                if len(list(connection.execute("SELECT 1 FROM blobs WHERE content_hash=? AND data IS NULL AND pack IS NULL", (content_hash,)))) == 0:
+                    orphans.append(path)
+
+            tmp_dir = get_tmp_dir(self.merkl_path)
+            for name in os.listdir(tmp_dir) if os.path.exists(tmp_dir) else []:
+                path = f'{tmp_dir}{name}'
+                if os.stat(path).st_mtime < min_changed:
+                    orphans.append(path)
+            return orphans
+
+        # Find candidates without blocking writers, then check them again holding the lock
+        candidates = find_orphans(self.connect())
+        if len(candidates) == 0 or dry_run:
+            return len(candidates), sum(get_size(path) for path in candidates)
+
+        num_bytes = 0
+        with self._write() as connection:
+            orphans = set(candidates) & set(find_orphans(connection))
+            for path in orphans:
+                num_bytes += get_size(path)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
                 else:
-                    os.remove(ref_path)
-            else:
-                os.remove(get_cache_file_path(hash))
+                    os.remove(path)
+
+        if len(orphans) > 0:
+            logger.warning(f'Removed {len(orphans)} orphaned files or directories from cache')
+        return len(orphans), num_bytes
 
-    @classmethod
-    def track_file(cls, path, modified=None, merkl_hash=None, md5_hash=None):
+    def track_file(self, path, modified=None, merkl_hash=None, md5_hash=None):
+        self._check_writable()
         logger.debug(f'Hashing file {path} modified={modified} merkl_hash={short_hash(merkl_hash)} md5_hash={short_hash(md5_hash)}')
         modified = modified or get_modified_time(path)
-        cls.connect()
-        cls.cursor.execute("INSERT INTO files VALUES (?, ?, ?, ?)", (path, modified, merkl_hash, md5_hash))
-        if not cls.no_commit:
-            cls.connection.commit()
+        row = (path, modified, merkl_hash, md5_hash)
+        pending = self._pending()
+        if pending is not None:
+            pending.add_file_row(path, modified, row)
+            return
 
-    @classmethod
-    def get_file_mod_hash(cls, path, modified=None):
+        with self._write() as connection:
+            connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", row)
+
+    def get_file_mod_hash(self, path, modified=None):
         modified = modified or get_modified_time(path)
-        cls.connect()
-        result = cls.cursor.execute("SELECT md5_hash, merkl_hash FROM files WHERE path=? AND modified=?", (path, modified))
+        pending = self._pending()
+        if pending is not None and (path, modified) in pending.file_rows:
+            _, (_, _, merkl_hash, md5_hash) = pending.file_rows[(path, modified)]
+            return md5_hash, merkl_hash
+
+        result = self.connect().execute("SELECT md5_hash, merkl_hash FROM files WHERE path=? AND modified=?", (path, modified))
         result = list(result)
         if len(result) == 0:
             return None, None
@@ -250,58 +1698,408 @@ class SqliteCache:
         assert len(result) == 1
         return result[0]
 
-    @classmethod
-    def get_latest_file(cls, path):
-        cls.connect()
-        result = cls.cursor.execute("""
+    def get_latest_file(self, path):
+        result = self.connect().execute("""
             SELECT md5_hash, merkl_hash, modified
             FROM files
             WHERE path=? ORDER BY modified DESC
         """, (path,))
         result = list(result)
+        pending = self._pending()
+        if pending is not None:
+            result += [
+                (md5_hash, merkl_hash, modified)
+                for _, (file_path, modified, merkl_hash, md5_hash) in pending.file_rows.values()
+                if file_path == path
+            ]
         if len(result) == 0:
             return None, None, None
-        return result[0]
+        return max(result, key=lambda x: x[2])
+
+    def get(self, hash):
+        return self._get(hash, as_buffer=False)
+
+    def get_buffer(self, hash):
+        return self._get(hash, as_buffer=True)
+
+    def _get(self, hash, as_buffer, retry=True):
+        pending = self._pending()
+        pending_row = pending.get_cache_row(hash) if pending is not None else None
+        if pending_row is not None:
+            (content_hash, data, _, codec), tmp_path = pending.get_blob(pending_row[1])
+            if data is None:
+                with open(tmp_path, 'rb') as f:
+                    data = f.read()
+            return decompress(codec, data)
 
-    @classmethod
-    def get(cls, hash):
-        cls.connect()
-        result = cls.cursor.execute("SELECT data FROM cache WHERE hash=?", (hash,))
+        start_time = time.perf_counter()
+        result = self.connect().execute("""
+            SELECT blobs.content_hash, blobs.data, blobs.size, blobs.codec, blobs.pack, blobs.pack_offset, cache.last_access
+            FROM cache JOIN blobs ON cache.content_hash = blobs.content_hash
+            WHERE cache.hash=?
+        """, (hash,))
         result = list(result)
         if len(result) == 0:
             return None
 
-        data = result[0][0]
-        if data is None:
-            with open(get_cache_file_path(hash), 'rb') as f:
-                return f.read()
+        content_hash, data, size, codec, pack, pack_offset, last_access = result[0]
+        if time.time() - last_access > self.access_time_resolution:
+            self._record_access(hash)
 
-        return data
+        # NOTE: mapped reads aren't measured, since the data is only read when it's used
+        kind = 'inline' if data is not None else 'file'
+        try:
+            if pack is not None:
+                pack_path = get_pack_path(pack, self.merkl_path)
+                if as_buffer and codec is None:
+                    return map_file(pack_path)[pack_offset:pack_offset + size]
 
-    @classmethod
-    def has(cls, hash):
-        cls.connect()
-        result = cls.cursor.execute("SELECT COUNT(*) FROM cache WHERE hash=?", (hash,))
+                with open(pack_path, 'rb') as f:
+                    data = os.pread(f.fileno(), size, pack_offset)
+            elif data is None:
+                blob_path = get_blob_file_path(content_hash, merkl_path=self.merkl_path)
+                if as_buffer and codec is None:
+                    return map_file(blob_path)
+
+                with open(blob_path, 'rb') as f:
+                    data = f.read()
+        except FileNotFoundError:
+            # The blob may have been cleared, or moved by `repack`, since it was selected
+            if retry:
+                return self._get(hash, as_buffer, retry=False)
+            raise
+
+        self._record_read(kind, size, time.perf_counter() - start_time)
+        return decompress(codec, data)
+
+    def has(self, hash):
+        pending = self._pending()
+        if pending is not None and hash in pending.cache_rows:
+            return True
+
+        result = self.connect().execute("SELECT COUNT(*) FROM cache WHERE hash=?", (hash,))
         result = list(result)
         return result[0][0] > 0
 
-    @classmethod
-    def has_file(cls, hash):
-        cls.connect()
-        result = cls.cursor.execute("SELECT COUNT(*) FROM files WHERE md5_hash=?", (hash,))
+    def has_file(self, hash):
+        pending = self._pending()
+        if pending is not None and any(row[3] == hash for _, row in pending.file_rows.values()):
+            return True
+
+        result = self.connect().execute("SELECT COUNT(*) FROM files WHERE md5_hash=?", (hash,))
         result = list(result)
         return result[0][0] > 0
 
-    @classmethod
-    def get_stats(cls, module_function=None):
-        cls.connect()
+    def get_stats(self, module_function=None):
+        connection = self.connect()
         if module_function is not None:
-            return list(cls.cursor.execute("SELECT COUNT(*), SUM(size) FROM cache WHERE module_function=?", (module_function,)))[0]
+            return list(connection.execute("SELECT COUNT(*), SUM(size) FROM cache WHERE module_function=?", (module_function,)))[0]
         else:
-            return list(cls.cursor.execute("SELECT module_function, COUNT(*), SUM(size) FROM cache GROUP BY module_function"))
+            return list(connection.execute("SELECT module_function, COUNT(*), SUM(size) FROM cache GROUP BY module_function"))
+
+    def get_module_function(self, hash):
+        pending = self._pending()
+        pending_row = pending.get_cache_row(hash) if pending is not None else None
+        if pending_row is not None:
+            return pending_row[5]
+
+        result = list(self.connect().execute("SELECT module_function FROM cache WHERE hash=?", (hash,)))
+        return result[0][0] if len(result) > 0 else None
+
+    def get_codec(self, hash):
+        pending = self._pending()
+        pending_row = pending.get_cache_row(hash) if pending is not None else None
+        if pending_row is not None:
+            pending_blob = pending.get_blob(pending_row[1])
+            if pending_blob is not None:
+                return pending_blob[0][3]
+
+        result = list(self.connect().execute(
+            "SELECT blobs.codec FROM cache JOIN blobs ON blobs.content_hash = cache.content_hash WHERE cache.hash=?", (hash,)
+        ))
+        return result[0][0] if len(result) > 0 else None
+
+    def get_format(self, hash):
+        pending = self._pending()
+        pending_row = pending.get_cache_row(hash) if pending is not None else None
+        if pending_row is not None:
+            return pending_row[7]
+
+        result = list(self.connect().execute("SELECT format FROM cache WHERE hash=?", (hash,)))
+        return result[0][0] if len(result) > 0 else None
+
+    def get_ref_path(self, hash):
+        pending = self._pending()
+        pending_row = pending.get_cache_row(hash) if pending is not None else None
+        if pending_row is not None:
+            return pending_row[3], bool(pending_row[4])
+
+        result = list(self.connect().execute("SELECT ref_path, ref_is_dir FROM cache WHERE hash=?", (hash,)))
+        return (result[0][0], bool(result[0][1])) if len(result) > 0 else (None, False)
+
+    def clear_module_function(self, module_function):
+        with self._write() as connection:
+            connection.execute("DELETE FROM cache WHERE module_function=?", (module_function,))
+            self._delete_unreferenced_blobs(connection)
+
+        self._empty_trash()
+
+    def pin(self, name, hashes):
+        with self._write() as connection:
+            connection.execute("DELETE FROM pins WHERE name=?", (name,))
+            connection.executemany("INSERT OR IGNORE INTO pins VALUES (?, ?)", [(name, hash) for hash in hashes])
+
+    def unpin(self, name):
+        with self._write() as connection:
+            connection.execute("DELETE FROM pins WHERE name=?", (name,))
+
+    def get_pins(self):
+        return list(self.connect().execute("SELECT name, COUNT(*) FROM pins GROUP BY name"))
+
+    def _select_evictions(self, connection, max_bytes, max_age):
+        """ Returns the rows of the entries to evict, and the number of bytes that evicting them frees """
+        now = time.time()
+        # Blobs are shared between entries, so evicting an entry only frees its blob if it's the last reference
+        total_bytes = list(connection.execute("""
+            SELECT (SELECT COALESCE(SUM(size), 0) FROM blobs)
+                + (SELECT COALESCE(SUM(size), 0) FROM cache WHERE ref_path IS NOT NULL)
+        """))[0][0]
+        candidates = connection.execute("""
+            SELECT hash, content_hash, size, ref_path, ref_is_dir, last_access
+            FROM cache
+            WHERE hash NOT IN (SELECT hash FROM pins)
+            ORDER BY last_access
+        """)
+
+        evicted_rows = []
+        num_freed = 0
+        blob_refcounts = {}
+        for hash, content_hash, size, ref_path, ref_is_dir, last_access in candidates:
+            is_expired = max_age is not None and last_access < now - max_age
+            if not is_expired and (max_bytes is None or total_bytes - num_freed <= max_bytes):
+                break
+
+            evicted_rows.append((hash, ref_path, ref_is_dir))
+            if ref_path is not None:
+                num_freed += size
+
+            if content_hash not in blob_refcounts:
+                blob_refcounts[content_hash] = list(
+                    connection.execute("SELECT refcount, size FROM blobs WHERE content_hash=?", (content_hash,))
+                )[0]
+            refcount, blob_size = blob_refcounts[content_hash]
+            blob_refcounts[content_hash] = (refcount - 1, blob_size)
+            if refcount == 1:
+                num_freed += blob_size
+
+        return evicted_rows, num_freed
+
+    def gc(self, max_bytes=None, max_age=None, dry_run=False):
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        max_age = max_age if max_age is not None else self.max_age
+        if max_bytes is None and max_age is None:
+            return 0, 0
+
+        with self._write() as connection:
+            self._write_accesses(connection)
+            evicted_rows, num_freed = self._select_evictions(connection, max_bytes, max_age)
+            if not dry_run:
+                hashes = [hash for hash, _, _ in evicted_rows]
+                for i in range(0, len(hashes), GC_DELETE_CHUNK_SIZE):
+                    chunk = hashes[i:i+GC_DELETE_CHUNK_SIZE]
+                    connection.execute(f"DELETE FROM cache WHERE hash IN ({','.join('?' * len(chunk))})", chunk)
+                self._delete_unreferenced_blobs(connection)
+
+        if not dry_run:
+            logger.info(f'Evicted {len(evicted_rows)} items ({num_freed} bytes) from cache')
+            self._empty_trash()
+            # Evicted blobs in pack files only free their space once the pack file is rewritten
+            self.repack_packs()
+
+        return len(evicted_rows), num_freed
+
+    def repack(self):
+        """ Moves the blobs whose placement (inline, in a pack file or in a file of their own) no longer matches their
+        size, e.g. since `inline_max_bytes` was adapted or packs were enabled, rewrites the pack files with dead space,
+        and rewrites the blobs table clustered by module function, so that the values of a function are read
+        sequentially. Then runs VACUUM, to free the space of deleted rows, and ANALYZE. Returns the number of blobs
+        moved and the number of bytes freed """
+        size_before = self._get_disk_usage()
+        num_moved = self._move_blobs()
+        self.repack_packs()
+        self._cluster_blobs()
+
+        connection = self.connect()
+        connection.execute('VACUUM')
+        connection.execute('ANALYZE')
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        # NOTE: the statistics gathered by ANALYZE take up a little space too
+        num_freed = max(size_before - self._get_disk_usage(), 0)
+        logger.info(f'Repacked cache, moving {num_moved} blobs and freeing {num_freed} bytes')
+        return num_moved, num_freed
+
+    def _get_disk_usage(self):
+        """ Size of the database and of the blob and pack files """
+        paths = [self.db_path, f'{self.db_path}-wal']
+        for dir_path in [f'{self.merkl_path}blobs/', get_packs_dir(self.merkl_path)]:
+            paths += [os.path.join(sub_dir, file_name) for sub_dir, _, file_names in os.walk(dir_path) for file_name in file_names]
+
+        num_bytes = 0
+        for path in paths:
+            try:
+                num_bytes += os.stat(path).st_size
+            except FileNotFoundError:
+                pass
+        return num_bytes
+
+    def _get_placement(self, blob_size):
+        if blob_size <= self.inline_max_bytes:
+            return 'inline'
+        return 'pack' if self._is_packed(blob_size) else 'file'
+
+    def _move_blobs(self):
+        """ Moves the blobs whose placement doesn't match their size to where a new blob of the size would go, in
+        chunks with a transaction each. Returns the number of blobs moved """
+        misplaced = [
+            content_hash
+            for content_hash, size, is_inline, pack in self.connect().execute("SELECT content_hash, size, data IS NOT NULL, pack FROM blobs")
+            if self._get_placement(size) != ('inline' if is_inline else 'file' if pack is None else 'pack')
+        ]
+
+        for i in range(0, len(misplaced), GC_DELETE_CHUNK_SIZE):
+            chunk = misplaced[i:i+GC_DELETE_CHUNK_SIZE]
+            with self._write() as connection:
+                blobs = connection.execute(
+                    f"SELECT content_hash, data, size, codec, pack, pack_offset FROM blobs WHERE content_hash IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+                updates = []
+                to_pack = []
+                to_trash = []
+                for content_hash, data, size, codec, pack, pack_offset in blobs:
+                    if pack is not None:
+                        with open(get_pack_path(pack, self.merkl_path), 'rb') as f:
+                            data = os.pread(f.fileno(), size, pack_offset)
+                    elif data is None:
+                        with open(get_blob_file_path(content_hash, merkl_path=self.merkl_path), 'rb') as f:
+                            data = f.read()
+                        to_trash.append((content_hash,))
+
+                    placement = self._get_placement(size)
+                    if placement == 'inline':
+                        updates.append((data, None, None, content_hash))
+                    elif placement == 'pack':
+                        to_pack.append((content_hash, data, size, codec))
+                    else:
+                        write_file_atomic(get_blob_file_path(content_hash, makedirs=True, merkl_path=self.merkl_path), data)
+                        updates.append((None, None, None, content_hash))
+
+                updates += [(None, pack, pack_offset, content_hash) for content_hash, _, _, _, pack, pack_offset in self._write_packs(to_pack)]
+                connection.executemany("UPDATE blobs SET data=?, pack=?, pack_offset=? WHERE content_hash=?", updates)
+                # NOTE: the data left behind in pack files is reclaimed by `repack_packs`
+                connection.executemany("INSERT OR IGNORE INTO trash VALUES (?, 'blob')", to_trash)
+
+            self._empty_trash()
+
+        return len(misplaced)
+
+    def _cluster_blobs(self):
+        """ Rewrites the blobs table in the order of the module function of the entries referencing them, so that the
+        rows of a function are next to each other in the database file once it's vacuumed """
+        with self._write() as connection:
+            connection.execute("""
+                CREATE TEMP TABLE clustered_blobs AS
+                SELECT blobs.* FROM blobs
+                LEFT JOIN (SELECT content_hash, MIN(module_function) AS module_function FROM cache GROUP BY content_hash) AS functions
+                ON blobs.content_hash = functions.content_hash
+                ORDER BY functions.module_function, blobs.content_hash
+            """)
+            connection.execute("DELETE FROM blobs")
+            connection.execute("INSERT INTO blobs SELECT * FROM clustered_blobs")
+            connection.execute("DROP TABLE clustered_blobs")
+
+    def repack_packs(self, min_dead_ratio=PACK_REPACK_MIN_DEAD_RATIO):
+        """ Rewrites the pack files in which at least `min_dead_ratio` of the bytes no longer belong to a blob, e.g.
+        after `clear` or `gc`, by moving their blobs to the last pack file. Each pack file is moved in a transaction of
+        its own. Returns the number of pack files rewritten and the number of bytes reclaimed """
+        packs_dir = get_packs_dir(self.merkl_path)
+        if not os.path.exists(packs_dir):
+            return 0, 0
+
+        pack_ids = sorted(int(name.split('.')[0]) for name in os.listdir(packs_dir) if name.endswith('.pack'))
+        num_packs = 0
+        num_freed = 0
+        for pack_id in pack_ids:
+            pack_path = get_pack_path(pack_id, self.merkl_path)
+            with self._write() as connection:
+                try:
+                    pack_size = os.stat(pack_path).st_size
+                except FileNotFoundError:
+                    continue  # repacked by another process
+
+                live_bytes = list(connection.execute("SELECT COALESCE(SUM(size), 0) FROM blobs WHERE pack=?", (pack_id,)))[0][0]
+                if pack_size == 0 or (pack_size - live_bytes) / pack_size < min_dead_ratio:
+                    continue
+
+                blobs = list(connection.execute(
+                    "SELECT content_hash, size, codec, pack_offset FROM blobs WHERE pack=? ORDER BY pack_offset", (pack_id,)
+                ))
+                with open(pack_path, 'rb') as f:
+                    # NOTE: the blobs are moved to a later pack file, never appended to the one being rewritten
+                    rows = (
+                        (content_hash, os.pread(f.fileno(), size, pack_offset), size, codec)
+                        for content_hash, size, codec, pack_offset in blobs
+                    )
+                    packed_rows = self._write_packs(rows, min_pack_id=pack_id + 1)
+
+                connection.executemany(
+                    "UPDATE blobs SET pack=?, pack_offset=? WHERE content_hash=?",
+                    [(new_pack_id, pack_offset, content_hash) for content_hash, _, _, _, new_pack_id, pack_offset in packed_rows],
+                )
+
+            # NOTE: readers that selected a blob before the move retry, see `_get`
+            os.remove(pack_path)
+            num_packs += 1
+            num_freed += pack_size - live_bytes
+
+        if num_packs > 0:
+            logger.info(f'Repacked {num_packs} pack files, freeing {num_freed} bytes')
+        return num_packs, num_freed
+
+
+class _FormerClassmethod:
+    """ Descriptor for a method of SqliteCache that used to be a classmethod, before caches became instances. Calling
+    it on the class, e.g. `SqliteCache.get(hash)`, still works on the shared instance from `resolve_cache`, but warns
+    that the call is deprecated """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __get__(self, instance, owner):
+        if instance is not None:
+            return self.function.__get__(instance, owner)
+
+        def _call(*args, **kwargs):
+            # An explicit `SqliteCache.get(cache, hash)` call passes the instance itself
+            if len(args) > 0 and isinstance(args[0], owner):
+                return self.function(*args, **kwargs)
+
+            warnings.warn(
+                f'Calling SqliteCache.{self.function.__name__} on the class is deprecated, call it on an instance, '
+                'e.g. merkl.cache.get_default_cache()',
+                DeprecationWarning,
+                stacklevel=2,
+            )
+            return self.function(resolve_cache(owner), *args, **kwargs)
+
+        return _call
+
+
+for _name in [
+    'connect', 'create_cache', 'transfer_ref', 'add', 'clear', 'clear_all_except', 'track_file', 'get_file_mod_hash',
+    'get_latest_file', 'get', 'has', 'has_file', 'get_stats', 'clear_module_function',
+]:
+    setattr(SqliteCache, _name, _FormerClassmethod(getattr(SqliteCache, _name)))
 
-    @classmethod
-    def clear_module_function(cls, module_function):
-        cls.connect()
-        result = list(cls.cursor.execute("DELETE FROM cache WHERE module_function=?", (module_function,)))
-        return result
+atexit.register(SqliteCache._write_all_accesses)
@@ -1,18 +1,127 @@
-import clize
-from sigtools.specifiers import forwards_to_function
+import functools
+from contextlib import contextmanager
 
-from merkl.future import Future, map_future_to_value
-from merkl.utils import nested_map, nested_collect, import_module_function
-from merkl.dot import print_dot_graph
 from merkl import cache
+from merkl.utils import import_module_function
+
+SIZE_UNITS = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+
+
+def parse_size(size):
+    """ Parses a size in bytes, optionally with a binary unit suffix, e.g. 500M or 10G """
+    unit = size[-1].upper()
+    if unit in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[unit])
+    return int(size)
+
+
+def parse_duration(duration):
+    """ Parses a duration in seconds, optionally with a unit suffix, e.g. 12h or 7d """
+    unit = duration[-1].lower()
+    if unit in DURATION_UNITS:
+        return float(duration[:-1]) * DURATION_UNITS[unit]
+    return float(duration)
+
+
+def export_futures_wrapper(f, output):
+    @functools.wraps(f)
+    def _wrap(*args, **kwargs):
+        outs = f(*args, **kwargs)
+        num_entries = cache.export_bundle(outs, output)
+        if output != '-':
+            print(f'Exported {num_entries} entries to {output}')
+
+    return _wrap
+
+
+@contextmanager
+def backend_support(operation):
+    """ Exits with a message rather than a traceback if the configured cache backend doesn't implement `operation` """
+    try:
+        yield
+    except NotImplementedError:
+        print(f'The {type(cache.get_default_cache()).__name__} cache backend does not support {operation}')
+        exit(1)
 
 
 class CacheAPI:
     def cache(self, module_function, clear=False):
         if module_function is not None:
-            count, size = cache.SqliteCache.get_stats(module_function)
+            count, size = cache.get_default_cache().get_stats(module_function)
             print(f'Num entries: {count}')
             print(f'Total size: {size} bytes ({size / 10e6}M)')
         else:
-            for module_function, count, size in sorted(cache.SqliteCache.get_stats(), key=lambda x: x[2]):
+            for module_function, count, size in sorted(cache.get_default_cache().get_stats(), key=lambda x: x[2]):
                 print(f'{size/10e6:.2f}M\t{count}\t{module_function}')
+
+    def gc(self, max_bytes=None, max_age=None, orphans=False, dry_run=False):
+        if max_bytes is None and max_age is None and not orphans:
+            print('Set --max-bytes, --max-age and/or --orphans')
+            exit(1)
+
+        if orphans:
+            with backend_support('sweeping orphans'):
+                num_removed, num_freed = cache.get_default_cache().sweep_orphans(dry_run)
+            prefix = 'Would remove' if dry_run else 'Removed'
+            print(f'{prefix} {num_removed} orphaned files, freeing {num_freed / 1024**2:.2f}M')
+
+        if max_bytes is not None or max_age is not None:
+            with backend_support('gc'):
+                num_evicted, num_freed = cache.get_default_cache().gc(max_bytes, max_age, dry_run)
+            prefix = 'Would evict' if dry_run else 'Evicted'
+            print(f'{prefix} {num_evicted} entries, freeing {num_freed / 1024**2:.2f}M')
+
+    def repack(self):
+        with backend_support('repack'):
+            num_moved, num_freed = cache.get_default_cache().repack()
+        print(f'Moved {num_moved} values, freeing {num_freed / 1024**2:.2f}M')
+
+    def export(self, output, module_function):
+        import clize
+        function = import_module_function(module_function)
+        function = export_futures_wrapper(function, output)
+        clize.run(function, args=['merkl-export', *self.unknown_args])
+
+    def import_bundle(self, bundle):
+        num_imported, num_skipped = cache.import_bundle(bundle)
+        print(f'Imported {num_imported} entries, skipped {num_skipped} already cached')
+
+    def pins(self, unpin=None):
+        with backend_support('pins'):
+            if unpin is not None:
+                cache.get_default_cache().unpin(unpin)
+                return
+
+            pins = cache.get_default_cache().get_pins()
+
+        for name, count in pins:
+            print(f'{count}\t{name}')
+
+    def stats(self):
+        default_cache = cache.get_default_cache()
+        sizes = {module_function: size for module_function, _, size in default_cache.get_stats()}
+        rows = []
+        for stats in default_cache.get_task_stats():
+            lookups = stats.hits + stats.misses
+            load = stats.load_seconds / stats.hits if stats.hits > 0 else None
+            compute = stats.compute_seconds / stats.misses if stats.misses > 0 else None
+            # Time the hits saved compared to recomputing, which is negative if loading is slower than computing
+            saved = stats.hits * (compute - load) if load is not None and compute is not None else None
+            rows.append((saved, stats.hits / lookups if lookups > 0 else 0.0, load, compute, stats, sizes.get(stats.module_function) or 0))
+
+        def format_seconds(seconds):
+            return '-' if seconds is None else f'{seconds:.3f}s'
+
+        print('SAVED\tHIT RATE\tLOAD\tCOMPUTE\tREAD\tWRITTEN\tSIZE\tFUNCTION')
+        for saved, hit_rate, load, compute, stats, size in sorted(rows, key=lambda x: -x[0] if x[0] is not None else float('inf')):
+            warning = '  (slower to load than to compute)' if saved is not None and saved < 0 else ''
+            print(
+                f'{format_seconds(saved)}\t{hit_rate:.0%} of {stats.hits + stats.misses}\t{format_seconds(load)}\t'
+                f'{format_seconds(compute)}\t{stats.bytes_read / 1024**2:.2f}M\t{stats.bytes_written / 1024**2:.2f}M\t'
+                f'{size / 1024**2:.2f}M\t{stats.module_function}{warning}'
+            )
+
+    def serve(self, path=None, host='127.0.0.1', port=8000):
+        from merkl.http_cache import serve
+        serve(path, host, port)
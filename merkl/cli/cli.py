@@ -2,8 +2,6 @@ import os
 import sys
 import logging
 import argparse
-import cProfile, pstats, io
-from pstats import SortKey
 from pathlib import Path
 
 import merkl
@@ -11,9 +9,12 @@ from merkl.cli.init import InitAPI
 from merkl.cli.run import RunAPI
 from merkl.cli.migrate import MigrateAPI
 from merkl.cli.dot import DotAPI
-from merkl.cli.cache import CacheAPI
+from merkl.cli.cache import CacheAPI, parse_size, parse_duration
 from merkl.logger import logger
 
+# Subcommands of `merkl cache`, which defaults to `list` so that `merkl cache [module_function]` keeps working
+CACHE_SUBCOMMANDS = ['list', 'gc', 'repack', 'export', 'import', 'pins', 'stats', 'serve']
+
 
 class MerkLAPI:
     init = InitAPI()
@@ -56,6 +57,9 @@ def main():
     run_parser.set_defaults(command='run', subcommand='run')
     run_parser.add_argument('-n', '--no-cache', action='store_true', help='Disable caching')
     run_parser.add_argument('-c', '--clear', action='store_true', help='Clear cache of any unrelated items before running')
+    run_parser.add_argument('--pin', action='store_true', help='Pin the outputs and their dependencies under the module function name, so that they are not garbage collected')
+    run_parser.add_argument('--gc-max-bytes', type=parse_size, help='Garbage collect the cache down to this size after running, e.g. 10G')
+    run_parser.add_argument('--gc-max-age', type=parse_duration, help='Garbage collect entries not accessed in this long after running, e.g. 7d')
     run_parser.add_argument('module_function', help='Module function to run (<module>.<function>)')
 
     # ------------- DOT --------------
@@ -69,10 +73,51 @@ def main():
 
     # ------------- CACHE --------------
     cache_parser = subparsers.add_parser(
-        'cache', description='Lists or clears cache')
-    cache_parser.set_defaults(command='cache', subcommand='cache')
-    cache_parser.add_argument('-c', '--clear', action='store_true', help='Clears the cache values')
-    cache_parser.add_argument('module_function', nargs='?', default=None, help='Module function to list or clear (<module>.<function>)')
+        'cache', description='Lists, clears or garbage collects the cache')
+    cache_subparsers = cache_parser.add_subparsers()
+
+    cache_list_parser = cache_subparsers.add_parser('list', description='Lists or clears cache')
+    cache_list_parser.set_defaults(command='cache', subcommand='cache')
+    cache_list_parser.add_argument('-c', '--clear', action='store_true', help='Clears the cache values')
+    cache_list_parser.add_argument('module_function', nargs='?', default=None, help='Module function to list or clear (<module>.<function>)')
+
+    cache_gc_parser = cache_subparsers.add_parser(
+        'gc', description='Evicts the least recently used cache entries that are not pinned')
+    cache_gc_parser.set_defaults(command='cache', subcommand='gc')
+    cache_gc_parser.add_argument('--max-bytes', type=parse_size, help='Evict entries until the cache is at most this size, e.g. 10G')
+    cache_gc_parser.add_argument('--max-age', type=parse_duration, help='Evict entries not accessed in this long, e.g. 7d')
+    cache_gc_parser.add_argument('--orphans', action='store_true', help='Remove files left behind in the cache directories, e.g. by a crash')
+    cache_gc_parser.add_argument('-n', '--dry-run', action='store_true', help='Only print what would be evicted')
+
+    cache_repack_parser = cache_subparsers.add_parser(
+        'repack', description='Moves values between inline and file storage, reclaims the space of deleted values and defragments the database')
+    cache_repack_parser.set_defaults(command='cache', subcommand='repack')
+
+    cache_export_parser = cache_subparsers.add_parser(
+        'export', description='Writes the cached outputs of a pipeline and their dependencies to a bundle, which can be imported elsewhere')
+    cache_export_parser.set_defaults(command='cache', subcommand='export')
+    cache_export_parser.add_argument('-o', '--output', required=True, help='Path of the bundle (a tar archive, gzipped if it ends with .gz), or - for stdout')
+    cache_export_parser.add_argument('module_function', help='Module function whose outputs to export (<module>.<function>)')
+
+    cache_import_parser = cache_subparsers.add_parser(
+        'import', description='Loads the entries of a bundle into the cache, skipping entries already in it')
+    cache_import_parser.set_defaults(command='cache', subcommand='import_bundle')
+    cache_import_parser.add_argument('bundle', help='Path of the bundle, or - for stdin')
+
+    cache_pins_parser = cache_subparsers.add_parser('pins', description='Lists or removes pins')
+    cache_pins_parser.set_defaults(command='cache', subcommand='pins')
+    cache_pins_parser.add_argument('--unpin', help='Name to unpin')
+
+    cache_stats_parser = cache_subparsers.add_parser(
+        'stats', description='Shows cache hits, misses and load and compute times per function')
+    cache_stats_parser.set_defaults(command='cache', subcommand='stats')
+
+    cache_serve_parser = cache_subparsers.add_parser(
+        'serve', description='Serves a shared cache over HTTP, for use with HttpCache')
+    cache_serve_parser.set_defaults(command='cache', subcommand='serve')
+    cache_serve_parser.add_argument('--path', help='Directory to store the values in, by default .merkl/fs_cache/')
+    cache_serve_parser.add_argument('--host', default='127.0.0.1', help='Host to listen on')
+    cache_serve_parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
 
     # ------------- MIGRATE --------------
     migrate_parser = subparsers.add_parser(
@@ -82,7 +127,14 @@ def main():
     migrate_parser.add_argument('module_function', help='Module function to migrate (<module>.<function>)')
 
 
-    args, unknown_args = parser.parse_known_args()
+    argv = sys.argv[1:]
+    positional = [i for i, arg in enumerate(argv) if not arg.startswith('-')]
+    if len(positional) > 0 and argv[positional[0]] == 'cache':
+        cache_idx = positional[0]
+        if cache_idx + 1 == len(argv) or argv[cache_idx + 1] not in CACHE_SUBCOMMANDS + ['-h', '--help']:
+            argv.insert(cache_idx + 1, 'list')
+
+    args, unknown_args = parser.parse_known_args(argv)
     kwargs = dict(args._get_kwargs())
 
     # Pop commands that should not go to the route
@@ -108,6 +160,8 @@ def main():
     route = getattr(api_route, args.subcommand)
 
     if profile:
+        import cProfile, pstats, io
+        from pstats import SortKey
         with cProfile.Profile() as pr:
             route(**kwargs)
 
@@ -1,7 +1,6 @@
 import os
-import sqlite3
 
-from merkl.cache import get_db_path, SqliteCache
+from merkl.cache import get_db_path, get_default_cache
 
 class InitAPI:
     def init(self):
@@ -9,4 +8,4 @@ class InitAPI:
             print('Repository .merkl already exists')
             return
 
-        SqliteCache.create_cache()
+        get_default_cache().create_cache()
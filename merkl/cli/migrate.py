@@ -1,5 +1,4 @@
 import functools
-import clize
 
 from merkl.io import migrate_output_files
 from merkl.utils import import_module_function
@@ -17,6 +16,7 @@ def migrate_futures_wrapper(f, glob):
 
 class MigrateAPI:
     def migrate(self, glob, module_function):
+        import clize
         function = import_module_function(module_function)
         function = migrate_futures_wrapper(function, glob)
         clize.run(function, args=['merkl-migrate', *self.unknown_args])
@@ -1,12 +1,10 @@
 import functools
-import clize
 
 from merkl.utils import evaluate_futures, import_module_function
-from merkl.dot import print_dot_graph
 from merkl import cache
 
 
-def evaluate_futures_wrapper(f, no_cache, clear):
+def evaluate_futures_wrapper(f, no_cache, clear, pin_name=None, gc_max_bytes=None, gc_max_age=None):
     @functools.wraps(f)
     def _wrap(*args, **kwargs):
         outs = f(*args, **kwargs)
@@ -17,14 +15,28 @@ def evaluate_futures_wrapper(f, no_cache, clear):
         if clear:
             cache.clear(outs, keep=True)
 
+        if pin_name is not None:
+            cache.pin(pin_name, outs)
+
+        if gc_max_bytes is not None or gc_max_age is not None:
+            cache.get_default_cache().gc(max_bytes=gc_max_bytes, max_age=gc_max_age)
+
         return evaluated_outs
 
     return _wrap
 
 
 class RunAPI:
-    def run(self, module_function, no_cache, clear):
+    def run(self, module_function, no_cache, clear, pin=False, gc_max_bytes=None, gc_max_age=None):
+        import clize
         function = import_module_function(module_function)
         # Function output values may contain Futures, so wrap the function to evaluate them
-        function = evaluate_futures_wrapper(function, no_cache, clear)
+        function = evaluate_futures_wrapper(
+            function,
+            no_cache,
+            clear,
+            module_function if pin else None,
+            gc_max_bytes,
+            gc_max_age,
+        )
         clize.run(function, args=['merkl-run', *self.unknown_args], exit=False)
@@ -0,0 +1,57 @@
+import zlib
+
+CODECS = ['zlib', 'lzma', 'bz2']
+
+# Values smaller than this are stored uncompressed, since the saving isn't worth the time
+MIN_COMPRESS_BYTES = 1024
+
+# With compression='auto', a sample of the value is compressed with a fast setting first, and the value is only
+# compressed if the sample shrinks to at most this ratio of its size
+AUTO_SAMPLE_BYTES = 64 * 1024
+AUTO_MAX_RATIO = 0.8
+
+
+def validate_compression(compression):
+    if compression is not None and compression != 'auto' and compression not in CODECS:
+        raise ValueError(f"Unknown compression '{compression}', expected one of {CODECS}, 'auto' or None")
+
+
+def _codec_functions(codec):
+    if codec == 'zlib':
+        return zlib.compress, zlib.decompress
+    elif codec == 'lzma':
+        import lzma
+        return lzma.compress, lzma.decompress
+    elif codec == 'bz2':
+        import bz2
+        return bz2.compress, bz2.decompress
+    raise ValueError(f"Unknown compression codec '{codec}'")
+
+
+def compress(content_bytes, compression):
+    """ Compresses `content_bytes` according to `compression`, which is a codec in CODECS, 'auto' or None. Returns the
+    codec used, or None if the value is stored uncompressed, and the bytes to store """
+    if compression is None or len(content_bytes) < MIN_COMPRESS_BYTES:
+        return None, content_bytes
+
+    codec = compression
+    if compression == 'auto':
+        sample = content_bytes[:AUTO_SAMPLE_BYTES]
+        if len(zlib.compress(sample, 1)) > len(sample) * AUTO_MAX_RATIO:
+            return None, content_bytes
+        codec = 'zlib'
+
+    compress_fn, _ = _codec_functions(codec)
+    compressed = compress_fn(content_bytes)
+    if len(compressed) >= len(content_bytes):
+        return None, content_bytes
+
+    return codec, compressed
+
+
+def decompress(codec, data):
+    if codec is None:
+        return data
+
+    _, decompress_fn = _codec_functions(codec)
+    return decompress_fn(data)
@@ -16,3 +16,11 @@ class TaskOutsError(Exception):
 
 class EvalError(Exception):
     pass
+
+
+class CacheServerError(OSError):
+    pass
+
+
+class ReadOnlyCacheError(Exception):
+    pass
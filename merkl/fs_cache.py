@@ -0,0 +1,389 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+
+import merkl.cache
+from merkl.cache import BaseCache, get_merkl_path, get_modified_time, map_file
+from merkl.logger import logger, short_hash
+from merkl.compression import compress, decompress
+
+
+class FileSystemCache(BaseCache):
+    """ Cache backend that only uses files, which scales better than SQLite on network file systems with many
+    concurrent writers. Every value is a single file, written to a temporary file and atomically renamed into place, so
+    there is no locking. Files are sharded on the first two bytes of the hash to keep directories small:
+
+        values/ab/cd/<hash>         header line with JSON metadata, followed by the value bytes
+        refs/ab/cd/<hash>[.ext]     FileRef/DirRef outputs
+        files/ab/cd/<path hash>/<modified>   JSON with the md5/merkl hash of a tracked file
+        md5/ab/cd/<md5 hash>        empty marker for `has_file`
+        pins/<name hash>            JSON with the name and the hashes of a pin
+
+    The modified time of a value file is its last access, for `gc`, updated at most every `access_time_resolution`
+    seconds
+    """
+    access_time_resolution = 60.0
+
+    def __init__(self, path=None, compression=None):
+        """ `path` is the root directory of the cache, by default .merkl/fs_cache/ in the current working directory.
+        `compression` is used for tasks that don't set their own, see merkl.compression """
+        self.path = path
+        self.compression = compression
+
+    @property
+    def root(self):
+        if self.path is None:
+            return f'{get_merkl_path()}fs_cache/'
+        return self.path if self.path.endswith('/') else f'{self.path}/'
+
+    def _sharded_path(self, kind, hash, makedirs=False):
+        shard_dir = f'{self.root}{kind}/{hash[:2]}/{hash[2:4]}/'
+        if makedirs:
+            os.makedirs(shard_dir, exist_ok=True)
+        return f'{shard_dir}{hash}'
+
+    def _write_atomic(self, path, *chunks):
+        tmp_dir = f'{self.root}tmp/'
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = f'{tmp_dir}{uuid.uuid4().hex}'
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+
+    def _read_header(self, value_path):
+        with open(value_path, 'rb') as f:
+            return json.loads(f.readline())
+
+    def _iter_value_paths(self):
+        for dir_path, _, file_names in os.walk(f'{self.root}values/'):
+            for file_name in file_names:
+                yield os.path.join(dir_path, file_name)
+
+    def create_cache(self):
+        for kind in ['values', 'refs', 'files', 'md5', 'pins', 'tmp']:
+            os.makedirs(f'{self.root}{kind}/', exist_ok=True)
+
+    def has(self, hash):
+        return os.path.exists(self._sharded_path('values', hash))
+
+    def get(self, hash):
+        stored = self.get_raw(hash)
+        if stored is None:
+            return None
+
+        header, data = stored
+        return decompress(header.get('codec'), data)
+
+    def get_raw(self, hash):
+        """ Returns the header and the value as stored, i.e. possibly compressed, or None """
+        try:
+            with open(self._sharded_path('values', hash), 'rb') as f:
+                self._touch(f)
+                header = json.loads(f.readline())
+                return header, f.read()
+        except FileNotFoundError:
+            return None
+
+    def _touch(self, f):
+        """ Records an access of the open value file `f` in its modified time """
+        now = time.time()
+        if now - os.fstat(f.fileno()).st_mtime > self.access_time_resolution:
+            try:
+                os.utime(f.fileno(), (now, now))
+            except OSError:
+                pass  # e.g. a cache on read-only storage
+
+    def get_buffer(self, hash):
+        value_path = self._sharded_path('values', hash)
+        try:
+            with open(value_path, 'rb') as f:
+                self._touch(f)
+                header = json.loads(f.readline())
+                offset = f.tell()
+        except FileNotFoundError:
+            return None
+
+        if header.get('codec') is not None:
+            return self.get(hash)
+
+        return map_file(value_path, offset)
+
+    def add(self, hash, content_bytes=None, ref=None, fn_name=None, compression=None, format=None):
+        content_len = len(content_bytes)
+        if ref is not None:
+            content_len = os.stat(ref).st_size
+
+        codec, data = compress(content_bytes, compression or self.compression)
+
+        header = {
+            'size': content_len,
+            'ref_path': None if ref is None else str(ref),
+            'ref_is_dir': os.path.isdir(ref) if ref is not None else False,
+            'module_function': fn_name,
+            'codec': codec,
+            'format': format,
+        }
+        self.add_raw(hash, header, data)
+
+    def add_raw(self, hash, header, data):
+        """ Stores `data` as is, with the `header` of the format written by `add` """
+        header_bytes = bytes(json.dumps(header) + '\n', 'utf-8')
+        self._write_atomic(self._sharded_path('values', hash, makedirs=True), header_bytes, data)
+
+    def _remove_value(self, value_path):
+        """ Removes a value file and its ref. Returns the number of bytes freed """
+        try:
+            header = self._read_header(value_path)
+            num_bytes = self._get_size(value_path, header)
+            os.remove(value_path)
+        except FileNotFoundError:
+            return 0  # already cleared, e.g. by another process
+
+        ref_path = header['ref_path']
+        if ref_path is not None:
+            if header['ref_is_dir']:
+                shutil.rmtree(ref_path, ignore_errors=True)
+            elif os.path.exists(ref_path):
+                os.remove(ref_path)
+        return num_bytes
+
+    def _get_size(self, value_path, header):
+        """ Size of a value file and its ref on disk """
+        num_bytes = os.stat(value_path).st_size
+        if header['ref_path'] is not None:
+            try:
+                num_bytes += _get_path_size(header['ref_path'])
+            except FileNotFoundError:
+                pass
+        return num_bytes
+
+    def clear(self, hash):
+        logger.debug(f'Clearing {short_hash(hash)}')
+        self._remove_value(self._sharded_path('values', hash))
+
+    def clear_all_except(self, hashes):
+        hashes = set(hashes)
+        value_paths = [path for path in self._iter_value_paths() if os.path.basename(path) not in hashes]
+        if len(value_paths) > 0:
+            logger.warning(f'Deleting {len(value_paths)} items from cache')
+
+        for value_path in value_paths:
+            self._remove_value(value_path)
+
+    def clear_module_function(self, module_function):
+        for value_path in self._iter_value_paths():
+            try:
+                header = self._read_header(value_path)
+            except FileNotFoundError:
+                continue
+            if header['module_function'] == module_function:
+                self._remove_value(value_path)
+
+    def get_stats(self, module_function=None):
+        stats = {}
+        for value_path in self._iter_value_paths():
+            try:
+                header = self._read_header(value_path)
+            except FileNotFoundError:
+                continue
+            count, size = stats.get(header['module_function'], (0, 0))
+            stats[header['module_function']] = (count + 1, size + header['size'])
+
+        if module_function is not None:
+            return stats.get(module_function, (0, None))
+        return [(module_function, count, size) for module_function, (count, size) in sorted(stats.items(), key=lambda x: (x[0] is not None, x[0] or ''))]
+
+    def get_module_function(self, hash):
+        try:
+            return self._read_header(self._sharded_path('values', hash))['module_function']
+        except FileNotFoundError:
+            return None
+
+    def get_codec(self, hash):
+        try:
+            return self._read_header(self._sharded_path('values', hash)).get('codec')
+        except FileNotFoundError:
+            return None
+
+    def get_format(self, hash):
+        try:
+            return self._read_header(self._sharded_path('values', hash)).get('format')
+        except FileNotFoundError:
+            return None
+
+    def get_ref_file_path(self, hash, ext):
+        path = self._sharded_path('refs', hash, makedirs=True)
+        return path if ext is None else f'{path}.{ext}'
+
+    def get_ref_dir_path(self, hash):
+        return self._sharded_path('refs', hash, makedirs=True) + '/'
+
+    def _file_dir_path(self, path, makedirs=False):
+        path_hash = hashlib.sha256(bytes(path, 'utf-8')).hexdigest()
+        file_dir = self._sharded_path('files', path_hash) + '/'
+        if makedirs:
+            os.makedirs(file_dir, exist_ok=True)
+        return file_dir
+
+    def track_file(self, path, modified=None, merkl_hash=None, md5_hash=None):
+        logger.debug(f'Hashing file {path} modified={modified} merkl_hash={short_hash(merkl_hash)} md5_hash={short_hash(md5_hash)}')
+        modified = modified or get_modified_time(path)
+        record = {'path': path, 'modified': modified, 'merkl_hash': merkl_hash, 'md5_hash': md5_hash}
+        self._write_atomic(f'{self._file_dir_path(path, makedirs=True)}{modified!r}', bytes(json.dumps(record), 'utf-8'))
+        if md5_hash is not None:
+            self._write_atomic(self._sharded_path('md5', md5_hash, makedirs=True))
+
+    def get_file_mod_hash(self, path, modified=None):
+        modified = modified or get_modified_time(path)
+        try:
+            with open(f'{self._file_dir_path(path)}{modified!r}', 'rb') as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None, None
+
+        return record['md5_hash'], record['merkl_hash']
+
+    def get_latest_file(self, path):
+        file_dir = self._file_dir_path(path)
+        try:
+            modified_times = os.listdir(file_dir)
+        except FileNotFoundError:
+            return None, None, None
+
+        # NOTE: untracked modified times (None) sort first
+        modified_times = sorted(modified_times, key=lambda x: float('-inf') if x == 'None' else float(x))
+        if len(modified_times) == 0:
+            return None, None, None
+
+        with open(f'{file_dir}{modified_times[-1]}', 'rb') as f:
+            record = json.load(f)
+
+        return record['md5_hash'], record['merkl_hash'], record['modified']
+
+    def has_file(self, hash):
+        return os.path.exists(self._sharded_path('md5', hash))
+
+    def _pin_path(self, name):
+        return f'{self.root}pins/{hashlib.sha256(bytes(name, "utf-8")).hexdigest()}'
+
+    def _read_pins(self):
+        """ Returns a list of (name, hashes) """
+        pins = []
+        try:
+            file_names = os.listdir(f'{self.root}pins/')
+        except FileNotFoundError:
+            return pins
+
+        for file_name in file_names:
+            try:
+                with open(f'{self.root}pins/{file_name}', 'rb') as f:
+                    pin = json.load(f)
+            except FileNotFoundError:
+                continue
+            pins.append((pin['name'], pin['hashes']))
+        return pins
+
+    def pin(self, name, hashes):
+        os.makedirs(f'{self.root}pins/', exist_ok=True)
+        pin = {'name': name, 'hashes': sorted(set(hashes))}
+        self._write_atomic(self._pin_path(name), bytes(json.dumps(pin), 'utf-8'))
+
+    def unpin(self, name):
+        try:
+            os.remove(self._pin_path(name))
+        except FileNotFoundError:
+            pass
+
+    def get_pins(self):
+        return sorted((name, len(hashes)) for name, hashes in self._read_pins())
+
+    def gc(self, max_bytes=None, max_age=None, dry_run=False):
+        if max_bytes is None and max_age is None:
+            return 0, 0
+
+        pinned = {hash for _, hashes in self._read_pins() for hash in hashes}
+        entries = []
+        total_bytes = 0
+        for value_path in self._iter_value_paths():
+            try:
+                header = self._read_header(value_path)
+                last_access = os.stat(value_path).st_mtime
+                size = self._get_size(value_path, header)
+            except FileNotFoundError:
+                continue
+            total_bytes += size
+            if os.path.basename(value_path) not in pinned:
+                entries.append((last_access, size, value_path))
+
+        now = time.time()
+        num_evicted = 0
+        num_freed = 0
+        for last_access, size, value_path in sorted(entries):
+            is_expired = max_age is not None and last_access < now - max_age
+            if not is_expired and (max_bytes is None or total_bytes - num_freed <= max_bytes):
+                break
+
+            num_evicted += 1
+            num_freed += size if dry_run else self._remove_value(value_path)
+
+        if not dry_run:
+            logger.info(f'Evicted {num_evicted} items ({num_freed} bytes) from cache')
+        return num_evicted, num_freed
+
+    def sweep_orphans(self, dry_run=False):
+        """ Removes the temporary files of interrupted writes, and refs whose value file is gone """
+        min_changed = time.time() - merkl.cache.ORPHAN_MIN_AGE
+        orphans = []
+        for dir_path, _, file_names in os.walk(f'{self.root}tmp/'):
+            orphans += [os.path.join(dir_path, file_name) for file_name in file_names]
+
+        for dir_path, dir_names, file_names in os.walk(f'{self.root}refs/'):
+            # Refs are sharded two levels deep, anything below is the content of a DirRef
+            if dir_path.count('/') - self.root.count('/') < 2:
+                continue
+            orphans += [
+                os.path.join(dir_path, name)
+                for name in dir_names + file_names
+                if not self.has(name.split('.')[0])
+            ]
+            dir_names.clear()
+
+        num_removed = 0
+        num_freed = 0
+        for path in orphans:
+            try:
+                stat = os.stat(path)
+                # NOTE: ctime is updated by renames too, e.g. of a ref moved into the cache before its value is added
+                if max(stat.st_mtime, stat.st_ctime) >= min_changed:
+                    continue
+                size = _get_path_size(path)
+                if not dry_run:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+            except FileNotFoundError:
+                continue
+            num_removed += 1
+            num_freed += size
+
+        return num_removed, num_freed
+
+    def repack(self):
+        """ Values are files of their own, written once, so there is nothing to repack """
+        return 0, 0
+
+
+def _get_path_size(path):
+    """ Size of a file, or of the files in a directory """
+    if not os.path.isdir(path):
+        return os.stat(path).st_size
+    return sum(
+        os.stat(os.path.join(dir_path, file_name)).st_size
+        for dir_path, _, file_names in os.walk(path)
+        for file_name in file_names
+    )
@@ -1,11 +1,15 @@
 import os
+import atexit
 import json
+import time
 import hashlib
+import threading
+import contextvars
+from pickle import PicklingError
 from collections import defaultdict
+from contextlib import nullcontext, ExitStack
 from functools import cached_property, partial
 
-import dill
-
 import merkl.cache
 from merkl.exceptions import *
 from merkl.cache import get_modified_time, MEMORY_CACHE
@@ -31,21 +35,232 @@ def to_bytes_maybe(bytes_or_str):
     return bytes_or_str
 
 
+def _write_chunks(chunks, f):
+    for chunk in chunks:
+        f.write(chunk)
+
+
 def _code_args_serializer_default(obj, fn_name):
+    import dill
     logger.debug(f'Argument of type {type(obj)} for function {fn_name} is not JSON serializable, serializing with dill instead')
     return str(dill.dumps(obj))
 
 
-FUTURE_STATE_EXCLUDED = ['bound_args', '_fn', 'single_fn', 'outs_shared_futures', '_parent_futures', '_val', 'on_completed']
+FUTURE_STATE_EXCLUDED = ['bound_args', '_fn', 'single_fn', 'outs_shared_futures', '_parent_futures', '_val', 'on_completed', '_prefetch']
 
 deps_hash_cache = {}
 
+_NOT_IN_MEMORY = object()
+_NOT_IN_CACHE = object()
+
+# Number of threads that load and deserialize cached values in the background, see `Future.prefetch`. Set to 0 to
+# load values when they are evaluated instead
+PREFETCH_WORKERS = 4
+
+# Whether outputs are serialized with the serializer's `dump` straight into a file of the cache, so that large outputs
+# aren't also held in memory in serialized form. Serializers without `dump` always use `dumps`
+STREAM_SERIALIZATION = True
+
+# Number of threads that serialize, compress and cache the sibling outputs of a multi-out task, see `Future._eval`. Set
+# to 0 to cache them one after another on the calling thread instead
+SIBLING_WRITE_WORKERS = 4
+
+# Whether outputs are cached by a background thread (write-behind), so that evaluation continues with the value in
+# memory instead of waiting for it to be serialized and written. Downstream tasks must not modify the value in place.
+# `wait_for_writes` waits until the values are cached, which `evaluate_futures` (and so `merkl run`) does at the end, as
+# does the end of the process. Tasks can set it with `write_behind`
+WRITE_BEHIND = False
+
+# Number of values waiting to be written behind after which evaluation waits for the writer, which bounds the memory
+# held by values that are no longer needed but not yet written
+WRITE_BEHIND_MAX_PENDING = 16
+
+_prefetch_executor = None
+_prefetch_executor_pid = None
+_prefetch_executor_lock = threading.Lock()
+
+
+def get_prefetch_executor():
+    global _prefetch_executor, _prefetch_executor_pid
+    with _prefetch_executor_lock:
+        # NOTE: the threads of the parent process don't exist in a forked child
+        if _prefetch_executor is None or _prefetch_executor_pid != os.getpid():
+            from concurrent.futures import ThreadPoolExecutor
+            _prefetch_executor = ThreadPoolExecutor(PREFETCH_WORKERS, thread_name_prefix='merkl-prefetch')
+            _prefetch_executor_pid = os.getpid()
+        return _prefetch_executor
+
+
+_sibling_write_executor = None
+_sibling_write_executor_pid = None
+_sibling_write_executor_lock = threading.Lock()
+
+
+def get_sibling_write_executor():
+    global _sibling_write_executor, _sibling_write_executor_pid
+    with _sibling_write_executor_lock:
+        if _sibling_write_executor is None or _sibling_write_executor_pid != os.getpid():
+            from concurrent.futures import ThreadPoolExecutor
+            _sibling_write_executor = ThreadPoolExecutor(SIBLING_WRITE_WORKERS, thread_name_prefix='merkl-sibling-write')
+            _sibling_write_executor_pid = os.getpid()
+        return _sibling_write_executor
+
+
+class _WriteBehindQueue:
+    """ Runs writes on a single background thread, in the order they were submitted, so that e.g. a temporarily cached
+    value is cleared after it was written. Values are kept by hash until written, so that they can be read meanwhile.
+    The values that queue up while the thread is busy are written in one transaction per cache, so that e.g. HttpCache
+    uploads them together """
+
+    def __init__(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='merkl-write-behind')
+        self.slots = threading.BoundedSemaphore(WRITE_BEHIND_MAX_PENDING)
+        self.lock = threading.Lock()
+        self.queued = []  # (write, hash, cache) of the writes that haven't started
+        self.pending = []  # concurrent futures of the writes that haven't been waited for
+        self.values = {}  # hash -> value being written
+
+    def submit(self, write, hash=None, value=None, cache=None):
+        """ Submits `write`, which writes `value` to `cache` if `hash` is set. Writes without a value, like clearing,
+        don't take a slot, since they are also submitted by the writer thread itself """
+        if hash is not None:
+            self.slots.acquire()
+        with self.lock:
+            if hash is not None:
+                self.values[hash] = value
+            self.queued.append((write, hash, cache))
+            self.pending.append(self.executor.submit(self._write_queued))
+
+    def _write_queued(self):
+        """ Does the writes queued so far, or nothing if an earlier call already did them. Consecutive writes of values
+        are batched, and writes without a value are done once the values before them are committed. Raises the error
+        of the first write that failed """
+        with self.lock:
+            queued, self.queued = self.queued, []
+
+        errors = []
+        batch = []
+        for write, hash, cache in queued + [(None, None, None)]:
+            if hash is not None:
+                batch.append((write, hash, cache))
+                continue
+
+            if len(batch) > 0:
+                self._write_batch(batch, errors)
+                batch = []
+            if write is not None:
+                try:
+                    write()
+                except Exception as e:
+                    errors.append(e)
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def _write_batch(self, batch, errors):
+        try:
+            with ExitStack() as stack:
+                for cache in dict.fromkeys(cache for _, _, cache in batch if cache is not None):
+                    stack.enter_context(cache.transaction())
+                for write, _, _ in batch:
+                    try:
+                        write()
+                    except Exception as e:
+                        errors.append(e)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            with self.lock:
+                for _, hash, _ in batch:
+                    self.values.pop(hash, None)
+                    self.slots.release()
+
+    def get(self, hash, default=None):
+        with self.lock:
+            return self.values.get(hash, default)
+
+    def wait(self):
+        """ Waits for the writes, including those submitted while waiting, and raises the error of the first that failed """
+        while True:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if len(pending) == 0:
+                return
+
+            from concurrent.futures import wait
+            wait(pending)
+            for write_future in pending:
+                write_future.result()
+
+
+_write_behind_queue = None
+_write_behind_queue_pid = None
+_write_behind_queue_lock = threading.Lock()
+
+
+def get_write_behind_queue(create=True):
+    """ Returns the queue of this process, or None if there is none and not `create` """
+    global _write_behind_queue, _write_behind_queue_pid
+    with _write_behind_queue_lock:
+        # NOTE: the writer thread of the parent process doesn't exist in a forked child
+        if _write_behind_queue_pid != os.getpid():
+            _write_behind_queue = _WriteBehindQueue() if create else None
+            _write_behind_queue_pid = os.getpid() if create else None
+        return _write_behind_queue
+
+
+def run_after_writes(fn):
+    """ Runs `fn` once the values that are being written behind are cached, or now if there are none """
+    queue = get_write_behind_queue(create=False)
+    if queue is None:
+        fn()
+    else:
+        queue.submit(fn)
+
+
+def wait_for_writes():
+    """ Waits until the outputs written behind (see WRITE_BEHIND) are cached """
+    queue = get_write_behind_queue(create=False)
+    if queue is not None:
+        queue.wait()
+
+
+def _wait_for_writes_at_exit():
+    try:
+        wait_for_writes()
+    except Exception as e:
+        logger.error(f'Caching an output in the background failed: {e!r}')
+
+
+atexit.register(_wait_for_writes_at_exit)
+
+
+def prefetch(futures):
+    """ Prefetches `futures`, see `Future.prefetch`. The values of futures whose cache has a `bulk_get`, e.g. an
+    HttpCache, are fetched with one `get_many` per cache instead of a request each """
+    futures = [future for future in futures if future._should_prefetch()]
+    cache_hashes = {}
+    for future in futures:
+        if future.cache is not None and future.cache.bulk_get and not future.is_input:
+            cache_hashes.setdefault(future.cache, set()).add(future.hash)
+
+    # NOTE: submitted before the futures that wait for them, so they are already running by then
+    fetches = {
+        cache: get_prefetch_executor().submit(cache.get_many, hashes)
+        for cache, hashes in cache_hashes.items() if len(hashes) > 1
+    }
+    for future in futures:
+        future.prefetch(fetches.get(future.cache))
+
+
 class Future:
     __slots__ = [
         '_fn', 'single_fn', 'fn_code_hash', 'outs', 'out_name', 'deps', 'cache', 'serializer', 'bound_args',
         'outs_shared_cache', '_hash', '_deps_args_hash', '_deps_hash', '_args_hash', 'meta', 'is_input', 'output_files', 'is_pipeline',
         'parent_pipeline_future', 'invocation_id', 'task_id', 'batch_idx', 'cache_temporarily', 'outs_shared_futures',
         '_parent_futures', 'cache_in_memory', 'ignore_args', 'on_completed', '_val', '_fn_descriptive_name',
+        'compression', 'transfer', 'auto_cache', 'write_behind', '_prefetch',
     ]
 
     def __init__(
@@ -71,6 +286,10 @@ class Future:
         cache_in_memory=False,
         ignore_args=None,
         single_fn=None,
+        compression=None,
+        transfer=None,
+        auto_cache=None,
+        write_behind=None,
     ):
         self._fn = fn
         self.single_fn = single_fn
@@ -103,10 +322,15 @@ class Future:
         self.cache_temporarily = cache_temporarily
         self.cache_in_memory = cache_in_memory
         self.ignore_args = ignore_args
+        self.compression = compression
+        self.transfer = transfer
+        self.auto_cache = auto_cache
+        self.write_behind = write_behind
         self.outs_shared_futures = None
         self.on_completed = None
         self._parent_futures = None
         self._val = None
+        self._prefetch = None
         self._fn_descriptive_name = None
 
     @property
@@ -138,7 +362,7 @@ class Future:
         m = hashlib.sha256()
         try:
             m.update(bytes(json.dumps(hash_data, sort_keys=True, default=default), 'utf-8'))
-        except (TypeError, dill.PicklingError):
+        except (TypeError, PicklingError):
             raise SerializationError(f'Value in args {hash_data} not JSON or dill-serializable')
         self._deps_hash = m.hexdigest()
         deps_hash_cache[fn_task_key] = self._deps_hash
@@ -165,7 +389,7 @@ class Future:
         m = hashlib.sha256()
         try:
             m.update(bytes(json.dumps(hash_data, sort_keys=True, default=default), 'utf-8'))
-        except (TypeError, dill.PicklingError):
+        except (TypeError, PicklingError):
             raise SerializationError(f'Value in args {hash_data} not JSON or dill-serializable')
         self._args_hash = m.hexdigest()
         return self._args_hash
@@ -237,26 +461,47 @@ class Future:
 
         return self.cache.has(self.hash)
 
-    def get_cache(self):
+    def get_cache(self, fetched=None):
+        """ Returns the deserialized value and, if they can be written to output files as they are, the cached bytes.
+        `fetched` is the cached bytes if they were already fetched, e.g. with `get_many` """
         # First check the in-memory cache
-        if self.cache_in_memory and self.hash in MEMORY_CACHE:
-            val = MEMORY_CACHE[self.hash]
-            # We don't want to store both unserialized and serialized value in the memory cache, so we need to serialize
-            # it if we need the serialized data. We only need this if we have to write it to file
-            serialized = to_bytes_maybe(self.serializer.dumps(val)) if self.output_files is not None and len(self.output_files) > 0 else None
-            return val, serialized
+        if self.cache_in_memory:
+            val = MEMORY_CACHE.get(self.hash, self.serializer, default=_NOT_IN_MEMORY)
+            if val is not _NOT_IN_MEMORY:
+                # We don't want to store both unserialized and serialized value in the memory cache, so we need to
+                # serialize it if we need the serialized data. We only need this if we have to write it to file
+                serialized = to_bytes_maybe(self.serializer.dumps(val)) if self.output_files is not None and len(self.output_files) > 0 else None
+                return val, serialized
 
         if self.cache is None:
             return None, None
 
-        if self.cache.has(self.hash):
-            val = self.cache.get(self.hash)
+        if fetched is not None or self.cache.has(self.hash):
+            start_time = time.perf_counter()
+            if fetched is not None:
+                val = fetched
+            elif getattr(self.serializer, 'accepts_buffers', False):
+                # Avoids copying large values, the serializer reads from e.g. a memory mapped file instead
+                val = self.cache.get_buffer(self.hash)
+            else:
+                val = self.cache.get(self.hash)
             if self.is_input:
                 # reading from source file, not serialized
                 return val, val
 
-            deserialized = log_if_slow(lambda: self.serializer.loads(val), f'Deserializing {self.fn_descriptive_name} out {self.hash} slow')
-            return deserialized, val
+            format = self.cache.get_format(self.hash) if hasattr(self.serializer, 'deserialize') else None
+            if format is None:
+                deserialized = log_if_slow(lambda: self.serializer.loads(val), f'Deserializing {self.fn_descriptive_name} out {self.hash} slow')
+            else:
+                deserialized = log_if_slow(lambda: self.serializer.deserialize(format, val), f'Deserializing {self.fn_descriptive_name} out {self.hash} slow')
+            self.cache.record_stats(
+                self.fn_descriptive_name,
+                hits=1,
+                bytes_read=len(val),
+                load_seconds=time.perf_counter() - start_time,
+            )
+            # NOTE: values cached in a format of their own are serialized with `dumps` for the output files
+            return deserialized, val if format is None else None
 
         # Not in regular cache, so check the output files:
         for output_file, write_merkl_file in self.output_files or []:
@@ -279,8 +524,8 @@ class Future:
     def clear_cache(self, delete_output_files=False):
         self._val = None
 
-        if self.cache_in_memory and self.hash in MEMORY_CACHE:
-            del MEMORY_CACHE[self.hash]
+        if self.cache_in_memory:
+            MEMORY_CACHE.discard(self.hash)
 
         if self.cache is None:
             return
@@ -315,20 +560,15 @@ class Future:
         if self._val is not None:
             return self._val
 
-        if self.in_cache():
-            if isinstance(self.out_name, int):
-                if self.out_name <= 5:
-                    logger.debug(f'{self.fn_descriptive_name}:{self.out_name} ({short_hash(self.hash)}) output was cached')
-                    if self.out_name == 5:
-                        logger.debug(f'And {self.outs - self.out_name} more...')
-
-            specific_out, specific_out_bytes = self.get_cache()
-            self.write_output_files(specific_out, specific_out_bytes)
-        else:
+        prefetched, self._prefetch = self._prefetch, None
+        specific_out = prefetched.result() if prefetched is not None else _NOT_IN_CACHE
+        if specific_out is _NOT_IN_CACHE:
+            # NOTE: check again if prefetched, it may have been cached since, e.g. along with a sibling output
+            specific_out = self._load()
+        if specific_out is _NOT_IN_CACHE:
+            start_time = time.perf_counter()
             specific_out, specific_out_bytes = self._eval()
-
-        if self.cache_in_memory:
-            MEMORY_CACHE[self.hash] = specific_out
+            self._put_in_memory(specific_out, start_time)
 
         self._val = specific_out
 
@@ -337,14 +577,61 @@ class Future:
 
         return specific_out
 
+    def prefetch(self, fetch=None):
+        """ Starts loading the value in the background if it is cached, so that `eval` only has to wait for it to
+        finish. Used for the arguments of a task, which are then loaded in parallel with each other and with computing
+        the arguments that aren't cached. `fetch` is the concurrent future of a `get_many` of the cache that may
+        include the value """
+        if self._should_prefetch():
+            self._prefetch = get_prefetch_executor().submit(self._load, fetch)
+
+    def _should_prefetch(self):
+        if self._val is not None or self._prefetch is not None or PREFETCH_WORKERS == 0:
+            return False
+        return not (self.cache_in_memory and MEMORY_CACHE.is_loaded(self.hash))
+
+    def _load(self, fetch=None):
+        """ Returns the value from the cache, or _NOT_IN_CACHE. Runs on a prefetch thread if prefetched """
+        start_time = time.perf_counter()
+        queue = get_write_behind_queue(create=False)
+        if queue is not None:
+            # Computed by another future with the same hash, and not yet cached
+            specific_out = queue.get(self.hash, _NOT_IN_CACHE)
+            if specific_out is not _NOT_IN_CACHE:
+                return specific_out
+
+        # NOTE: popped, so that the fetched bytes are freed once deserialized
+        fetched = fetch.result().pop(self.hash, None) if fetch is not None else None
+        if fetched is None and not self.in_cache():
+            return _NOT_IN_CACHE
+
+        if isinstance(self.out_name, int):
+            if self.out_name <= 5:
+                logger.debug(f'{self.fn_descriptive_name}:{self.out_name} ({short_hash(self.hash)}) output was cached')
+                if self.out_name == 5:
+                    logger.debug(f'And {self.outs - self.out_name} more...')
+
+        specific_out, specific_out_bytes = self.get_cache(fetched)
+        self.write_output_files(specific_out, specific_out_bytes)
+        self._put_in_memory(specific_out, start_time)
+        return specific_out
+
+    def _put_in_memory(self, specific_out, start_time):
+        if self.cache_in_memory and not MEMORY_CACHE.is_loaded(self.hash):
+            # The time it took to compute or load the value is the cost of evicting it
+            MEMORY_CACHE.put(self.hash, specific_out, cost=time.perf_counter() - start_time, serializer=self.serializer)
+
     def _eval(self):
         specific_out = None
         specific_out_is_ref = False
         outputs = None
         called_function = False
+        compute_seconds = 0.0
         if self.deps_args_hash and self.deps_args_hash in self.outs_shared_cache:
             outputs = self.outs_shared_cache.get(self.deps_args_hash)
         else:
+            if self.bound_args:
+                prefetch(self.parent_futures)
             evaluated_args = nested_map(self.bound_args.args, map_future_to_value) if self.bound_args else []
             evaluated_kwargs = nested_map(self.bound_args.kwargs, map_future_to_value) if self.bound_args else {}
             logger.debug(f'Calling {self.fn_descriptive_name} (out_name={self.out_name})')
@@ -353,23 +640,13 @@ class Future:
             # In case an Eval manager was used, we need to reset it so that any calls inside `fn` are not also
             # evaled immediately
             with Eval(False):
+                start_time = time.perf_counter()
                 outputs = self._fn(*evaluated_args, **evaluated_kwargs)
+                compute_seconds = time.perf_counter() - start_time
 
             if self.deps_args_hash:
                 self.outs_shared_cache[self.deps_args_hash] = outputs
 
-                if self.cache:
-                    self.cache.no_commit = True  # for efficiency, commit only after all futures have been cached
-
-                for future in self.outs_shared_futures or []:
-                    if future.hash == self.hash:
-                        continue
-                    future._eval()
-
-                if self.cache:
-                    self.cache.no_commit = False
-                    self.cache.commit()
-
         if isinstance(outputs, tuple) and len(outputs) != self.outs and self.outs != 1:
             raise TaskOutsError(f'Wrong number of outputs: {len(outputs)}. Expected {self.outs}')
         elif isinstance(outputs, dict) and self.outs != 1:
@@ -394,7 +671,7 @@ class Future:
 
         if self.cache is not None:
             if isinstance(specific_out, FileRef) or isinstance(specific_out, DirRef):
-                specific_out = self.cache.transfer_ref(specific_out, self.hash)
+                specific_out = self.cache.transfer_ref(specific_out, self.hash, self.transfer)
                 specific_out_is_ref = True
 
         if self.is_pipeline:
@@ -403,30 +680,129 @@ class Future:
                 future.parent_pipeline_future = self
 
         specific_out_bytes = None
-        if not self.is_input:  # Futures from io should not be cached (but is read from cache)
-            if self.cache is not None:
-                specific_out_bytes = to_bytes_maybe(self.serializer.dumps(specific_out))
+        # For efficiency, the outputs of a function call are all cached and committed in a single transaction
+        with self.cache.transaction() if called_function and self.cache else nullcontext():
+            if not self.is_input:  # Futures from io should not be cached (but is read from cache)
+                if self.writes_behind(specific_out_is_ref):
+                    def write():
+                        with self.cache.transaction():
+                            self._persist(specific_out, False, called_function, compute_seconds)
+
+                    logger.debug(f'Caching {self.fn_descriptive_name} {short_hash(self.hash)} in the background')
+                    get_write_behind_queue().submit(write, self.hash, specific_out, self.cache)
+                else:
+                    specific_out_bytes = self._persist(specific_out, specific_out_is_ref, called_function, compute_seconds)
+
+            if called_function and self.deps_args_hash:
+                # Cache sibling outputs too, in case they are never evaluated, e.g. if the program crashes
+                siblings = [future for future in self.outs_shared_futures or [] if future.hash != self.hash]
+                self._eval_siblings(siblings)
+
+        return specific_out, specific_out_bytes
 
-                if not self.cache.has(self.hash):  # gotta check again
-                    with DelayedKeyboardInterrupt():
-                        # Cache needs to be fully done, otherwise we might have added data to sqlite but not file
-                        ref = (specific_out if specific_out_is_ref else None)
-                        logger.debug(f'Caching {self.fn_descriptive_name} {short_hash(self.hash)} ref={ref}, len(content_bytes)={len(specific_out_bytes)}')
+    def _persist(self, specific_out, specific_out_is_ref, called_function, compute_seconds):
+        """ Caches the output and writes the output files, and returns the serialized output if it was serialized """
+        specific_out_bytes = None
+        if self.cache is not None:
+            bytes_written = 0
+            is_written = False
+            if not self.cache.has(self.hash) and (specific_out_is_ref or self.is_worth_caching()):  # gotta check again
+                is_written = True
+                with DelayedKeyboardInterrupt():
+                    # Cache needs to be fully done, otherwise we might have added data to sqlite but not file
+                    ref = (specific_out if specific_out_is_ref else None)
+                    format = None
+                    if hasattr(self.serializer, 'serialize'):
+                        # The serializer picks a format for the value, which the cache records
+                        format, chunks = self.serializer.serialize(specific_out)
+
+                    if self.streams_to_cache and ref is None:
+                        logger.debug(f'Caching {self.fn_descriptive_name} {short_hash(self.hash)} streamed')
+                        bytes_written = self.cache.add_stream(
+                            self.hash,
+                            partial(self.serializer.dump, specific_out) if format is None else partial(_write_chunks, chunks),
+                            fn_name=self.fn_descriptive_name,
+                            compression=self.compression,
+                            format=format,
+                        )
+                    else:
+                        if format is None:
+                            content_bytes = specific_out_bytes = to_bytes_maybe(self.serializer.dumps(specific_out))
+                        else:
+                            # NOTE: output files are written with `dumps`, not in the format of the cache
+                            content_bytes = b''.join(chunks)
+                        logger.debug(f'Caching {self.fn_descriptive_name} {short_hash(self.hash)} ref={ref}, len(content_bytes)={len(content_bytes)}')
                         self.cache.add(
                             self.hash,
-                            specific_out_bytes,
+                            content_bytes,
                             ref=ref,
                             fn_name=self.fn_descriptive_name,
+                            compression=self.compression,
+                            format=format,
                         )
+                        bytes_written = len(content_bytes)
+
+            # Misses count function calls, which the sibling outputs share, and so do writes
+            self.cache.record_stats(
+                self.fn_descriptive_name,
+                misses=int(called_function),
+                bytes_written=bytes_written,
+                compute_seconds=compute_seconds,
+                writes=int(called_function and is_written),
+            )
 
-                if called_function:  # Make sure we only clear parent futures once for all the output futures
-                    for parent_future in self.parent_futures:
-                        if parent_future.cache_temporarily:
-                            parent_future.clear_cache()
+            if called_function:  # Make sure we only clear parent futures once for all the output futures
+                for parent_future in self.parent_futures:
+                    if parent_future.cache_temporarily:
+                        # NOTE: the parent may still be written behind
+                        run_after_writes(parent_future.clear_cache)
+
+        self.write_output_files(specific_out, specific_out_bytes)
+        return specific_out_bytes
+
+    def writes_behind(self, specific_out_is_ref):
+        """ Whether the output is cached in the background, see WRITE_BEHIND. FileRef/DirRef outputs are moved into the
+        cache right away, and the outputs of pipelines, which are futures, are small """
+        write_behind = self.write_behind if self.write_behind is not None else WRITE_BEHIND
+        return write_behind and self.cache is not None and not specific_out_is_ref and not self.is_pipeline
+
+    def _eval_siblings(self, siblings):
+        """ Caches the `siblings` in parallel on the sibling write threads, which run in a copy of the current context
+        so that their writes join the transaction of this call, and returns once all of them are done """
+        if SIBLING_WRITE_WORKERS == 0 or len(siblings) < 2:
+            for future in siblings:
+                future._eval()
+            return
 
-            self.write_output_files(specific_out, specific_out_bytes)
+        from concurrent.futures import wait
+        executor = get_sibling_write_executor()
+        # NOTE: each run needs its own copy, a context can't be entered by two threads at once
+        sibling_futures = [executor.submit(contextvars.copy_context().run, future._eval) for future in siblings]
+        with DelayedKeyboardInterrupt():
+            # The transaction must not exit while the threads still add to it
+            wait(sibling_futures)
+        for sibling_future in sibling_futures:
+            sibling_future.result()
+
+    def is_worth_caching(self):
+        """ Whether the output should be persisted, which with `auto_cache` depends on the TaskStats of the function,
+        see merkl.cache.AUTO_CACHE. Outputs that aren't persisted are kept by the future, and computed again next time """
+        auto_cache = self.auto_cache if self.auto_cache is not None else merkl.cache.AUTO_CACHE
+        if not auto_cache or self.is_pipeline:
+            return True
 
-        return specific_out, specific_out_bytes
+        stats = merkl.cache.get_task_stats_snapshot(self.cache).get(self.fn_descriptive_name)
+        if merkl.cache.is_worth_caching(stats):
+            return True
+
+        logger.debug(f'Not caching {self.fn_descriptive_name} {short_hash(self.hash)}, it is faster to compute than to load')
+        return False
+
+    @property
+    def streams_to_cache(self):
+        """ Whether the output is serialized with the serializer's `dump` straight into the cache, instead of into
+        memory with `dumps`. Not done if the output is written to files, which need the serialized bytes anyway """
+        return STREAM_SERIALIZATION and hasattr(self.serializer, 'dump') and not self.output_files
 
     @property
     def fn_descriptive_name(self):
@@ -454,6 +830,10 @@ class Future:
         return state
 
     def __setstate__(self, d):
+        # Futures pickled by older versions may lack some attributes
+        for key in self.__slots__:
+            setattr(self, key, None)
+
         for key, val in d.items():
             setattr(self, key, val)
 
@@ -498,6 +878,7 @@ class Future:
             else:
                 return None
 
+        import dill
         with open(path + '.merkl', 'rb') as f:
             future = dill.load(f)
             if replace_output_files:
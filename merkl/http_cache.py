@@ -0,0 +1,531 @@
+import os
+import re
+import json
+import time
+import threading
+import contextvars
+import http.client
+import urllib.parse
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from merkl.cache import BaseCache, get_default_cache
+from merkl.logger import logger, short_hash
+from merkl.compression import compress, decompress
+from merkl.exceptions import CacheServerError
+
+# Number of hashes per `POST /has` request, and per `POST /get` request, whose responses hold the values. Larger lists
+# are split and sent in parallel
+BULK_CHUNK_SIZE = 1000
+BULK_GET_CHUNK_SIZE = 100
+
+# Number of answers of the server about which hashes are stored that an HttpCache keeps, see `has_ttl`. Answers older
+# than `has_ttl` are dropped as others are added, and the oldest ones once there are more than this
+HAS_RESULTS_MAX_ENTRIES = 100000
+
+_HASH_RE = re.compile('[0-9a-f]+')
+
+# The values added in the open `HttpCache.transaction()`s by server URL, along with the pid: (pid, {url: {hash: ...}}).
+# Like the `_pending_writes` of SqliteCache, it's a context variable, so that threads running in a copy of the context,
+# like the workers that write the sibling outputs of a task, add their values to the transaction that started them
+_pending_uploads = contextvars.ContextVar('merkl_pending_uploads', default=None)
+
+
+class _ConnectionPool:
+    """ Persistent HTTP/1.1 connections to one host, at most `max_connections` at a time """
+
+    def __init__(self, url, max_connections, timeout):
+        parsed = urllib.parse.urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = parsed.netloc
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(max_connections)
+
+    @contextmanager
+    def connection(self, new=False):
+        """ Yields an idle connection, or a new one if there is none or `new` is set, and whether it's new. Connections
+        are only returned to the pool if the block doesn't raise """
+        with self._semaphore:
+            connection = None
+            if not new:
+                with self._lock:
+                    connection = self._idle.pop() if len(self._idle) > 0 else None
+            is_new = connection is None
+            if is_new:
+                connection = self.connection_class(self.netloc, timeout=self.timeout)
+
+            try:
+                yield connection, is_new
+            except:
+                connection.close()
+                raise
+
+            with self._lock:
+                self._idle.append(connection)
+
+    def close(self):
+        with self._lock:
+            for connection in self._idle:
+                connection.close()
+            self._idle = []
+
+
+class HttpCache(BaseCache):
+    """ Cache backend for a shared cache server, e.g. the reference server of `merkl cache serve`. Values are stored
+    and fetched per hash over persistent pooled connections:
+
+        HEAD   /values/<hash>      200 or 404, with the X-Merkl-Module-Function, X-Merkl-Codec and X-Merkl-Format
+                                   headers
+        GET    /values/<hash>      the value as stored, with the X-Merkl-Codec header
+        PUT    /values/<hash>      the value, compressed by the client, with X-Merkl-Codec, X-Merkl-Size,
+                                   X-Merkl-Module-Function and X-Merkl-Format headers
+        DELETE /values/<hash>
+        POST   /has                JSON list of hashes -> JSON list of those that are stored
+        POST   /get                JSON list of hashes -> for each stored value, a JSON header line with the hash,
+                                   length, codec, format and module function, followed by the value as stored
+        POST   /clear_all_except   JSON list of hashes
+        POST   /clear_module_function   JSON string
+        GET    /stats              JSON list of [module_function, count, size]
+
+    The bulk endpoints let `has_many` and `get_many` avoid a round trip per hash, and their answers are used by `has`
+    (and the metadata of values by e.g. `get_format`) for `has_ttl` seconds. Values added in a `transaction()` are
+    uploaded in parallel when it exits.
+
+    FileRef/DirRef outputs can't be shared this way, since their values are local paths, so this backend is meant as
+    the shared tier of a TieredCache, which keeps them in the local tier. Tracked files are also local, and are
+    delegated to the default cache """
+
+    bulk_get = True
+
+    def __init__(self, url, compression=None, max_connections=8, timeout=60, has_ttl=60):
+        self.url = url.rstrip('/')
+        self.compression = compression
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.has_ttl = has_ttl
+        self._init_state()
+
+    def _init_state(self):
+        self._pid = os.getpid()
+        self._pool = None
+        self._executor = None
+        self._lock = threading.Lock()
+        # hash -> (is stored, time, (module function, codec, format) or None if unknown), oldest first
+        self._has_results = OrderedDict()
+
+    def __getstate__(self):
+        return {
+            'url': self.url,
+            'compression': self.compression,
+            'max_connections': self.max_connections,
+            'timeout': self.timeout,
+            'has_ttl': self.has_ttl,
+        }
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._init_state()
+
+    @property
+    def pool(self):
+        if self._pid != os.getpid():
+            self._init_state()  # connections can't be shared with the parent process
+        with self._lock:
+            if self._pool is None:
+                self._pool = _ConnectionPool(self.url, self.max_connections, self.timeout)
+            return self._pool
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_connections, thread_name_prefix='merkl-http-cache')
+            return self._executor
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _request(self, method, path, body=None, headers=None):
+        """ Returns the status, headers and body of the response. 404 is returned, other errors are raised """
+        path = urllib.parse.urlsplit(self.url).path + path
+        new = False
+        while True:
+            is_new = True
+            try:
+                with self.pool.connection(new) as (connection, is_new):
+                    connection.request(method, path, body=body, headers=headers or {})
+                    response = connection.getresponse()
+                    data = response.read()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                # The pool drops the failed connection. A reused one may have been closed by the server while idle, so
+                # retry once on a new connection
+                if not is_new:
+                    new = True
+                    continue
+                raise CacheServerError(f'{method} {self.url}{path} failed: {e!r}') from e
+
+        if response.status >= 400 and response.status != 404:
+            raise CacheServerError(f'{method} {self.url}{path} failed: {response.status} {data[:200]!r}')
+        return response.status, response.headers, data
+
+    def _post_json(self, path, val):
+        return self._request('POST', path, bytes(json.dumps(val), 'utf-8'), {'Content-Type': 'application/json'})
+
+    def _set_has(self, hashes, is_stored, metadata=None):
+        now = time.time()
+        with self._lock:
+            for hash in hashes:
+                self._has_results[hash] = (is_stored, now, (metadata or {}).get(hash))
+                self._has_results.move_to_end(hash)
+
+            while len(self._has_results) > 0:
+                _, checked, _ = next(iter(self._has_results.values()))
+                if len(self._has_results) <= HAS_RESULTS_MAX_ENTRIES and now - checked < self.has_ttl:
+                    break
+                self._has_results.popitem(last=False)
+
+    def _get_metadata(self, hash):
+        """ Returns whether `hash` is stored, and its module function, codec and format, from a HEAD request or from
+        an earlier answer of at most `has_ttl` seconds ago """
+        with self._lock:
+            is_stored, checked, metadata = self._has_results.get(hash, (None, 0, None))
+        if time.time() - checked < self.has_ttl and (metadata is not None or is_stored is False):
+            return is_stored, metadata
+
+        status, headers, _ = self._request('HEAD', f'/values/{hash}')
+        if status == 404:
+            self._set_has([hash], False)
+            return False, None
+
+        metadata = tuple(headers.get(f'X-Merkl-{key}') or None for key in ['Module-Function', 'Codec', 'Format'])
+        self._set_has([hash], True, {hash: metadata})
+        return True, metadata
+
+    def _pending(self):
+        pid_pendings = _pending_uploads.get()
+        if pid_pendings is None or pid_pendings[0] != os.getpid():
+            return None
+        return pid_pendings[1].get(self.url)
+
+    @contextmanager
+    def transaction(self):
+        """ Values added in the scope, also by threads running in a copy of the current context, are uploaded in
+        parallel when the outermost scope exits. The threads must be done before it exits """
+        pid_pendings = _pending_uploads.get()
+        token = None
+        if pid_pendings is None or pid_pendings[0] != os.getpid():
+            pid_pendings = (os.getpid(), {})
+            token = _pending_uploads.set(pid_pendings)
+
+        pendings = pid_pendings[1]
+        pending = pendings.get(self.url)
+        is_outermost = pending is None
+        if is_outermost:
+            pending = pendings[self.url] = {}
+
+        try:
+            yield
+        finally:
+            if is_outermost:
+                del pendings[self.url]
+            if token is not None:
+                _pending_uploads.reset(token)
+
+        if is_outermost and len(pending) > 0:
+            self._upload(pending)
+
+    def _upload(self, pending):
+        list(self.executor.map(lambda item: self._put(item[0], *item[1]), pending.items()))
+
+    def has(self, hash):
+        pending = self._pending()
+        if pending is not None and hash in pending:
+            return True
+
+        with self._lock:
+            is_stored, checked, _ = self._has_results.get(hash, (None, 0, None))
+        if time.time() - checked < self.has_ttl:
+            return is_stored
+
+        return self._get_metadata(hash)[0]
+
+    def has_many(self, hashes):
+        hashes = list(hashes)
+        chunks = [hashes[i:i + BULK_CHUNK_SIZE] for i in range(0, len(hashes), BULK_CHUNK_SIZE)]
+
+        def has_chunk(chunk):
+            _, _, data = self._post_json('/has', chunk)
+            return json.loads(data)
+
+        present = {hash for stored in self.executor.map(has_chunk, chunks) for hash in stored}
+        self._set_has(present, True)
+        self._set_has(set(hashes) - present, False)
+
+        pending = self._pending()
+        if pending is not None:
+            present |= {hash for hash in hashes if hash in pending}
+        return present
+
+    def get(self, hash):
+        pending = self._pending()
+        if pending is not None and hash in pending:
+            return pending[hash][0]
+
+        status, headers, data = self._request('GET', f'/values/{hash}')
+        if status == 404:
+            return None
+        return decompress(headers.get('X-Merkl-Codec') or None, data)
+
+    def get_many(self, hashes):
+        hashes = list(hashes)
+        values = {}
+        pending = self._pending()
+        if pending is not None:
+            values = {hash: pending[hash][0] for hash in hashes if hash in pending}
+            hashes = [hash for hash in hashes if hash not in pending]
+        chunks = [hashes[i:i + BULK_GET_CHUNK_SIZE] for i in range(0, len(hashes), BULK_GET_CHUNK_SIZE)]
+
+        def get_chunk(chunk):
+            _, _, data = self._post_json('/get', chunk)
+            chunk_values, metadata = {}, {}
+            view = memoryview(data)
+            offset = 0
+            while offset < len(data):
+                line_end = data.index(b'\n', offset)
+                header = json.loads(data[offset:line_end])
+                offset = line_end + 1 + header['length']
+                chunk_values[header['hash']] = decompress(header['codec'], view[line_end + 1:offset].tobytes())
+                metadata[header['hash']] = (header['module_function'], header['codec'], header['format'])
+            self._set_has(chunk_values.keys(), True, metadata)
+            self._set_has(set(chunk) - chunk_values.keys(), False)
+            return chunk_values
+
+        for chunk_values in self.executor.map(get_chunk, chunks):
+            values.update(chunk_values)
+        return values
+
+    def add(self, hash, content_bytes=None, ref=None, fn_name=None, compression=None, format=None):
+        if ref is not None:
+            raise ValueError('HttpCache can not store FileRef/DirRef outputs, use it as a tier of a TieredCache')
+
+        pending = self._pending()
+        if pending is not None:
+            pending[hash] = (content_bytes, fn_name, compression or self.compression, format)
+        else:
+            self._put(hash, content_bytes, fn_name, compression, format)
+
+    def _put(self, hash, content_bytes, fn_name, compression, format):
+        logger.debug(f'Uploading {short_hash(hash)} to {self.url}')
+        codec, data = compress(content_bytes, compression or self.compression)
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'X-Merkl-Codec': codec or '',
+            'X-Merkl-Size': str(len(content_bytes)),
+            'X-Merkl-Module-Function': fn_name or '',
+            'X-Merkl-Format': format or '',
+        }
+        self._request('PUT', f'/values/{hash}', data, headers)
+        self._set_has([hash], True, {hash: (fn_name, codec, format)})
+
+    def clear(self, hash):
+        logger.debug(f'Clearing {short_hash(hash)}')
+        self._request('DELETE', f'/values/{hash}')
+        self._set_has([hash], False)
+
+    def clear_all_except(self, hashes):
+        self._post_json('/clear_all_except', list(hashes))
+        with self._lock:
+            self._has_results = OrderedDict()
+
+    def clear_module_function(self, module_function):
+        self._post_json('/clear_module_function', module_function)
+        with self._lock:
+            self._has_results = OrderedDict()
+
+    def get_stats(self, module_function=None):
+        _, _, data = self._request('GET', '/stats')
+        stats = [tuple(row) for row in json.loads(data)]
+        if module_function is not None:
+            return next(((count, size) for fn_name, count, size in stats if fn_name == module_function), (0, None))
+        return stats
+
+    def get_module_function(self, hash):
+        _, metadata = self._get_metadata(hash)
+        return metadata and metadata[0]
+
+    def get_codec(self, hash):
+        _, metadata = self._get_metadata(hash)
+        return metadata and metadata[1]
+
+    def get_format(self, hash):
+        pending = self._pending()
+        if pending is not None and hash in pending:
+            return pending[hash][3]
+
+        _, metadata = self._get_metadata(hash)
+        return metadata and metadata[2]
+
+    def transfer_ref(self, ref, hash, transfer=None):
+        raise ValueError('HttpCache can not store FileRef/DirRef outputs, use it as a tier of a TieredCache')
+
+    def track_file(self, path, modified=None, merkl_hash=None, md5_hash=None):
+        get_default_cache().track_file(path, modified, merkl_hash, md5_hash)
+
+    def get_file_mod_hash(self, path, modified=None):
+        return get_default_cache().get_file_mod_hash(path, modified)
+
+    def get_latest_file(self, path):
+        return get_default_cache().get_latest_file(path)
+
+    def has_file(self, hash):
+        return get_default_cache().has_file(hash)
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    """ Reference implementation of the HttpCache protocol, storing values in a FileSystemCache """
+    protocol_version = 'HTTP/1.1'  # keep connections alive
+    cache = None
+
+    def log_message(self, format, *args):
+        logger.debug(f'{self.address_string()} {format % args}')
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _read_json(self):
+        return json.loads(self._read_body())
+
+    def _value_hash(self):
+        match = re.fullmatch('/values/([0-9a-f]+)', self.path)
+        if match is None:
+            self._send(404)
+            return None
+        return match.group(1)
+
+    def do_HEAD(self):
+        hash = self._value_hash()
+        if hash is None:
+            return
+
+        if not self.cache.has(hash):
+            self._send(404)
+            return
+        self._send(200, headers={
+            'X-Merkl-Module-Function': self.cache.get_module_function(hash) or '',
+            'X-Merkl-Codec': self.cache.get_codec(hash) or '',
+            'X-Merkl-Format': self.cache.get_format(hash) or '',
+        })
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send(200, bytes(json.dumps(self.cache.get_stats()), 'utf-8'), {'Content-Type': 'application/json'})
+            return
+
+        hash = self._value_hash()
+        if hash is None:
+            return
+
+        stored = self.cache.get_raw(hash)
+        if stored is None:
+            self._send(404)
+            return
+
+        header, data = stored
+        self._send(200, data, {'Content-Type': 'application/octet-stream', 'X-Merkl-Codec': header.get('codec') or ''})
+
+    def do_PUT(self):
+        hash = self._value_hash()
+        if hash is None:
+            return
+
+        data = self._read_body()
+        header = {
+            'size': int(self.headers.get('X-Merkl-Size', len(data))),
+            'ref_path': None,
+            'ref_is_dir': False,
+            'module_function': self.headers.get('X-Merkl-Module-Function') or None,
+            'codec': self.headers.get('X-Merkl-Codec') or None,
+            'format': self.headers.get('X-Merkl-Format') or None,
+        }
+        self.cache.add_raw(hash, header, data)
+        self._send(201)
+
+    def do_DELETE(self):
+        hash = self._value_hash()
+        if hash is None:
+            return
+
+        self.cache.clear(hash)
+        self._send(204)
+
+    def do_POST(self):
+        if self.path == '/has':
+            hashes = [hash for hash in self._read_json() if _HASH_RE.fullmatch(hash) and self.cache.has(hash)]
+            self._send(200, bytes(json.dumps(hashes), 'utf-8'), {'Content-Type': 'application/json'})
+        elif self.path == '/get':
+            chunks = []
+            for hash in self._read_json():
+                stored = self.cache.get_raw(hash) if _HASH_RE.fullmatch(hash) else None
+                if stored is None:
+                    continue
+                header, data = stored
+                chunks.append(bytes(json.dumps({
+                    'hash': hash,
+                    'length': len(data),
+                    'codec': header.get('codec'),
+                    'format': header.get('format'),
+                    'module_function': header.get('module_function'),
+                }) + '\n', 'utf-8'))
+                chunks.append(data)
+            self._send(200, b''.join(chunks), {'Content-Type': 'application/octet-stream'})
+        elif self.path == '/clear_all_except':
+            self.cache.clear_all_except(self._read_json())
+            self._send(204)
+        elif self.path == '/clear_module_function':
+            self.cache.clear_module_function(self._read_json())
+            self._send(204)
+        else:
+            self._read_body()
+            self._send(404)
+
+
+def make_server(path=None, host='127.0.0.1', port=8000):
+    """ Returns a threaded HTTP server for the HttpCache protocol, storing values in a FileSystemCache at `path` """
+    from merkl.fs_cache import FileSystemCache
+    cache = FileSystemCache(path)
+    cache.create_cache()
+    handler = type('CacheRequestHandler', (CacheRequestHandler,), {'cache': cache})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(path=None, host='127.0.0.1', port=8000):
+    server = make_server(path, host, port)
+    print(f'Serving cache in {server.RequestHandlerClass.cache.root} on http://{host}:{server.server_port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
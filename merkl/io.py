@@ -1,7 +1,6 @@
 import os
 import uuid
 import json
-import dill
 import glob
 import shutil
 import hashlib
@@ -15,6 +14,7 @@ import merkl
 from merkl.utils import get_hash_memory_optimized, nested_collect, collect_dag_futures
 from merkl.exceptions import SerializationError
 from merkl.logger import logger
+from merkl.transfer import transfer_file, transfer_dir
 
 
 cwd = ''
@@ -61,7 +61,8 @@ def write_future(future, path, write_merkl_file=False):
     return future
 
 
-def fetch_or_compute_md5(path, cache=merkl.cache.SqliteCache, store=True):
+def fetch_or_compute_md5(path, cache=None, store=True):
+    cache = cache or merkl.cache.get_default_cache()
     if not os.path.exists(path):
         raise FileNotFoundError(path)
 
@@ -75,7 +76,7 @@ def fetch_or_compute_md5(path, cache=merkl.cache.SqliteCache, store=True):
     return md5_hash
 
 
-def fetch_or_compute_dir_md5(files, cache=merkl.cache.SqliteCache, store=True):
+def fetch_or_compute_dir_md5(files, cache=None, store=True):
     h = hashlib.new('md5')
     for file_path in files:
         file_md5 = fetch_or_compute_dir_md5(file_path, cache, store)
@@ -85,6 +86,7 @@ def fetch_or_compute_dir_md5(files, cache=merkl.cache.SqliteCache, store=True):
 
 
 def _write_merkl_file(path, future):
+    import dill
     with open(path + '.merkl', 'wb') as f:
         dill.dump(future, f)
 
@@ -93,6 +95,7 @@ def get_merkl_file_hash(path):
     if not os.path.exists(path + '.merkl'):
         return None
 
+    import dill
     try:
         with open(path + '.merkl', 'rb') as f:
             return dill.load(f).hash
@@ -100,12 +103,13 @@ def get_merkl_file_hash(path):
         raise TypeError(f'Unable to deserialize .merkl file: {path}.merkl')
 
 
-def write_track_file(path, content_bytes, future, cache=merkl.cache.SqliteCache, write_merkl_file=False):
+def write_track_file(path, content_bytes, future, cache=None, write_merkl_file=False):
+    cache = cache or merkl.cache.get_default_cache()
     logger.debug(f'Writing to path: {path}')
     if isinstance(content_bytes, FileRef):
-        shutil.copy(content_bytes, path)
+        transfer_file(content_bytes, path, future.transfer)
     elif isinstance(content_bytes, DirRef):
-        shutil.copytree(content_bytes, path)
+        transfer_dir(content_bytes, path, future.transfer)
     else:
         with open(path, 'wb') as f:
             f.write(content_bytes)
@@ -119,6 +123,7 @@ def write_track_file(path, content_bytes, future, cache=merkl.cache.SqliteCache,
 
 def migrate_output_files(outs, files_glob=None):
     """ Migrates the .merkl file hash to the new one, if .merkl file exists for output file """
+    import dill
     futures = nested_collect(outs, lambda x: isinstance(x, merkl.future.Future))
 
     dag_futures = set()
@@ -269,6 +274,20 @@ class IdentitySerializer:
         return val
 
 
+class BufferSerializer:
+    """ Like IdentitySerializer for bytes-like values, but loads cached values as read-only memoryviews, which for
+    large values are memory mapped from the cache file rather than read into memory """
+    accepts_buffers = True
+
+    @classmethod
+    def dumps(cls, val):
+        return val
+
+    @classmethod
+    def loads(cls, val):
+        return memoryview(val)
+
+
 class WrappedSerializer:
     """ A way to wrap another serializer, for supplying args to it when dumping """
 
@@ -277,6 +296,10 @@ class WrappedSerializer:
         self.dump_args = dump_args
         self.dump_kwargs = dump_kwargs
 
+    @property
+    def accepts_buffers(self):
+        return getattr(self.serializer, 'accepts_buffers', False)
+
     def dump(self, *args, **kwargs):
         return self.serializer.dump(*args, *self.dump_args, **kwargs, **self.dump_kwargs)
 
@@ -0,0 +1,185 @@
+import sys
+import heapq
+import threading
+from collections import OrderedDict
+
+from merkl.logger import logger, short_hash
+
+# Containers with more items than this have their size extrapolated from a sample of the items
+SIZE_SAMPLE_ITEMS = 100
+
+
+def estimate_size(value, depth=3):
+    """ Estimates the memory used by `value` in bytes. Buffers (bytes, numpy arrays etc) are measured exactly, while
+    containers are measured `depth` levels down, from a sample of the items if they are large """
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    elif isinstance(value, memoryview):
+        return value.nbytes
+
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+
+    size = sys.getsizeof(value)
+    if depth == 0 or isinstance(value, str):
+        return size
+
+    if isinstance(value, dict):
+        items = list(value.items()) if len(value) <= SIZE_SAMPLE_ITEMS else [
+            item for _, item in zip(range(SIZE_SAMPLE_ITEMS), value.items())
+        ]
+        items_size = sum(estimate_size(key, depth - 1) + estimate_size(val, depth - 1) for key, val in items)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = value if len(value) <= SIZE_SAMPLE_ITEMS else [
+            item for _, item in zip(range(SIZE_SAMPLE_ITEMS), value)
+        ]
+        items_size = sum(estimate_size(item, depth - 1) for item in items)
+    else:
+        return size
+
+    if len(items) == 0:
+        return size
+
+    return size + items_size * len(value) // len(items)
+
+
+class MemoryCache:
+    """ Deserialized values of tasks with `cache_in_memory=True`, limited to `max_bytes` as estimated by
+    `estimate_size`. When full, values are evicted in least recently used order (policy='lru'), or by GreedyDual-Size
+    (policy='cost'), which prefers to keep values that are small and took long to compute or load.
+
+    If `spill_cache` is set to a cache backend, evicted values are serialized to it unless they are there already (i.e.
+    for tasks without a persistent cache), and loaded back into memory when requested again """
+
+    def __init__(self, max_bytes=None, policy='lru', spill_cache=None):
+        if policy not in ['lru', 'cost']:
+            raise ValueError(f"Unknown policy '{policy}', expected 'lru' or 'cost'")
+
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.spill_cache = spill_cache
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()  # hash -> (value, size, cost, priority, serializer)
+            self._heap = []  # (priority, seq, hash), entries are lazily removed when their priority changes
+            self._seq = 0
+            self._inflation = 0.0  # the `L` value of GreedyDual-Size
+            self.num_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.spills = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_loaded(self, hash):
+        """ Returns whether the value is in memory, as opposed to spilled """
+        return hash in self._entries
+
+    def __contains__(self, hash):
+        if hash in self._entries:
+            return True
+        return self.spill_cache is not None and self.spill_cache.has(hash)
+
+    def __getitem__(self, hash):
+        return self._entries[hash][0]
+
+    def __delitem__(self, hash):
+        self.discard(hash)
+
+    def get_stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.num_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'spills': self.spills,
+        }
+
+    def _touch(self, hash, value, size, cost, serializer):
+        """ Inserts or refreshes the entry's position in the eviction order """
+        priority = self._inflation + cost / max(size, 1)
+        self._entries[hash] = (value, size, cost, priority, serializer)
+        self._entries.move_to_end(hash)
+        if self.policy == 'cost':
+            heapq.heappush(self._heap, (priority, self._seq, hash))
+            self._seq += 1
+
+    def get(self, hash, serializer=None, default=None):
+        """ Returns the value for `hash`, loading it from the spill cache if it was spilled and `serializer` is given """
+        with self._lock:
+            entry = self._entries.get(hash)
+            if entry is not None:
+                self.hits += 1
+                self._touch(hash, *entry[:3], entry[4])
+                return entry[0]
+
+            self.misses += 1
+
+        if self.spill_cache is not None and serializer is not None:
+            content_bytes = self.spill_cache.get(hash)
+            if content_bytes is not None:
+                value = serializer.loads(content_bytes)
+                self.put(hash, value, serializer=serializer)
+                return value
+
+        return default
+
+    def put(self, hash, value, size=None, cost=1.0, serializer=None):
+        """ Stores `value`, where `cost` is e.g. the seconds it took to compute. `serializer` is used to spill the value
+        on eviction """
+        size = size if size is not None else estimate_size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            logger.debug(f'Value of {short_hash(hash)} ({size} bytes) is larger than the memory cache')
+            return
+
+        with self._lock:
+            self.discard(hash, spilled=False)
+            self._touch(hash, value, size, cost, serializer)
+            self.num_bytes += size
+            self._evict()
+
+    def discard(self, hash, spilled=True):
+        """ Removes `hash` if present, including from the spill cache if `spilled` """
+        with self._lock:
+            entry = self._entries.pop(hash, None)
+            if entry is not None:
+                self.num_bytes -= entry[1]
+
+        if spilled and self.spill_cache is not None:
+            self.spill_cache.clear(hash)
+
+    def _pop_victim(self):
+        if self.policy == 'lru':
+            return self._entries.popitem(last=False)
+
+        while True:
+            priority, _, hash = heapq.heappop(self._heap)
+            entry = self._entries.get(hash)
+            if entry is not None and entry[3] == priority:
+                del self._entries[hash]
+                self._inflation = priority
+                return hash, entry
+
+    def _evict(self):
+        while self.max_bytes is not None and self.num_bytes > self.max_bytes:
+            hash, (value, size, _, _, serializer) = self._pop_victim()
+            self.num_bytes -= size
+            self.evictions += 1
+            if self.spill_cache is not None and serializer is not None and not self.spill_cache.has(hash):
+                content_bytes = serializer.dumps(value)
+                if isinstance(content_bytes, str):
+                    content_bytes = bytes(content_bytes, 'utf-8')
+                self.spill_cache.add(hash, content_bytes)
+                self.spills += 1
+
+        # Compact the heap when most of its items are stale
+        if len(self._heap) > 2 * len(self._entries) + SIZE_SAMPLE_ITEMS:
+            self._heap = [(priority, seq, hash) for priority, seq, hash in self._heap if hash in self._entries and self._entries[hash][3] == priority]
+            heapq.heapify(self._heap)
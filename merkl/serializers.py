@@ -0,0 +1,265 @@
+import io
+import json
+import pickle
+import struct
+from typing import Callable, NamedTuple
+
+from merkl.exceptions import SerializationError
+from merkl.logger import logger
+
+# Buffers smaller than this are pickled in-band, since the table entry and alignment padding aren't worth it
+OUT_OF_BAND_MIN_BYTES = 64 * 1024
+
+# Out-of-band buffers are aligned to this many bytes, enough for any dtype and SIMD loads, within the serialized value
+BUFFER_ALIGNMENT = 64
+
+_PICKLE5_MAGIC = b'MERKLP5\x00'
+_PICKLE5_HEADER = struct.Struct('<QI')  # length of the pickle stream, number of buffers
+_PICKLE5_BUFFER = struct.Struct('<QQ')  # offset and length of a buffer
+
+
+def _align(offset):
+    return (offset + BUFFER_ALIGNMENT - 1) // BUFFER_ALIGNMENT * BUFFER_ALIGNMENT
+
+
+class Pickle5Serializer:
+    """ Serializes with dill and pickle protocol 5, writing large contiguous buffers (e.g. NumPy arrays) out-of-band as
+    aligned segments after the pickle stream, instead of copying them into it:
+
+        magic | pickle length, number of buffers | (offset, length) per buffer | pickle stream | buffer | buffer ...
+
+    When loading, the buffers are passed to the unpickler as views of the cached value, which for large values is
+    memory mapped from the cache file, so arrays are loaded without copying. Such arrays are read-only, copy them to
+    modify them """
+    accepts_buffers = True
+
+    @classmethod
+    def _pickle(cls, val):
+        """ Returns the header, pickle stream, and the buffers with their offsets """
+        import dill
+        buffers = []
+
+        def buffer_callback(pickle_buffer):
+            try:
+                raw = pickle_buffer.raw()
+            except BufferError:
+                return True  # not contiguous, pickle in-band
+
+            if raw.nbytes < OUT_OF_BAND_MIN_BYTES:
+                return True
+
+            buffers.append(raw)
+            return False
+
+        pickled = dill.dumps(val, protocol=5, buffer_callback=buffer_callback)
+
+        pickle_offset = len(_PICKLE5_MAGIC) + _PICKLE5_HEADER.size + _PICKLE5_BUFFER.size * len(buffers)
+        end = pickle_offset + len(pickled)
+        buffer_offsets = []
+        for raw in buffers:
+            buffer_offsets.append(_align(end))
+            end = buffer_offsets[-1] + raw.nbytes
+
+        header = bytearray(pickle_offset)
+        header[:len(_PICKLE5_MAGIC)] = _PICKLE5_MAGIC
+        _PICKLE5_HEADER.pack_into(header, len(_PICKLE5_MAGIC), len(pickled), len(buffers))
+        for i, (offset, raw) in enumerate(zip(buffer_offsets, buffers)):
+            table_offset = len(_PICKLE5_MAGIC) + _PICKLE5_HEADER.size + _PICKLE5_BUFFER.size * i
+            _PICKLE5_BUFFER.pack_into(header, table_offset, offset, raw.nbytes)
+
+        return header, pickled, list(zip(buffer_offsets, buffers)), end
+
+    @classmethod
+    def dumps(cls, val):
+        header, pickled, buffers, end = cls._pickle(val)
+
+        # NOTE: a bytearray rather than bytes, so that the buffers are copied only once
+        out = bytearray(end)
+        out[:len(header)] = header
+        out[len(header):len(header) + len(pickled)] = pickled
+        for offset, raw in buffers:
+            out[offset:offset + raw.nbytes] = raw
+        return out
+
+    @classmethod
+    def dump(cls, val, f):
+        """ Writes the same bytes as `dumps` to the file object `f`, without copying the buffers """
+        header, pickled, buffers, end = cls._pickle(val)
+        f.write(header)
+        f.write(pickled)
+        written = len(header) + len(pickled)
+        for offset, raw in buffers:
+            f.write(bytes(offset - written))  # alignment padding
+            f.write(raw)
+            written = offset + raw.nbytes
+
+    @classmethod
+    def loads(cls, val):
+        import dill
+        view = memoryview(val)
+        if view[:len(_PICKLE5_MAGIC)] != _PICKLE5_MAGIC:
+            raise SerializationError('Value was not serialized by Pickle5Serializer')
+
+        pickle_len, num_buffers = _PICKLE5_HEADER.unpack_from(view, len(_PICKLE5_MAGIC))
+        table_offset = len(_PICKLE5_MAGIC) + _PICKLE5_HEADER.size
+        buffers = []
+        for i in range(num_buffers):
+            offset, length = _PICKLE5_BUFFER.unpack_from(view, table_offset + _PICKLE5_BUFFER.size * i)
+            buffers.append(view[offset:offset + length])
+
+        pickle_offset = table_offset + _PICKLE5_BUFFER.size * num_buffers
+        return dill.loads(view[pickle_offset:pickle_offset + pickle_len], buffers=buffers)
+
+
+# Strings at least this long are checked for being contained in a value more than once, see `_is_plain_data`
+_SHARED_STR_MIN_LENGTH = 64
+
+
+class Format(NamedTuple):
+    """ A format of TypedSerializer. `accepts(val)` is whether to try the format for `val`, `dumps(val)` returns the
+    serialized value as a list of bytes-like chunks, or raises if the format can't serialize it after all, in which
+    case the next format is tried, and `loads(view)` loads it from a memoryview. `name` is recorded in the cache along
+    with each value, so it must not change once values were cached with it """
+    name: str
+    accepts: Callable
+    dumps: Callable
+    loads: Callable
+
+
+def _is_plain_data(val):
+    """ Whether `val` is made of None, bools, ints, floats, strings, lists and dicts with string keys only, which JSON
+    loads back as the same types. Values that contain the same list, dict or long string more than once are pickled
+    instead, since JSON would write them out every time and load them as separate objects """
+    stack = [val]
+    seen = set()
+    while len(stack) > 0:
+        val = stack.pop()
+        val_type = type(val)
+        if val_type is list or val_type is dict or (val_type is str and len(val) >= _SHARED_STR_MIN_LENGTH):
+            if id(val) in seen:
+                return False
+            seen.add(id(val))
+
+        if val_type is list:
+            stack += val
+        elif val_type is dict:
+            if any(type(key) is not str for key in val):
+                return False
+            stack += val.values()
+        elif val_type not in (type(None), bool, int, float, str):
+            return False
+    return True
+
+
+def _is_ndarray(val):
+    # NOTE: checked by name, so that numpy isn't imported for values that aren't arrays
+    val_type = type(val)
+    return val_type.__name__ == 'ndarray' and val_type.__module__ == 'numpy' and not val.dtype.hasobject
+
+
+def _dumps_npy(arr):
+    import numpy
+    if not arr.flags.c_contiguous and not arr.flags.f_contiguous:
+        arr = numpy.ascontiguousarray(arr)
+
+    header = io.BytesIO()
+    numpy.lib.format.write_array_header_1_0(header, numpy.lib.format.header_data_from_array_1_0(arr))
+    # NOTE: ravel in memory order is a view of a contiguous array, so the data isn't copied
+    return [header.getvalue(), memoryview(arr.ravel(order='K').view(numpy.uint8))]
+
+
+def _loads_npy(view):
+    import numpy
+    header_end = 10 + struct.unpack_from('<H', view, 8)[0]
+    header = io.BytesIO(bytes(view[:header_end]))
+    numpy.lib.format.read_magic(header)
+    shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(header)
+    count = 1
+    for dim in shape:
+        count *= dim
+    arr = numpy.frombuffer(view, dtype=dtype, count=count, offset=header_end)
+    # NOTE: copied, so that the array is writable like an unpickled one
+    return arr.reshape(shape, order='F' if fortran_order else 'C').copy(order='K')
+
+
+def _dumps_dill(val):
+    import dill
+    return [dill.dumps(val)]
+
+
+def _loads_dill(view):
+    import dill
+    return dill.loads(view)
+
+
+# The formats of TypedSerializer, of which the first that accepts a value and serializes it without raising is used
+FORMATS = [
+    Format('bytes', lambda val: type(val) is bytes, lambda val: [val], bytes),
+    Format('str', lambda val: type(val) is str, lambda val: [val.encode('utf-8')], lambda view: str(view, 'utf-8')),
+    Format('json', _is_plain_data, lambda val: [json.dumps(val).encode('utf-8')], lambda view: json.loads(str(view, 'utf-8'))),
+    Format('npy', _is_ndarray, _dumps_npy, _loads_npy),
+    Format('pickle', lambda val: True, lambda val: [pickle.dumps(val, protocol=5)], pickle.loads),
+    Format('dill', lambda val: True, _dumps_dill, _loads_dill),
+]
+
+
+def register_format(format, before='pickle'):
+    """ Adds a Format to TypedSerializer, tried before the format named `before`, by default before values are
+    pickled. E.g. a format for DataFrames that writes parquet """
+    if any(other.name == format.name for other in FORMATS):
+        raise ValueError(f'A format named {format.name} is already registered')
+    index = [other.name for other in FORMATS].index(before)
+    FORMATS.insert(index, format)
+
+
+class TypedSerializer:
+    """ The default serializer of task outputs, which picks a Format by the type of each value: bytes and strings are
+    stored as they are, plain data (see `_is_plain_data`) as JSON, NumPy arrays in the .npy format and other values are
+    pickled with protocol 5. dill is only used for what pickle can't serialize, such as lambdas, since it is several
+    times slower. Formats can be added with `register_format`.
+
+    Values are cached with `serialize`, and the cache records the name of the format of each entry for `deserialize`.
+    `dumps`, `dump` and `loads` use dill, for output files, which can then be loaded with dill or pickle as before, and
+    for entries cached without a format, i.e. by older versions of merkl """
+    accepts_buffers = True
+
+    @classmethod
+    def serialize(cls, val):
+        """ Returns the name of the Format picked for `val`, and the chunks of the serialized value """
+        for format in FORMATS:
+            if not format.accepts(val):
+                continue
+
+            try:
+                chunks = format.dumps(val)
+            except Exception as e:
+                if format is FORMATS[-1]:
+                    raise
+                logger.debug(f'Unable to serialize {type(val)} as {format.name}, trying the next format: {e}')
+                continue
+
+            return format.name, chunks
+
+        raise SerializationError(f'No format accepts {type(val)}')
+
+    @classmethod
+    def deserialize(cls, format_name, val):
+        """ Loads the value `val` serialized as the Format named `format_name` """
+        for format in FORMATS:
+            if format.name == format_name:
+                return format.loads(memoryview(val))
+        raise SerializationError(f'Unknown format {format_name} of cached value, was it registered?')
+
+    @classmethod
+    def dumps(cls, val):
+        import dill
+        return dill.dumps(val)
+
+    @classmethod
+    def dump(cls, val, f):
+        import dill
+        dill.dump(val, f)
+
+    @classmethod
+    def loads(cls, val):
+        return _loads_dill(val)
@@ -1,12 +1,10 @@
 import json
 import hashlib
 import textwrap
-import dill
 from pathlib import Path
 from enum import Enum
 from functools import lru_cache
 from inspect import getsource, isfunction, ismodule, getmodule
-from sigtools.specifiers import forwards_to_function
 import merkl
 from merkl.utils import (
     doublewrap,
@@ -24,7 +22,10 @@ from merkl.utils import (
 from merkl.logger import logger, short_hash
 from merkl.future import Future
 from merkl.exceptions import *
-from merkl.cache import SqliteCache
+from merkl.cache import SqliteCache, resolve_cache
+from merkl.compression import validate_compression
+from merkl.serializers import TypedSerializer
+from merkl.transfer import validate_transfer
 from merkl.io import DirRef, FileRef
 from merkl.utils import Eval
 
@@ -64,13 +65,12 @@ def code_hash(f, is_module=False, version=None, hash_key=None):
 
 
 def resolve_serializer(serializer, out_name):
+    # NOTE: TypedSerializer picks a format by the type of the output, and only uses dill for what pickle can't
+    # serialize. Pipelines use dill, since their outputs are Futures, which reference the dill module
     if serializer is None:
-        # NOTE: we use dill instead of pickle as default, because dill can serialize a reference to
-        # itself, while pickle can't. This is a problem when we want to serialize a Future(e.g. when
-        # caching pipeline results)
-        return dill
+        return TypedSerializer
     elif isinstance(serializer, dict):
-        return serializer.get(out_name, dill)  # default to dill if key doesn't exist
+        return serializer.get(out_name, TypedSerializer)  # default if key doesn't exist
     else:
         return serializer
 
@@ -189,8 +189,16 @@ def batch(
     hash_key=None,
     cache_in_memory=None,
     ignore_args=None,
+    compression=None,
+    transfer=None,
+    auto_cache=None,
+    write_behind=None,
 ):
+    from sigtools.specifiers import forwards_to_function
     deps = deps or []
+    cache = resolve_cache(cache)
+    validate_compression(compression)
+    validate_transfer(transfer)
     if single_fn is None:
         raise BatchTaskError(f"'single_fn' has to be supplied")
 
@@ -298,6 +306,14 @@ def batch(
                     future.cache = cache if not merkl.cache.NO_CACHE else None
                 if serializer:
                     future.serializer = resolve_serializer(serializer, future.out_name)
+                if compression:
+                    future.compression = compression
+                if transfer:
+                    future.transfer = transfer
+                if auto_cache is not None:
+                    future.auto_cache = auto_cache
+                if write_behind is not None:
+                    future.write_behind = write_behind
 
                 if not future.in_cache():
                     any_out_not_cached = True
@@ -361,9 +377,17 @@ def task(
     hash_key=None,
     cache_in_memory=False,
     ignore_args=None,
+    compression=None,
+    transfer=None,
+    auto_cache=None,
+    write_behind=None,
 ):
+    from sigtools.specifiers import forwards_to_function
     global next_task_id
     deps = deps or []
+    cache = resolve_cache(cache)
+    validate_compression(compression)
+    validate_transfer(transfer)
     ignore_args = ignore_args or []
     sig = sig if sig else signature_with_default(f)
 
@@ -430,6 +454,10 @@ def task(
                 task_id=task_id,
                 cache_in_memory=cache_in_memory,
                 ignore_args=ignore_args,
+                compression=compression,
+                transfer=transfer,
+                auto_cache=auto_cache,
+                write_behind=write_behind,
             )
             # `deps_hash` triggers an expensive calculation, but it's the
             # same for all output futures, so we cache it and set manually
@@ -472,7 +500,10 @@ def task(
 
 @doublewrap
 def pipeline(f, hash_mode=HashMode.FIND_DEPS, deps=None, cache=SqliteCache, cache_in_memory=False, ignore_args=None):
+    from sigtools.specifiers import forwards_to_function
+    import dill
     deps = deps or []
+    cache = resolve_cache(cache)
     ignore_args = ignore_args or []
     sig = signature_with_default(f)
 
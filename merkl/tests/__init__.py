@@ -3,7 +3,7 @@ import shutil
 import unittest
 import merkl
 from merkl.cli.init import InitAPI
-from merkl.cache import SqliteCache
+from merkl.cache import get_default_cache, MEMORY_CACHE
 
 
 class TestCaseWithMerklRepo(unittest.TestCase):
@@ -12,10 +12,12 @@ class TestCaseWithMerklRepo(unittest.TestCase):
         merkl.io.cwd = '/tmp/'
         api = InitAPI()
         api.init()
+        self.cache = get_default_cache()
 
     def tearDown(self):
+        self.cache.close()
+        MEMORY_CACHE.clear()
         shutil.rmtree('/tmp/.merkl/')
         merkl.io.cwd = None
-        SqliteCache.connection = None
 
 
@@ -1,16 +1,54 @@
 import os
+import json
+import shutil
 import math
+import pickle
+import struct
+import tarfile
+import mmap
+import sqlite3
+import time
 import unittest
+from unittest.mock import patch
+import threading
+import multiprocessing
+from io import BytesIO
 from pathlib import Path
+import merkl.future
 from merkl import *
 from merkl.exceptions import *
 from merkl.tests import TestCaseWithMerklRepo
 from merkl.io import FileRef, DirRef
-from merkl.cache import get_cache_file_path, SqliteCache, BLOB_DB_SIZE_LIMIT_BYTES, MEMORY_CACHE
+from merkl.cache import (
+    get_cache_file_path, get_blob_file_path, get_content_hash, get_db_path, get_tmp_dir, get_merkl_path, get_packs_dir,
+    get_pack_path, export_bundle, import_bundle, BLOB_DB_SIZE_LIMIT_BYTES, GC_DELETE_CHUNK_SIZE, MEMORY_CACHE, SCHEMA_VERSION, SqliteCache, pin,
+)
+from merkl.memory_cache import MemoryCache, estimate_size
+from merkl.serializers import TypedSerializer, Format, register_format, FORMATS
 from merkl.utils import evaluate_futures, Eval
 from merkl.util_tasks import combine_file_refs
 
 
+class BufferArray:
+    """ Stand-in for a NumPy array, which pickles its data as an out-of-band buffer with protocol 5 """
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        return (BufferArray, (pickle.PickleBuffer(self.data),))
+
+
+def _get_schema(connection):
+    """ The columns of each table, and the SQL of the indexes and triggers, with whitespace normalized """
+    schema = {}
+    for kind, name, sql in connection.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name"):
+        if kind == 'table':
+            schema[name] = [row[1:] for row in connection.execute(f"PRAGMA table_info({name})")]
+        elif sql is not None:
+            schema[name] = ' '.join(sql.split())
+    return schema
+
+
 class TestCache(TestCaseWithMerklRepo):
     def test_caching(self):
         task_has_run = False
@@ -229,19 +267,365 @@ class TestCache(TestCaseWithMerklRepo):
     def test_cache_larger_blobs(self):
         # First test that small blob doesn't get stored in file
         hash = 'gfafasf323'
-        SqliteCache.add(hash, b'small blob')
-        self.assertFalse(os.path.exists(get_cache_file_path(hash)))
+        self.cache.add(hash, b'small blob')
+        self.assertFalse(os.path.exists(get_blob_file_path(get_content_hash(b'small blob'))))
 
         # Then check that large blog is stored in file
         hash = 'gy25uhg2hwy34'
         big_blob = b'big blob!!'
         big_blob = big_blob * (math.ceil(BLOB_DB_SIZE_LIMIT_BYTES / len(big_blob)) + 1)  # make it large
-        SqliteCache.add(hash, big_blob)
-        self.assertTrue(os.path.exists(get_cache_file_path(hash)))
+        self.cache.add(hash, big_blob)
+        self.assertTrue(os.path.exists(get_blob_file_path(get_content_hash(big_blob))))
 
         # Check that file is removed when cache is cleared
-        SqliteCache.clear(hash)
-        self.assertFalse(os.path.exists(get_cache_file_path(hash)))
+        self.cache.clear(hash)
+        self.assertFalse(os.path.exists(get_blob_file_path(get_content_hash(big_blob))))
+
+    def test_dedup(self):
+        big_blob = os.urandom(BLOB_DB_SIZE_LIMIT_BYTES + 1)
+        blob_path = get_blob_file_path(get_content_hash(big_blob))
+        self.cache.add('a' * 64, big_blob)
+        with self.cache.transaction():
+            self.cache.add('b' * 64, big_blob)
+            self.cache.add('c' * 64, big_blob)
+            self.cache.add('d' * 64, b'small blob')
+            self.cache.add('e' * 64, b'small blob')
+
+        # Stored once
+        self.assertEqual(os.listdir(os.path.dirname(blob_path)), [os.path.basename(blob_path)])
+        blob_rows = list(self.cache.connect().execute('SELECT content_hash, refcount FROM blobs ORDER BY refcount'))
+        self.assertEqual(blob_rows, [(get_content_hash(b'small blob'), 2), (get_content_hash(big_blob), 3)])
+
+        # Blobs are kept until the last entry referencing them is cleared
+        self.cache.clear('a' * 64)
+        self.cache.clear_all_except(['c' * 64, 'd' * 64])
+        self.assertEqual(self.cache.get('c' * 64), big_blob)
+        self.assertEqual(self.cache.get('d' * 64), b'small blob')
+        self.cache.clear('c' * 64)
+        self.cache.clear('d' * 64)
+        self.assertFalse(os.path.exists(blob_path))
+        self.assertEqual(list(self.cache.connect().execute('SELECT COUNT(*) FROM blobs')), [(0,)])
+
+        # An entry added and cleared within a transaction leaves no blob behind
+        with self.cache.transaction():
+            self.cache.add('f' * 64, big_blob)
+            self.cache.clear('f' * 64)
+        self.assertFalse(os.path.exists(blob_path))
+        self.assertEqual(os.listdir(get_tmp_dir()), [])
+
+    def test_buffer_serializer(self):
+        @task(serializer=BufferSerializer)
+        def my_task():
+            return b'x' * (BLOB_DB_SIZE_LIMIT_BYTES + 1)
+
+        self.assertEqual(my_task().eval(), b'x' * (BLOB_DB_SIZE_LIMIT_BYTES + 1))
+        val = my_task().eval()
+        self.assertIsInstance(val, memoryview)
+        self.assertIsInstance(val.obj, mmap.mmap)
+        self.assertEqual(val, b'x' * (BLOB_DB_SIZE_LIMIT_BYTES + 1))
+
+    def test_pickle5_serializer(self):
+        @task(serializer=Pickle5Serializer)
+        def my_task():
+            return [BufferArray(bytearray(b'x' * BLOB_DB_SIZE_LIMIT_BYTES)), BufferArray(b'small')]
+
+        val = my_task().eval()
+        self.assertEqual(bytes(val[0].data), b'x' * BLOB_DB_SIZE_LIMIT_BYTES)
+
+        # Loaded as a view of the memory mapped cache file, at an aligned offset
+        val = my_task().eval()
+        data = val[0].data
+        self.assertIsInstance(data, memoryview)
+        self.assertIsInstance(data.obj, mmap.mmap)
+        self.assertEqual(data, b'x' * BLOB_DB_SIZE_LIMIT_BYTES)
+        self.assertEqual(val[1].data, b'small')
+
+        serialized = Pickle5Serializer.dumps(val)
+        offset, length = struct.unpack_from('<QQ', serialized, 20)
+        self.assertEqual(offset % 64, 0)
+        self.assertEqual(length, BLOB_DB_SIZE_LIMIT_BYTES)
+
+        with self.assertRaises(SerializationError):
+            Pickle5Serializer.loads(b'not serialized by Pickle5Serializer')
+
+        f = BytesIO()
+        Pickle5Serializer.dump(val, f)
+        self.assertEqual(f.getvalue(), serialized)
+
+    def test_typed_serializer(self):
+        import dill
+        values = [
+            (b'bytes', 'bytes'),
+            ('text', 'str'),
+            ([1, 2.5, None, True, {'a': 'b'}], 'json'),
+            ((1, 2), 'pickle'),  # JSON would load it as a list
+            ({1: 'a'}, 'pickle'),
+            (['x' * 100] * 2, 'pickle'),
+            (FileRef('/tmp/file.txt'), 'pickle'),
+            (lambda: 1, 'dill'),
+        ]
+        for val, format in values:
+            format_name, chunks = TypedSerializer.serialize(val)
+            self.assertEqual(format_name, format)
+            if format != 'dill':
+                loaded = TypedSerializer.deserialize(format_name, memoryview(b''.join(chunks)))
+                self.assertEqual((loaded, type(loaded)), (val, type(val)))
+
+        # Output files, and values cached without a format, are written with dill
+        self.assertEqual(TypedSerializer.dumps([1]), dill.dumps([1]))
+        self.assertEqual(TypedSerializer.loads(dill.dumps([1])), [1])
+        with self.assertRaises(SerializationError):
+            TypedSerializer.deserialize('unknown', b'')
+
+        register_format(Format('set', lambda val: type(val) is set, lambda val: [json.dumps(sorted(val)).encode()], lambda view: set(json.loads(bytes(view)))))
+        try:
+            format_name, chunks = TypedSerializer.serialize({1, 2})
+            self.assertEqual(format_name, 'set')
+            self.assertEqual(TypedSerializer.deserialize(format_name, b''.join(chunks)), {1, 2})
+            with self.assertRaises(ValueError):
+                register_format(Format('set', None, None, None))
+        finally:
+            FORMATS[:] = [format for format in FORMATS if format.name != 'set']
+
+        # The cache records the format of each entry
+        @task
+        def json_task():
+            return [1, {'a': 2}]
+
+        @task(serializer=Pickle5Serializer)
+        def pickle5_task():
+            return [1, {'a': 2}]
+
+        self.assertEqual(json_task().eval(), [1, {'a': 2}])
+        self.assertEqual(self.cache.get_format(json_task().hash), 'json')
+        self.assertEqual(self.cache.get(json_task().hash), b'[1, {"a": 2}]')
+        self.assertEqual(json_task().eval(), [1, {'a': 2}])
+        self.assertEqual(pickle5_task().eval(), [1, {'a': 2}])
+        self.assertIsNone(self.cache.get_format(pickle5_task().hash))
+
+        # Entries cached before the format was recorded are loaded with dill
+        self.cache.clear(json_task().hash)
+        self.cache.add(json_task().hash, dill.dumps([3]))
+        self.assertEqual(json_task().eval(), [3])
+
+        try:
+            import numpy
+        except ImportError:
+            return
+
+        arrays = [numpy.arange(12, dtype=numpy.float32).reshape(3, 4), numpy.asfortranarray(numpy.ones((3, 4))), numpy.arange(10)[::2]]
+        for arr in arrays:
+            format_name, chunks = TypedSerializer.serialize(arr)
+            self.assertEqual(format_name, 'npy')
+            loaded = TypedSerializer.deserialize(format_name, b''.join(chunks))
+            self.assertTrue(numpy.array_equal(loaded, arr))
+            self.assertEqual(loaded.dtype, arr.dtype)
+            self.assertTrue(loaded.flags.writeable)
+
+    def test_stream_serialization(self):
+        large_val = ['x' * 1000] * BLOB_DB_SIZE_LIMIT_BYTES
+
+        @task
+        def large_task():
+            return large_val
+
+        @task(serializer=json)
+        def json_task():
+            return [1, {'a': 2}]
+
+        class FailingSerializer:
+            @classmethod
+            def dump(cls, val, f):
+                f.write(b'partial')
+                raise SerializationError('Failed')
+
+        @task(serializer=FailingSerializer)
+        def failing_task():
+            return large_val
+
+        # Streamed into the blob file, under the hash of its content
+        self.assertEqual(large_task().eval(), large_val)
+        large_val_bytes = b''.join(TypedSerializer.serialize(large_val)[1])
+        content_hash = get_content_hash(large_val_bytes)
+        self.assertTrue(os.path.exists(get_blob_file_path(content_hash)))
+        self.assertEqual(self.cache.get_stats(large_task().fn_descriptive_name)[1], len(large_val_bytes))
+        self.assertEqual(large_task().eval(), large_val)
+
+        # Text written by json.dump is encoded like the result of json.dumps
+        self.assertEqual(json_task().eval(), [1, {'a': 2}])
+        self.assertEqual(self.cache.get(json_task().hash), bytes(json.dumps([1, {'a': 2}]), 'utf-8'))
+
+        # A failed dump leaves nothing behind
+        with self.assertRaises(SerializationError):
+            failing_task().eval()
+        self.assertFalse(self.cache.has(failing_task().hash))
+        self.assertEqual(os.listdir(get_tmp_dir()), [])
+
+    def test_compression(self):
+        @task(compression='lzma')
+        def my_task():
+            return 'compressible text ' * 10000
+
+        out = my_task()
+        self.assertEqual(out.eval(), 'compressible text ' * 10000)
+        self.assertEqual(my_task().eval(), 'compressible text ' * 10000)
+        codec, size = list(self.cache.connect().execute('SELECT codec, size FROM blobs'))[0]
+        self.assertEqual(codec, 'lzma')
+        self.assertLess(size, 10000)
+        self.assertEqual(self.cache.get_stats(out.fn_descriptive_name)[1], len(self.cache.get(out.hash)))
+
+        with self.assertRaises(ValueError):
+            @task(compression='zip')
+            def my_other_task():
+                return 1
+
+    def test_task_stats(self):
+        @task
+        def my_task(arg):
+            time.sleep(0.01)
+            return arg * 2
+
+        @task
+        def my_multi_out_task():
+            return 1, 2
+
+        my_task(1).eval()
+        my_task(1).eval()
+        my_task(2).eval()
+        for out in my_multi_out_task():
+            out.eval()
+        self.cache.close()  # writes the buffered stats
+
+        stats = {stats.module_function: stats for stats in self.cache.get_task_stats()}
+        stats_my_task = stats[my_task(1).fn_descriptive_name]
+        self.assertEqual((stats_my_task.hits, stats_my_task.misses), (1, 2))
+        num_bytes = len(self.cache.get(my_task(1).hash))
+        self.assertEqual(stats_my_task.bytes_read, num_bytes)
+        self.assertEqual(stats_my_task.bytes_written, 2 * num_bytes)
+        self.assertGreater(stats_my_task.compute_seconds, 0.02)
+        self.assertGreater(stats_my_task.load_seconds, 0)
+
+        # Both outputs are written by one call, and the second is then loaded from the cache
+        stats_multi_out = stats[my_multi_out_task()[0].fn_descriptive_name]
+        self.assertEqual((stats_multi_out.hits, stats_multi_out.misses), (1, 1))
+
+        # get_stats filters on the indexed module_function
+        plan = list(self.cache.connect().execute(
+            'EXPLAIN QUERY PLAN SELECT COUNT(*), SUM(size) FROM cache WHERE module_function=?', ('fn',),
+        ))
+        self.assertIn('cache_module_function', plan[0][-1])
+
+    def test_gc(self):
+        def set_last_access(hash, last_access):
+            with self.cache.transaction():
+                self.cache.connect().execute('UPDATE cache SET last_access=? WHERE hash=?', (last_access, hash))
+
+        big_blob = os.urandom(BLOB_DB_SIZE_LIMIT_BYTES + 1)
+        for i, hash in enumerate(['a' * 64, 'b' * 64, 'c' * 64, 'd' * 64]):
+            self.cache.add(hash, bytes([i]) + big_blob)
+            set_last_access(hash, 1000 + i)
+        # Shares the blob with 'a', so evicting 'a' doesn't free anything
+        self.cache.add('e' * 64, bytes([0]) + big_blob)
+        set_last_access('e' * 64, 2000)
+
+        # Access times are updated on get, when written
+        self.cache.get('b' * 64)
+        self.cache.close()
+        self.assertGreater(list(self.cache.connect().execute('SELECT last_access FROM cache WHERE hash=?', ('b' * 64,)))[0][0], 2000)
+
+        # Nothing is evicted without limits or in a dry run
+        self.assertEqual(self.cache.gc(), (0, 0))
+        self.assertEqual(self.cache.gc(max_bytes=2 * len(big_blob) + 10, dry_run=True), (3, 2 * (len(big_blob) + 1)))
+        self.assertTrue(self.cache.has('a' * 64))
+
+        # Least recently used first, 'c' is pinned
+        self.cache.pin('my_pipeline', ['c' * 64])
+        self.assertEqual(self.cache.get_pins(), [('my_pipeline', 1)])
+        num_evicted, num_freed = self.cache.gc(max_bytes=2 * len(big_blob) + 10)
+        self.assertEqual((num_evicted, num_freed), (3, 2 * (len(big_blob) + 1)))
+        self.assertEqual(
+            [self.cache.has(hash) for hash in ['a' * 64, 'b' * 64, 'c' * 64, 'd' * 64, 'e' * 64]],
+            [False, True, True, False, False],
+        )
+        self.assertFalse(os.path.exists(get_blob_file_path(get_content_hash(bytes([0]) + big_blob))))
+
+        # Entries not accessed within max_age are evicted regardless of size, unless pinned
+        self.assertEqual(self.cache.gc(max_age=60)[0], 0)
+        self.cache.unpin('my_pipeline')
+        self.assertEqual(self.cache.gc(max_age=60)[0], 1)
+        self.assertFalse(self.cache.has('c' * 64))
+        self.assertTrue(self.cache.has('b' * 64))
+
+    def test_pin_pipeline(self):
+        @task
+        def my_task(val):
+            return val
+
+        @pipeline
+        def my_pipeline():
+            return my_task(my_task(1))
+
+        out = my_pipeline()
+        out.eval()
+        pin('my_pipeline', out)
+        self.assertEqual(self.cache.get_pins(), [('my_pipeline', 3)])
+        self.cache.gc(max_age=0)
+        self.assertTrue(my_pipeline().in_cache())
+        self.assertTrue(out.in_cache())
+        self.assertTrue(list(out.parent_futures)[0].in_cache())
+
+    def test_former_classmethods(self):
+        # The methods used to be classmethods, calls on the class go to the default cache
+        self.cache.add('a' * 64, b'value')
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(SqliteCache.get('a' * 64), b'value')
+        with self.assertWarns(DeprecationWarning):
+            self.assertFalse(SqliteCache.has('b' * 64))
+
+        # Explicitly passing the instance isn't deprecated
+        self.assertEqual(SqliteCache.get(self.cache, 'a' * 64), b'value')
+
+    def test_migrate_content_hashes(self):
+        # Create a cache with the schema from before values were deduplicated
+        self.cache.close()
+        os.remove(get_db_path())
+        connection = sqlite3.connect(get_db_path())
+        connection.execute("""
+            CREATE TABLE cache (
+                hash CHARACTER(64) PRIMARY KEY, data BLOB, size INTEGER, ref_path TEXT, ref_is_dir BOOL,
+                module_function TEXT NULL
+            )
+        """)
+        connection.execute("CREATE TABLE files (path TEXT, modified INTEGER, merkl_hash CHARACTER(64), md5_hash CHARACTER(64), PRIMARY KEY (path, modified))")
+        big_blob = os.urandom(BLOB_DB_SIZE_LIMIT_BYTES + 1)
+        for hash in ['a' * 64, 'b' * 64]:
+            with open(get_cache_file_path(hash, makedirs=True), 'wb') as f:
+                f.write(big_blob)
+            connection.execute("INSERT INTO cache VALUES (?, NULL, ?, NULL, 0, 'module.fn')", (hash, len(big_blob)))
+        connection.execute("INSERT INTO cache VALUES (?, ?, 5, NULL, 0, 'module.fn')", ('c' * 64, b'small'))
+        connection.commit()
+        connection.close()
+
+        self.assertEqual(self.cache.get('a' * 64), big_blob)
+        self.assertEqual(self.cache.get('b' * 64), big_blob)
+        self.assertEqual(self.cache.get('c' * 64), b'small')
+        self.assertEqual(self.cache.get_stats('module.fn'), (3, 2 * len(big_blob) + 5))
+        self.assertFalse(os.path.exists(get_cache_file_path('a' * 64)))
+        self.assertFalse(os.path.exists(get_cache_file_path('b' * 64)))
+        self.assertTrue(os.path.exists(get_blob_file_path(get_content_hash(big_blob))))
+        self.assertEqual(list(self.cache.connect().execute('PRAGMA user_version')), [(SCHEMA_VERSION,)])
+
+        # The migrated schema is the same as that of a new cache
+        fresh_cache = SqliteCache('/tmp/.merkl_fresh/')
+        try:
+            fresh_cache.create_cache()
+            self.assertEqual(_get_schema(self.cache.connect()), _get_schema(fresh_cache.connect()))
+        finally:
+            fresh_cache.close()
+            shutil.rmtree('/tmp/.merkl_fresh/')
+
+        self.cache.clear_module_function('module.fn')
+        self.assertFalse(os.path.exists(get_blob_file_path(get_content_hash(big_blob))))
 
     def test_siblings_evaluated(self):
         # There's an issue where if a function has multiple outs, and only some of them have been evaluated before the
@@ -269,6 +653,174 @@ class TestCache(TestCaseWithMerklRepo):
         for out in outs1:
             self.assertTrue(out.in_cache())
 
+    def test_clear_all_except_mark_and_sweep(self):
+        big_blob = os.urandom(BLOB_DB_SIZE_LIMIT_BYTES + 1)
+        hashes = [f'{i:064x}' for i in range(2 * GC_DELETE_CHUNK_SIZE + 10)]
+        with self.cache.transaction():
+            for i, hash in enumerate(hashes):
+                self.cache.add(hash, big_blob if i == 0 else bytes([i % 256]) * 10)
+
+        file_path = '/tmp/merkl_sweep_test.txt'
+        with open(file_path, 'w') as f:
+            f.write('test')
+        ref = self.cache.transfer_ref(FileRef(file_path, rm_after_caching=True), 'f' * 64)
+        self.cache.add('f' * 64, b'ref', ref=ref)
+
+        # More kept hashes than fit in an SQL expression
+        keep = hashes[1:] + [f'{i:064x}' for i in range(10 ** 6, 10 ** 6 + 50000)]
+        self.cache.clear_all_except(keep)
+        self.assertFalse(self.cache.has(hashes[0]))
+        self.assertTrue(all(self.cache.has(hash) for hash in hashes[1:]))
+        self.assertFalse(os.path.exists(get_blob_file_path(get_content_hash(big_blob))))
+        self.assertFalse(os.path.exists(ref))
+
+        self.cache.clear_all_except([])
+        self.assertEqual(self.cache.get_stats(), [])
+
+    def test_trash(self):
+        big_blob = os.urandom(BLOB_DB_SIZE_LIMIT_BYTES + 1)
+        blob_path = get_blob_file_path(get_content_hash(big_blob))
+        self.cache.add('a' * 64, big_blob)
+
+        # The blob file goes to the trash in the transaction that deletes the entry, so it survives a crash before
+        # the files are removed, and is removed by the next write that empties the trash
+        with self.cache._write() as connection:
+            connection.execute('DELETE FROM cache')
+            self.cache._delete_unreferenced_blobs(connection)
+        self.assertTrue(os.path.exists(blob_path))
+        self.assertEqual(list(self.cache.connect().execute('SELECT kind FROM trash')), [('blob',)])
+
+        # Adding the content again takes it out of the trash
+        self.cache.add('b' * 64, big_blob)
+        self.assertEqual(self.cache.get('b' * 64), big_blob)
+        self.assertEqual(list(self.cache.connect().execute('SELECT kind FROM trash')), [])
+
+        self.cache.clear('b' * 64)
+        self.assertFalse(os.path.exists(blob_path))
+
+    def test_sweep_orphans(self):
+        big_blob = os.urandom(BLOB_DB_SIZE_LIMIT_BYTES + 1)
+        self.cache.add('a' * 64, big_blob)
+        blob_path = get_blob_file_path(get_content_hash(big_blob))
+
+        orphan_blob_path = get_blob_file_path('b' * 64, makedirs=True)
+        orphan_ref_path = get_cache_file_path('c' * 64, 'txt', makedirs=True)
+        orphan_tmp_path = f'{get_tmp_dir()}{"d" * 64}.tmp'
+        for path in [orphan_blob_path, orphan_ref_path, orphan_tmp_path]:
+            with open(path, 'wb') as f:
+                f.write(b'orphan')
+
+        # Recently changed files may belong to writes in progress
+        self.assertEqual(self.cache.sweep_orphans(), (0, 0))
+
+        orig_min_age, cache.ORPHAN_MIN_AGE = cache.ORPHAN_MIN_AGE, -1
+        try:
+            self.assertEqual(self.cache.sweep_orphans(dry_run=True), (3, 18))
+            self.assertTrue(os.path.exists(orphan_blob_path))
+            self.assertEqual(self.cache.sweep_orphans(), (3, 18))
+        finally:
+            cache.ORPHAN_MIN_AGE = orig_min_age
+
+        for path in [orphan_blob_path, orphan_ref_path, orphan_tmp_path]:
+            self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(blob_path))
+        self.assertEqual(self.cache.get('a' * 64), big_blob)
+
+    def test_blob_stored_in_db(self):
+        # The content is packed by one cache, and then written to a file by another, which isn't referenced
+        blob = os.urandom(BLOB_DB_SIZE_LIMIT_BYTES + 1)
+        SqliteCache(packs=True).add('a' * 64, blob)
+        self.cache.add('b' * 64, blob)
+        self.assertFalse(os.path.exists(get_blob_file_path(get_content_hash(blob))))
+        self.assertEqual(os.listdir(get_tmp_dir()), [])
+        self.assertEqual(self.cache.get('b' * 64), blob)
+        self.assertEqual(self.cache.sweep_orphans(), (0, 0))
+
+    def test_packs(self):
+        packed_cache = SqliteCache(packs=True)
+        blob_size = BLOB_DB_SIZE_LIMIT_BYTES + 1
+        blobs = [os.urandom(blob_size) for _ in range(5)]
+
+        orig_max_bytes, cache.PACK_MAX_BYTES = cache.PACK_MAX_BYTES, 3 * blob_size
+        try:
+            with packed_cache.transaction():
+                for i, blob in enumerate(blobs):
+                    packed_cache.add(str(i) * 64, blob)
+                self.assertEqual(packed_cache.get('0' * 64), blobs[0])
+        finally:
+            cache.PACK_MAX_BYTES = orig_max_bytes
+
+        self.assertEqual(os.listdir(f'{get_merkl_path()}blobs/'), [])
+        self.assertEqual(sorted(os.listdir(get_packs_dir())), ['0.pack', '1.pack'])
+        for i, blob in enumerate(blobs):
+            self.assertEqual(packed_cache.get(str(i) * 64), blob)
+            buffer = packed_cache.get_buffer(str(i) * 64)
+            self.assertIsInstance(buffer.obj, mmap.mmap)
+            self.assertEqual(buffer, blob)
+
+        # Only pack files with enough dead space are rewritten, into a later pack file
+        self.cache.clear('0' * 64)
+        self.assertEqual(packed_cache.repack_packs(min_dead_ratio=0.5), (0, 0))
+        self.cache.clear('1' * 64)
+        self.assertEqual(packed_cache.repack_packs(min_dead_ratio=0.5), (1, 2 * blob_size))
+        self.assertEqual(sorted(os.listdir(get_packs_dir())), ['1.pack'])
+        for i, blob in enumerate(blobs[2:], 2):
+            self.assertEqual(self.cache.get(str(i) * 64), blob)
+
+        # e.g. data appended by a transaction that failed
+        with open(get_pack_path(1), 'ab') as f:
+            f.write(b'dead')
+        self.assertEqual(packed_cache.repack_packs(min_dead_ratio=0.0), (1, 4))
+        self.assertEqual(sorted(os.listdir(get_packs_dir())), ['2.pack'])
+        self.assertEqual(os.stat(get_pack_path(2)).st_size, 3 * blob_size)
+        for i, blob in enumerate(blobs[2:], 2):
+            self.assertEqual(self.cache.get(str(i) * 64), blob)
+
+    def test_adaptive_placement(self):
+        def get_totals(intercept, slope, sizes):
+            seconds = [intercept + slope * size for size in sizes]
+            return [len(sizes), sum(sizes), sum(seconds), sum(size ** 2 for size in sizes), sum(size * t for size, t in zip(sizes, seconds))]
+
+        sizes = [1000 * i for i in range(1, cache.ADAPTIVE_PLACEMENT_MIN_READS + 1)]
+        file_reads = get_totals(1e-4, 1e-10, sizes)
+        self.assertAlmostEqual(cache.choose_inline_max_bytes(get_totals(1e-5, 1e-9, sizes), file_reads), 100000, delta=1)
+        self.assertEqual(cache.choose_inline_max_bytes(get_totals(1e-5, 1e-11, sizes), file_reads), cache.INLINE_MAX_BYTES)
+        self.assertEqual(cache.choose_inline_max_bytes(get_totals(1e-5, 1e-9, sizes[:10]), file_reads), BLOB_DB_SIZE_LIMIT_BYTES)
+
+        self.cache.add('c' * 64, b'small')
+        self.cache.get('c' * 64)
+        self.cache.close()
+        self.assertEqual(list(self.cache.connect().execute("SELECT kind, count FROM read_latencies")), [('inline', 1)])
+
+        # Repacking moves blobs to where the current inline_max_bytes places them
+        small, large = os.urandom(50000), os.urandom(150000)
+        self.cache.add('a' * 64, large, fn_name='b.fn')
+        self.cache.add('b' * 64, small, fn_name='a.fn')
+        small_path, large_path = get_blob_file_path(get_content_hash(small)), get_blob_file_path(get_content_hash(large))
+        self.assertTrue(os.path.exists(large_path))
+
+        orig_limit = cache.BLOB_DB_SIZE_LIMIT_BYTES
+        try:
+            cache.BLOB_DB_SIZE_LIMIT_BYTES = 200000
+            self.cache.close()  # forgets the inline_max_bytes chosen
+            self.assertEqual(self.cache.repack()[0], 1)
+            self.assertFalse(os.path.exists(large_path))
+
+            cache.BLOB_DB_SIZE_LIMIT_BYTES = 40000
+            self.cache.close()
+            self.assertEqual(self.cache.repack()[0], 2)
+            self.assertTrue(os.path.exists(small_path))
+            self.assertTrue(os.path.exists(large_path))
+        finally:
+            cache.BLOB_DB_SIZE_LIMIT_BYTES = orig_limit
+
+        self.assertEqual(self.cache.get('a' * 64), large)
+        self.assertEqual(self.cache.get('b' * 64), small)
+
+        # Clustered by module function, which is NULL for the first
+        content_hashes = [content_hash for content_hash, in self.cache.connect().execute("SELECT content_hash FROM blobs ORDER BY rowid")]
+        self.assertEqual(content_hashes, [get_content_hash(b'small'), get_content_hash(small), get_content_hash(large)])
+
     def test_clear_all_except(self):
         @task
         def my_task(val):
@@ -276,25 +828,27 @@ class TestCache(TestCaseWithMerklRepo):
 
         out1, out2 = my_task(2)
         out1.eval()
+        out1_path = get_blob_file_path(get_content_hash(self.cache.get(out1.hash)))
+        out2_path = get_blob_file_path(get_content_hash(self.cache.get(out2.hash)))
         # Some sanity checks
-        self.assertFalse(os.path.exists(get_cache_file_path(out1.hash)))
-        self.assertTrue(os.path.exists(get_cache_file_path(out2.hash)))
-        self.assertTrue(SqliteCache.has(out1.hash))
-        self.assertTrue(SqliteCache.has(out2.hash))
+        self.assertFalse(os.path.exists(out1_path))
+        self.assertTrue(os.path.exists(out2_path))
+        self.assertTrue(self.cache.has(out1.hash))
+        self.assertTrue(self.cache.has(out2.hash))
 
         # Now let's say we evaluate my_task with some other input
         out1_2, out2_2 = my_task(3)
         out1_2.eval()
-        self.assertTrue(SqliteCache.has(out2_2.hash))
+        self.assertTrue(self.cache.has(out2_2.hash))
 
         # Now clear all except this out
-        SqliteCache.clear_all_except([out1_2.hash])
+        self.cache.clear_all_except([out1_2.hash])
 
         # None of these should be cached or on file
-        self.assertFalse(SqliteCache.has(out2_2.hash))
-        self.assertFalse(SqliteCache.has(out1.hash))
-        self.assertFalse(SqliteCache.has(out2.hash))
-        self.assertFalse(os.path.exists(get_cache_file_path(out2.hash)))
+        self.assertFalse(self.cache.has(out2_2.hash))
+        self.assertFalse(self.cache.has(out1.hash))
+        self.assertFalse(self.cache.has(out2.hash))
+        self.assertFalse(os.path.exists(out2_path))
 
         # Make sure pipeline outs remain (there was a bug with this)
         @pipeline
@@ -305,8 +859,8 @@ class TestCache(TestCaseWithMerklRepo):
         out1.eval()
 
         cache.clear([out1], keep=True)
-        self.assertTrue(SqliteCache.has(out1.hash))
-        self.assertTrue(SqliteCache.has(out1.parent_pipeline_future.hash))
+        self.assertTrue(self.cache.has(out1.hash))
+        self.assertTrue(self.cache.has(out1.parent_pipeline_future.hash))
 
     def test_pipeline_cache_invalidation(self):
         # Test that a cached pipeline out is removed/recalculated if it contains a future which has not been evaled/cached
@@ -335,6 +889,257 @@ class TestCache(TestCaseWithMerklRepo):
         out = my_pipeline()
         self.assertFalse(called)
 
+    def test_prefetch(self):
+        barrier = threading.Barrier(2, timeout=2)
+
+        class BarrierSerializer:
+            """ Loading only succeeds if both values are loaded at the same time """
+            @classmethod
+            def dumps(cls, val):
+                return pickle.dumps(val)
+
+            @classmethod
+            def loads(cls, data):
+                barrier.wait()
+                return pickle.loads(data)
+
+        @task(serializer=BarrierSerializer)
+        def load(arg):
+            return arg
+
+        @task
+        def combine(a, b, c):
+            return a + b + c
+
+        calls = 0
+
+        @task
+        def not_cached():
+            nonlocal calls
+            calls += 1
+            return 3
+
+        load(1).eval()
+        load(2).eval()
+        self.assertEqual(combine(load(1), load(2), not_cached()).eval(), 6)
+
+        # Without prefetching, the values are loaded one at a time
+        barrier.reset()
+        orig_workers, merkl.future.PREFETCH_WORKERS = merkl.future.PREFETCH_WORKERS, 0
+        try:
+            with self.assertRaises(threading.BrokenBarrierError):
+                combine(load(2), load(1), not_cached()).eval()
+        finally:
+            merkl.future.PREFETCH_WORKERS = orig_workers
+
+    def test_parallel_sibling_writes(self):
+        barrier = threading.Barrier(2, timeout=2)
+
+        class BarrierSerializer:
+            """ Serializing the siblings only succeeds if both are serialized at the same time """
+            @classmethod
+            def dumps(cls, val):
+                if val != 'out':
+                    barrier.wait()
+                return pickle.dumps(val)
+
+            @classmethod
+            def loads(cls, data):
+                return pickle.loads(data)
+
+        @task(outs=3, serializer=BarrierSerializer)
+        def multi_out(arg):
+            return 'out', f'sibling1-{arg}', f'sibling2-{arg}'
+
+        outs = multi_out(1)
+        self.assertEqual(outs[0].eval(), 'out')
+        # The sibling writes joined the transaction of the call, which has been written when eval returns
+        for out in outs:
+            self.assertTrue(out.in_cache())
+        self.assertEqual(self.cache.get_module_function(outs[1].hash), outs[1].fn_descriptive_name)
+
+        # Without workers, the siblings are serialized one at a time
+        barrier.reset()
+        orig_workers, merkl.future.SIBLING_WRITE_WORKERS = merkl.future.SIBLING_WRITE_WORKERS, 0
+        try:
+            with self.assertRaises(threading.BrokenBarrierError):
+                multi_out(2)[0].eval()
+        finally:
+            merkl.future.SIBLING_WRITE_WORKERS = orig_workers
+
+    def test_write_behind(self):
+        written = threading.Event()
+        release = threading.Event()
+
+        class BlockingSerializer:
+            """ Serializing waits until released, like a slow dump of a large value """
+            @classmethod
+            def dumps(cls, val):
+                release.wait(timeout=5)
+                if val == 'fail':
+                    raise SerializationError('failed')
+                written.set()
+                return pickle.dumps(val)
+
+            @classmethod
+            def loads(cls, data):
+                return pickle.loads(data)
+
+        calls = 0
+
+        @task(serializer=BlockingSerializer, write_behind=True)
+        def produce(arg):
+            nonlocal calls
+            calls += 1
+            return arg
+
+        @task
+        def consume(val):
+            return val + '!'
+
+        out = consume(produce('a'))
+        # The downstream task is computed with the value in memory while it's being written
+        self.assertEqual(out.eval(), 'a!')
+        self.assertFalse(written.is_set())
+        self.assertFalse(out.parent_futures[0].in_cache())
+
+        # Until it's written, a future with the same hash gets the value from memory
+        self.assertEqual(produce('a').eval(), 'a')
+        self.assertEqual(calls, 1)
+
+        release.set()
+        merkl.future.wait_for_writes()
+        self.assertTrue(out.parent_futures[0].in_cache())
+        self.assertEqual(self.cache.get_module_function(out.parent_futures[0].hash), out.parent_futures[0].fn_descriptive_name)
+
+        # Errors are raised when waiting for the writes
+        produce('fail').eval()
+        with self.assertRaises(SerializationError):
+            merkl.future.wait_for_writes()
+
+    def test_bundles(self):
+        num_calls = 0
+
+        @task
+        def my_task(size):
+            nonlocal num_calls
+            num_calls += 1
+            return os.urandom(size)
+
+        @task
+        def my_file_task(data):
+            nonlocal num_calls
+            num_calls += 1
+            file_out = FileRef(ext='txt')
+            with open(file_out, 'wb') as f:
+                f.write(data)
+            return file_out
+
+        @task
+        def my_dir_task(data):
+            nonlocal num_calls
+            num_calls += 1
+            dir_out = DirRef()
+            with open(dir_out.get_new_file(name='data.bin'), 'wb') as f:
+                f.write(data)
+            return dir_out
+
+        def my_pipeline():
+            small, large = my_task(10), my_task(BLOB_DB_SIZE_LIMIT_BYTES + 1)
+            return [my_file_task(small), my_dir_task(large)]
+
+        outs = [out.eval() for out in my_pipeline()]
+        small, large = my_task(10).eval(), my_task(BLOB_DB_SIZE_LIMIT_BYTES + 1).eval()
+        bundle_path = f'{get_merkl_path()}bundle.tar.gz'
+        # Values are streamed into the archive, rather than read into memory with `get`
+        with patch.object(SqliteCache, 'get', None):
+            self.assertEqual(export_bundle(my_pipeline(), bundle_path), 4)
+
+        # Refs are moved to the paths of the other cache, and their values point there
+        other_cache = SqliteCache(path=f'{get_merkl_path()}other/')
+        other_cache.create_cache()
+        self.assertEqual(import_bundle(bundle_path, other_cache), (4, 0))
+        self.assertEqual(import_bundle(bundle_path, other_cache), (0, 4))
+        for out_future in my_pipeline():
+            ref = TypedSerializer.deserialize(other_cache.get_format(out_future.hash), other_cache.get(out_future.hash))
+            self.assertTrue(ref.startswith(other_cache.merkl_path))
+            self.assertEqual(other_cache.get_ref_path(out_future.hash), (str(ref), isinstance(ref, DirRef)))
+        self.assertEqual(other_cache.get_module_function(my_task(10).hash), self.cache.get_module_function(my_task(10).hash))
+        other_cache.close()
+
+        self.cache.clear_all_except([])
+        self.assertEqual(import_bundle(bundle_path), (4, 0))
+        num_calls = 0
+        file_out, dir_out = [out.eval() for out in my_pipeline()]
+        self.assertEqual(num_calls, 0)
+        self.assertEqual((my_task(10).eval(), my_task(BLOB_DB_SIZE_LIMIT_BYTES + 1).eval()), (small, large))
+        self.assertEqual([file_out, dir_out], outs)
+        with open(file_out, 'rb') as f:
+            self.assertEqual(f.read(), small)
+        with open(dir_out.files[0], 'rb') as f:
+            self.assertEqual(f.read(), large)
+
+        # Without extraction filters, links in refs are rejected
+        link_bundle_path = f'{get_merkl_path()}link_bundle.tar'
+        with tarfile.open(link_bundle_path, 'w') as tar:
+            manifest = json.dumps({'version': 1, 'entries': 1}).encode('utf-8')
+            info = tarfile.TarInfo('merkl-bundle.json')
+            info.size = len(manifest)
+            tar.addfile(info, BytesIO(manifest))
+            info = tarfile.TarInfo(f'refs/{"f" * 64}.txt')
+            info.type = tarfile.SYMTYPE
+            info.linkname = '/tmp/merkl_link_target'
+            tar.addfile(info)
+
+        data_filter = getattr(tarfile, 'data_filter', None)
+        if data_filter is not None:
+            del tarfile.data_filter
+        try:
+            with self.assertRaises(ValueError):
+                import_bundle(link_bundle_path)
+        finally:
+            if data_filter is not None:
+                tarfile.data_filter = data_filter
+
+        # Refs are found by the names of the extracted members, not by the headers of values
+        target_path = f'{get_merkl_path()}target.txt'
+        with open(target_path, 'w') as f:
+            f.write('not to be moved')
+
+        def write_bundle(bundle_path, value_name, ref_name=None):
+            with tarfile.open(bundle_path, 'w') as tar:
+                manifest = json.dumps({'version': 1, 'entries': 1}).encode('utf-8')
+                info = tarfile.TarInfo('merkl-bundle.json')
+                info.size = len(manifest)
+                tar.addfile(info, BytesIO(manifest))
+                if ref_name is not None:
+                    info = tarfile.TarInfo(f'refs/{ref_name}')
+                    info.size = 4
+                    tar.addfile(info, BytesIO(b'data'))
+                info = tarfile.TarInfo(f'values/{value_name}')
+                info.size = 5
+                info.pax_headers = {
+                    'merkl.ref_path': '/tmp/out.txt', 'merkl.ref_is_dir': '0',
+                    'merkl.ref_name': os.path.relpath(target_path, '/tmp/some/dir/refs'),
+                }
+                tar.addfile(info, BytesIO(b'value'))
+
+        bad_bundle_path = f'{get_merkl_path()}bad_bundle.tar'
+        for value_name, ref_name in [('e' * 64, None), ('../' + 'e' * 64, None), ('e' * 63, 'e' * 63 + '.txt'), ('e' * 64, 'E' * 64)]:
+            write_bundle(bad_bundle_path, value_name, ref_name)
+            with self.assertRaises(ValueError):
+                import_bundle(bad_bundle_path)
+            self.assertTrue(os.path.exists(target_path))
+        self.assertFalse(self.cache.has('e' * 64))
+
+        write_bundle(bad_bundle_path, 'e' * 64, 'e' * 64 + '.txt')
+        self.assertEqual(import_bundle(bad_bundle_path), (1, 0))
+        self.assertTrue(os.path.exists(target_path))
+        ref_path, ref_is_dir = self.cache.get_ref_path('e' * 64)
+        self.assertFalse(ref_is_dir)
+        with open(ref_path, 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+
     def test_memory_caching(self):
         @task(cache_in_memory=True)
         def my_task(val):
@@ -345,22 +1150,68 @@ class TestCache(TestCaseWithMerklRepo):
         out.eval()
         self.assertEqual(len(MEMORY_CACHE), 1)
         self.assertEqual(MEMORY_CACHE[out.hash], 4)
+        self.assertEqual(my_task(2).eval(), 4)
+        self.assertEqual(MEMORY_CACHE.hits, 1)
+
+    def test_memory_cache_eviction(self):
+        memory_cache = MemoryCache(max_bytes=1000)
+        for hash in ['a', 'b', 'c']:
+            memory_cache.put(hash, b'x' * 400)
+        self.assertEqual(memory_cache.num_bytes, 800)
+        self.assertFalse('a' in memory_cache)  # least recently used
+
+        memory_cache.get('b')
+        memory_cache.put('d', b'x' * 400)
+        self.assertEqual(sorted(memory_cache._entries), ['b', 'd'])
+        memory_cache.put('e', b'x' * 2000)  # larger than the budget, not stored
+        self.assertFalse('e' in memory_cache)
+        self.assertIsNone(memory_cache.get('e'))
+        self.assertEqual(
+            memory_cache.get_stats(),
+            {'entries': 2, 'bytes': 800, 'hits': 1, 'misses': 1, 'evictions': 2, 'spills': 0},
+        )
+
+        # Cost-aware eviction keeps the value that was expensive for its size
+        memory_cache = MemoryCache(max_bytes=1000, policy='cost')
+        memory_cache.put('expensive', b'x' * 400, cost=10.0)
+        memory_cache.put('cheap', b'x' * 400, cost=0.1)
+        memory_cache.put('new', b'x' * 400, cost=1.0)
+        self.assertEqual(sorted(memory_cache._entries), ['expensive', 'new'])
+
+    def test_memory_cache_spill(self):
+        import dill
+        memory_cache = MemoryCache(max_bytes=1000, spill_cache=self.cache)
+        memory_cache.put('a' * 64, [1, 2, 3], size=600, serializer=dill)
+        memory_cache.put('b' * 64, [4, 5, 6], size=600, serializer=dill)
+        self.assertFalse(memory_cache.is_loaded('a' * 64))
+        self.assertTrue('a' * 64 in memory_cache)
+        self.assertEqual(memory_cache.spills, 1)
+
+        # Loaded back from the spill cache
+        self.assertEqual(memory_cache.get('a' * 64, dill), [1, 2, 3])
+        self.assertTrue(memory_cache.is_loaded('a' * 64))
+
+        memory_cache.discard('a' * 64)
+        self.assertFalse('a' * 64 in memory_cache)
+        self.assertFalse(self.cache.has('a' * 64))
+
+        self.assertGreater(estimate_size([b'x' * 1000] * 1000), 1000 * 1000)
 
     def test_stats(self):
-        SqliteCache.add('h1', b'123', fn_name='module1.function1')
-        SqliteCache.add('h2', b'12345', fn_name='module1.function1')
+        self.cache.add('h1', b'123', fn_name='module1.function1')
+        self.cache.add('h2', b'12345', fn_name='module1.function1')
 
-        SqliteCache.add('h3', b'12', fn_name='module1.function2')
-        SqliteCache.add('h4', b'1234', fn_name='module1.function2')
-        stats = SqliteCache.get_stats()
+        self.cache.add('h3', b'12', fn_name='module1.function2')
+        self.cache.add('h4', b'1234', fn_name='module1.function2')
+        stats = self.cache.get_stats()
         self.assertEqual(stats[0], ('module1.function1', 2, 3+5))
         self.assertEqual(stats[1], ('module1.function2', 2, 2+4))
 
-        self.assertEqual(SqliteCache.get_stats('module1.function1'), (2, 3+5))
+        self.assertEqual(self.cache.get_stats('module1.function1'), (2, 3+5))
 
         # Test that large blobs stored on the filesystem are counted correctly
-        SqliteCache.add('h5', b'12'*BLOB_DB_SIZE_LIMIT_BYTES, fn_name='module1.function3')
-        self.assertEqual(SqliteCache.get_stats('module1.function3'), (1, 2*BLOB_DB_SIZE_LIMIT_BYTES))
+        self.cache.add('h5', b'12'*BLOB_DB_SIZE_LIMIT_BYTES, fn_name='module1.function3')
+        self.assertEqual(self.cache.get_stats('module1.function3'), (1, 2*BLOB_DB_SIZE_LIMIT_BYTES))
 
         # Test that FileRefs returned from tasks are counted correctly
         num_bytes = 32
@@ -372,7 +1223,55 @@ class TestCache(TestCaseWithMerklRepo):
             return file_ref
 
         my_task().eval()
-        self.assertEqual(SqliteCache.get_stats('test_cache.my_task'), (1, num_bytes))
+        self.assertEqual(self.cache.get_stats('test_cache.my_task'), (1, num_bytes))
+
+    def test_auto_cache(self):
+        self.assertTrue(cache.is_worth_caching(None))
+        self.assertTrue(cache.is_worth_caching(cache.TaskStats('f', misses=1, compute_seconds=1e-6)))
+        self.assertFalse(cache.is_worth_caching(cache.TaskStats('f', misses=10, compute_seconds=1e-5, bytes_written=1000, writes=10)))
+        self.assertTrue(cache.is_worth_caching(cache.TaskStats('f', misses=10, compute_seconds=1.0, bytes_written=1000, writes=10)))
+        self.assertTrue(cache.is_worth_caching(cache.TaskStats('f', hits=10, misses=10, load_seconds=1e-6, compute_seconds=1e-4)))
+
+        @task(auto_cache=True)
+        def cheap_task(i):
+            return f'value {i}'
+
+        @task(auto_cache=True)
+        def slow_task(i):
+            time.sleep(0.01)
+            return i
+
+        cache._task_stats_snapshots.clear()
+        for i in range(cache.AUTO_CACHE_MIN_CALLS):
+            cheap_task(i).eval()
+            slow_task(i).eval()
+        self.assertEqual(self.cache.get_stats(cheap_task(0).fn_descriptive_name)[0], cache.AUTO_CACHE_MIN_CALLS)
+
+        # The decisions are made from the stats as of the first output of the process
+        cache._task_stats_snapshots.clear()
+        self.assertEqual(cheap_task(100).eval(), 'value 100')
+        self.assertEqual(slow_task(100).eval(), 100)
+        self.assertFalse(cheap_task(100).in_cache())
+        self.assertTrue(slow_task(100).in_cache())
+        self.assertEqual(self.cache.get_task_stats()[0].misses, cache.AUTO_CACHE_MIN_CALLS + 1)
+        self.assertEqual(self.cache.get_task_stats()[0].writes, cache.AUTO_CACHE_MIN_CALLS)
+        cache._task_stats_snapshots.clear()
+
+        # Calls whose outputs aren't persisted don't lower the estimated load time, which would make the function seem
+        # worth caching again, but the decision does change if calls become slower
+        def get_flip_stats():
+            return {stats.module_function: stats for stats in self.cache.get_task_stats()}['flip']
+
+        size = 10 * 1024 ** 2
+        for _ in range(cache.AUTO_CACHE_MIN_CALLS):
+            self.cache.record_stats('flip', misses=1, bytes_written=size, compute_seconds=0.01, writes=1)
+        self.assertFalse(cache.is_worth_caching(get_flip_stats()))
+        for _ in range(60):
+            self.cache.record_stats('flip', misses=1, compute_seconds=0.01)
+        self.assertFalse(cache.is_worth_caching(get_flip_stats()))
+        for _ in range(10):
+            self.cache.record_stats('flip', misses=1, compute_seconds=1.0)
+        self.assertTrue(cache.is_worth_caching(get_flip_stats()))
 
     def test_batch_stats(self):
         @task
@@ -386,9 +1285,113 @@ class TestCache(TestCaseWithMerklRepo):
         with Eval():
             my_batch_task([1,2,3])
 
-        stats = SqliteCache.get_stats()
+        stats = self.cache.get_stats()
         # Test that it's reported as coming from the single fn
         self.assertEqual(stats[0][0], 'test_cache.my_task')
 
+    def test_wal_mode(self):
+        journal_mode = list(self.cache.connect().execute('PRAGMA journal_mode'))[0][0]
+        self.assertEqual(journal_mode, 'wal')
+
+    def test_exited_thread_connections(self):
+        thread_connections = []
+
+        def connect():
+            thread_connections.append(self.cache.connect())
+
+        for _ in range(10):
+            thread = threading.Thread(target=connect)
+            thread.start()
+            thread.join()
+
+        # The connection of each exited thread is closed once the next thread connects
+        pid = os.getpid()
+        connections = [entry for entry in SqliteCache._connections if entry[0] == pid and entry[1] == self.cache.db_path]
+        self.assertLessEqual(len(connections), 2)
+        for connection in thread_connections[:-1]:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                connection.execute('SELECT 1')
+
+        thread_connections[-1].execute('SELECT 1')
+        thread = threading.Thread(target=connect)
+        thread.start()
+        thread.join()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            thread_connections[-2].execute('SELECT 1')
+
+    def test_transaction(self):
+        def _has_in_other_thread(hash):
+            result = []
+            thread = threading.Thread(target=lambda: result.append(self.cache.has(hash)))
+            thread.start()
+            thread.join()
+            return result[0]
+
+        with self.cache.transaction():
+            self.cache.add('h1', b'1')
+            self.cache.track_file('/tmp/merkl_test_file', 123, md5_hash='md5')
+            # Writes are visible within the transaction, but are not written until it exits
+            self.assertTrue(self.cache.has('h1'))
+            self.assertEqual(self.cache.get('h1'), b'1')
+            self.assertEqual(self.cache.get_file_mod_hash('/tmp/merkl_test_file', 123), ('md5', None))
+            self.assertFalse(_has_in_other_thread('h1'))
+
+            with self.cache.transaction():
+                self.cache.add('h2', b'2')
+
+            # A failing nested scope only discards its own writes, and the bytes they buffered
+            num_bytes = self.cache._pending().num_bytes
+            with self.assertRaises(KeyboardInterrupt):
+                with self.cache.transaction():
+                    self.cache.add('h3', b'3')
+                    raise KeyboardInterrupt
+
+            self.assertFalse(self.cache.has('h3'))
+            self.assertEqual(self.cache._pending().num_bytes, num_bytes)
+            self.assertFalse(_has_in_other_thread('h2'))
+
+        self.assertTrue(_has_in_other_thread('h1'))
+        self.assertTrue(_has_in_other_thread('h2'))
+        self.assertFalse(self.cache.has('h3'))
+        self.assertEqual(self.cache.get_file_mod_hash('/tmp/merkl_test_file', 123), ('md5', None))
+
+        # Everything in the outermost scope is discarded on an exception
+        with self.assertRaises(KeyboardInterrupt):
+            with self.cache.transaction():
+                self.cache.add('h4', b'4')
+                raise KeyboardInterrupt
+
+        self.assertFalse(self.cache.has('h4'))
+
+    def test_concurrent_writes(self):
+        num_workers, num_adds = 4, 50
+
+        def _add_values(worker_id):
+            for i in range(num_adds):
+                self.cache.add(f'{worker_id}-{i}', bytes(f'{worker_id}-{i}', 'utf-8'))
+                # Also add a value that all workers are competing for
+                self.cache.add('shared', b'shared')
+
+        threads = [threading.Thread(target=_add_values, args=(f'thread{i}',)) for i in range(num_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        ctx = multiprocessing.get_context('fork')
+        processes = [ctx.Process(target=_add_values, args=(f'process{i}',)) for i in range(num_workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        for worker_type in ['thread', 'process']:
+            for worker_id in range(num_workers):
+                for i in range(num_adds):
+                    self.assertEqual(self.cache.get(f'{worker_type}{worker_id}-{i}'), bytes(f'{worker_type}{worker_id}-{i}', 'utf-8'))
+
+        self.assertEqual(self.cache.get('shared'), b'shared')
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,602 @@
+import os
+import sys
+import time
+import pickle
+import socket
+import sqlite3
+import subprocess
+import http.client
+import shutil
+import unittest
+import threading
+from unittest.mock import patch
+from merkl import *
+import merkl.future
+from merkl.tests import TestCaseWithMerklRepo
+from merkl.exceptions import ReadOnlyCacheError, CacheServerError
+from merkl import cache
+from merkl.io import FileRef, DirRef
+from merkl.cache import SqliteCache, BLOB_DB_SIZE_LIMIT_BYTES, get_merkl_path
+from merkl.fs_cache import FileSystemCache
+from merkl.tiered_cache import TieredCache
+from merkl.http_cache import HttpCache, make_server
+
+
+class CacheConformanceTests:
+    """ Tests that every BaseCache backend should pass, mixed into a TestCaseWithMerklRepo per backend """
+
+    def make_cache(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        super().setUp()
+        self.backend = self.make_cache()
+        self.backend.create_cache()
+
+    def tearDown(self):
+        self.backend.close()
+        super().tearDown()
+
+    def test_add_get(self):
+        small = b'small'
+        large = os.urandom(BLOB_DB_SIZE_LIMIT_BYTES + 1)
+        self.assertFalse(self.backend.has('a' * 64))
+        self.assertIsNone(self.backend.get('a' * 64))
+
+        self.backend.add('a' * 64, small, fn_name='module.fn')
+        self.backend.add('b' * 64, large, fn_name='module.fn')
+        self.backend.add('c' * 64, b'', fn_name='module.other_fn')
+        self.assertTrue(self.backend.has('a' * 64))
+        self.assertEqual(self.backend.get('a' * 64), small)
+        self.assertEqual(self.backend.get('b' * 64), large)
+        self.assertEqual(self.backend.get('c' * 64), b'')
+
+        self.assertEqual(self.backend.get_stats('module.fn'), (2, len(small) + len(large)))
+        self.assertEqual(self.backend.get_stats('module.missing_fn'), (0, None))
+        self.assertEqual(
+            self.backend.get_stats(),
+            [('module.fn', 2, len(small) + len(large)), ('module.other_fn', 1, 0)],
+        )
+
+    def test_get_buffer(self):
+        large = os.urandom(BLOB_DB_SIZE_LIMIT_BYTES + 1)
+        text = b'compressible text ' * 10000
+        self.backend.add('a' * 64, b'small')
+        self.backend.add('b' * 64, large)
+        self.backend.add('c' * 64, text, compression='zlib')
+        self.assertEqual(bytes(self.backend.get_buffer('a' * 64)), b'small')
+        self.assertEqual(bytes(self.backend.get_buffer('c' * 64)), text)
+        self.assertIsNone(self.backend.get_buffer('d' * 64))
+
+        buffer = self.backend.get_buffer('b' * 64)
+        self.assertIsInstance(buffer, memoryview)
+        self.assertEqual(buffer, large)
+        # Still readable after the file is removed
+        self.backend.clear('b' * 64)
+        self.assertEqual(buffer, large)
+
+    def test_compression(self):
+        text = b'compressible text ' * 10000
+        noise = os.urandom(10000)
+        for i, compression in enumerate(['zlib', 'lzma', 'bz2', 'auto', None]):
+            self.backend.add(f'{i:064x}', text, compression=compression, fn_name='module.fn')
+            self.assertEqual(self.backend.get(f'{i:064x}'), text)
+            self.backend.add(f'{i + 10:064x}', noise, compression=compression)
+            self.assertEqual(self.backend.get(f'{i + 10:064x}'), noise)
+
+        # Stats are for the uncompressed size
+        self.assertEqual(self.backend.get_stats('module.fn'), (5, 5 * len(text)))
+
+    def test_clear(self):
+        large = os.urandom(BLOB_DB_SIZE_LIMIT_BYTES + 1)
+        for hash in ['a' * 64, 'b' * 64, 'c' * 64]:
+            self.backend.add(hash, large, fn_name='module.fn')
+        self.backend.add('d' * 64, b'value', fn_name='module.other_fn')
+
+        self.backend.clear('a' * 64)
+        self.assertFalse(self.backend.has('a' * 64))
+        self.assertIsNone(self.backend.get('a' * 64))
+        self.backend.clear('a' * 64)  # clearing a missing hash is a no-op
+
+        self.backend.clear_all_except(['b' * 64, 'd' * 64])
+        self.assertFalse(self.backend.has('c' * 64))
+        self.assertEqual(self.backend.get('b' * 64), large)
+
+        self.backend.clear_module_function('module.fn')
+        self.assertFalse(self.backend.has('b' * 64))
+        self.assertTrue(self.backend.has('d' * 64))
+        self.assertEqual(self.backend.get_stats(), [('module.other_fn', 1, 5)])
+
+    def test_refs(self):
+        file_path = '/tmp/merkl_backend_test.txt'
+        with open(file_path, 'w') as f:
+            f.write('test')
+
+        ref = self.backend.transfer_ref(FileRef(file_path), 'a' * 64)
+        self.backend.add('a' * 64, pickle.dumps(ref), ref=ref, fn_name='module.fn')
+        self.assertNotEqual(ref, file_path)
+        self.assertTrue(ref.endswith('.txt'))
+        self.assertTrue(os.path.exists(file_path))
+        with open(ref) as f:
+            self.assertEqual(f.read(), 'test')
+        self.assertEqual(self.backend.get_stats('module.fn'), (1, 4))
+
+        dir_path = '/tmp/merkl_backend_test_dir/'
+        os.makedirs(dir_path, exist_ok=True)
+        with open(f'{dir_path}file.txt', 'w') as f:
+            f.write('test')
+
+        dir_ref = self.backend.transfer_ref(DirRef(dir_path, rm_after_caching=True), 'b' * 64)
+        self.backend.add('b' * 64, pickle.dumps(dir_ref), ref=dir_ref, fn_name='module.fn')
+        self.assertFalse(os.path.exists(dir_path))
+        self.assertTrue(os.path.exists(f'{dir_ref}file.txt'))
+
+        self.backend.clear('a' * 64)
+        self.backend.clear('b' * 64)
+        self.assertFalse(os.path.exists(ref))
+        self.assertFalse(os.path.exists(dir_ref))
+        os.remove(file_path)
+
+    def test_track_file(self):
+        path = '/tmp/merkl_backend_test.txt'
+        with open(path, 'w') as f:
+            f.write('test')
+
+        self.assertEqual(self.backend.get_file_mod_hash(path), (None, None))
+        self.assertEqual(self.backend.get_latest_file(path), (None, None, None))
+        self.assertFalse(self.backend.has_file('md5'))
+
+        self.backend.track_file(path, 1.0, md5_hash='md5_old')
+        self.backend.track_file(path, 2.5, merkl_hash='merkl', md5_hash='md5')
+        self.assertEqual(self.backend.get_file_mod_hash(path, 1.0), ('md5_old', None))
+        self.assertEqual(self.backend.get_file_mod_hash(path, 2.5), ('md5', 'merkl'))
+        self.assertEqual(self.backend.get_latest_file(path), ('md5', 'merkl', 2.5))
+        self.assertTrue(self.backend.has_file('md5'))
+
+        # Tracking without a modified time uses the file's
+        self.backend.track_file(path, md5_hash='md5_new')
+        self.assertEqual(self.backend.get_file_mod_hash(path), ('md5_new', None))
+        os.remove(path)
+
+    def test_transaction(self):
+        with self.backend.transaction():
+            self.backend.add('a' * 64, b'value')
+            self.assertEqual(self.backend.get('a' * 64), b'value')
+        self.assertEqual(self.backend.get('a' * 64), b'value')
+
+    def test_concurrent_writes(self):
+        def write(i):
+            for j in range(20):
+                self.backend.add(f'{i:032x}{j:032x}', bytes(f'{i}-{j}', 'utf-8'), fn_name='module.fn')
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.backend.get_stats('module.fn')[0], 80)
+        self.assertEqual(self.backend.get(f'{3:032x}{19:032x}'), b'3-19')
+
+    def test_task(self):
+        calls = 0
+
+        @task(cache=self.backend)
+        def task1(arg):
+            nonlocal calls
+            calls += 1
+            return arg * 2
+
+        self.assertEqual(task1(2).eval(), 4)
+        self.assertEqual(task1(2).eval(), 4)
+        self.assertEqual(calls, 1)
+        self.assertTrue(task1(2).in_cache())
+        self.assertTrue(self.backend.has(task1(2).hash))
+
+        # Backends are pickled along with futures
+        backend = pickle.loads(pickle.dumps(self.backend))
+        self.assertEqual(backend.get(task1(2).hash), self.backend.get(task1(2).hash))
+
+
+class TestSqliteCache(CacheConformanceTests, TestCaseWithMerklRepo):
+    def make_cache(self):
+        return SqliteCache()
+
+
+class TestFileSystemCache(CacheConformanceTests, TestCaseWithMerklRepo):
+    def make_cache(self):
+        return FileSystemCache()
+
+    def set_access_time(self, hash, access_time):
+        os.utime(self.backend._sharded_path('values', hash), (access_time, access_time))
+
+    def test_gc(self):
+        now = time.time()
+        for i, hash in enumerate(['a' * 64, 'b' * 64, 'c' * 64]):
+            self.backend.add(hash, b'x' * 100)
+            self.set_access_time(hash, now - 1000 + i)
+        entry_size = os.stat(self.backend._sharded_path('values', 'a' * 64)).st_size
+        self.assertEqual(self.backend.gc(), (0, 0))
+        self.assertEqual(self.backend.gc(max_bytes=entry_size, dry_run=True), (2, 2 * entry_size))
+        self.assertTrue(self.backend.has('a' * 64))
+
+        # Reads count as accesses, so 'a' is now the most recently used. 'b' is pinned
+        self.backend.get('a' * 64)
+        self.backend.pin('my_pipeline', ['b' * 64])
+        self.assertEqual(self.backend.get_pins(), [('my_pipeline', 1)])
+        self.assertEqual(self.backend.gc(max_bytes=2 * entry_size), (1, entry_size))
+        self.assertFalse(self.backend.has('c' * 64))
+        self.assertTrue(self.backend.has('a' * 64))
+
+        # Entries not accessed within max_age are evicted regardless of size, unless pinned
+        self.assertEqual(self.backend.gc(max_age=60)[0], 0)
+        self.backend.unpin('my_pipeline')
+        self.assertEqual(self.backend.get_pins(), [])
+        self.assertEqual(self.backend.gc(max_age=60)[0], 1)
+        self.assertFalse(self.backend.has('b' * 64))
+        self.assertEqual(self.backend.repack(), (0, 0))
+
+    def test_sweep_orphans(self):
+        ref_path = self.backend.get_ref_file_path('a' * 64, 'txt')
+        with open(ref_path, 'w') as f:
+            f.write('ref')
+        self.backend.add('a' * 64, b'value', ref=ref_path)
+        orphan_ref = self.backend.get_ref_file_path('b' * 64, 'txt')
+        with open(orphan_ref, 'w') as f:
+            f.write('orphan')
+        orphan_dir = self.backend.get_ref_dir_path('c' * 64)
+        os.makedirs(orphan_dir)
+        with open(f'{orphan_dir}file.txt', 'w') as f:
+            f.write('orphan')
+        with open(f'{self.backend.root}tmp/interrupted', 'w') as f:
+            f.write('tmp')
+
+        # A ref with an old modification time that was just moved into the cache, whose value is not yet added
+        moved_path = f'{get_merkl_path()}moved.txt'
+        with open(moved_path, 'w') as f:
+            f.write('moved')
+        old_time = time.time() - 2 * cache.ORPHAN_MIN_AGE
+        os.utime(moved_path, (old_time, old_time))
+        moved_ref = self.backend.transfer_ref(FileRef(moved_path), 'd' * 64)
+        self.assertLess(os.stat(moved_ref).st_mtime, old_time + 1)
+
+        # Recently changed files may belong to writes in progress
+        self.assertEqual(self.backend.sweep_orphans(), (0, 0))
+        self.assertTrue(os.path.exists(moved_ref))
+
+        with patch.object(cache, 'ORPHAN_MIN_AGE', -1):
+            self.assertEqual(self.backend.sweep_orphans(dry_run=True), (4, 20))
+            self.assertEqual(self.backend.sweep_orphans(), (4, 20))
+        self.assertFalse(os.path.exists(orphan_ref))
+        self.assertFalse(os.path.exists(orphan_dir))
+        self.assertFalse(os.path.exists(moved_ref))
+        self.assertTrue(self.backend.has('a' * 64))
+        self.assertTrue(os.path.exists(ref_path))
+
+
+class TestTieredCache(CacheConformanceTests, TestCaseWithMerklRepo):
+    def make_cache(self):
+        return TieredCache([SqliteCache(), FileSystemCache()], memory_max_bytes=1024 ** 2)
+
+    def test_read_through(self):
+        local, shared = self.backend.tiers
+        shared.add('a' * 64, b'value', fn_name='module.fn')
+        self.assertFalse(local.has('a' * 64))
+        self.assertTrue(self.backend.has('a' * 64))
+
+        # Hits in the shared tier are promoted to the local tier and memory
+        self.assertEqual(self.backend.get('a' * 64), b'value')
+        self.assertEqual(local.get('a' * 64), b'value')
+        self.assertEqual(local.get_stats('module.fn'), (1, 5))
+        self.assertTrue(self.backend.memory.is_loaded('a' * 64))
+
+        # Writes go through to all tiers
+        self.backend.add('b' * 64, b'other')
+        self.assertEqual(shared.get('b' * 64), b'other')
+
+        # Clearing only applies to the local tier, the shared one is used by others. Cleared values aren't read back
+        self.backend.clear('a' * 64)
+        self.assertFalse(self.backend.has('a' * 64))
+        self.assertIsNone(self.backend.get('a' * 64))
+        self.assertTrue(shared.has('a' * 64))
+        self.assertFalse(local.has('a' * 64))
+        self.backend.add('a' * 64, b'value')
+        self.assertTrue(self.backend.has('a' * 64))
+
+        shared.add('c' * 64, b'value', fn_name='module.fn')
+        shared.add('d' * 64, b'value', fn_name='module.other_fn')
+        self.backend.clear_module_function('module.fn')
+        self.assertEqual(self.backend.has_many(['a' * 64, 'c' * 64, 'd' * 64]), {'a' * 64, 'd' * 64})
+        self.backend.clear_all_except(['c' * 64])
+        self.assertEqual(self.backend.has_many(['a' * 64, 'b' * 64, 'c' * 64, 'd' * 64]), set())
+        self.assertTrue(shared.has('d' * 64))
+
+        clearing = TieredCache(self.backend.tiers, clear_shared=True)
+        clearing.clear('d' * 64)
+        self.assertFalse(shared.has('d' * 64))
+
+    def test_promote_compressed(self):
+        local, shared = self.backend.tiers
+        text = b'compressible text ' * 1000
+        shared.add('a' * 64, text, compression='zlib')
+        self.assertEqual(self.backend.get('a' * 64), text)
+        self.assertEqual(local.get_codec('a' * 64), 'zlib')
+        self.assertEqual(self.backend.get_codec('a' * 64), 'zlib')
+
+    def test_unavailable_tier(self):
+        self.backend.tiers[1] = FileSystemCache('/dev/null/merkl/')
+        self.backend.add('a' * 64, b'value')
+        self.assertEqual(self.backend.get('a' * 64), b'value')
+        self.assertFalse(self.backend.has('b' * 64))
+        self.assertIsNone(self.backend.get('b' * 64))
+
+    def test_failing_tier(self):
+        shared = self.backend.tiers[1]
+        for error in [http.client.RemoteDisconnected('closed'), sqlite3.OperationalError('disk I/O error')]:
+            def fail(*args, **kwargs):
+                raise error
+            with patch.object(shared, 'get', fail), patch.object(shared, 'has', fail):
+                self.assertFalse(self.backend.has('b' * 64))
+                self.assertIsNone(self.backend.get('b' * 64))
+
+        # Reads that hang are abandoned, and the tier is skipped for a while
+        self.backend.timeout = 0.1
+        release = threading.Event()
+        with patch.object(shared, 'has', lambda hash: release.wait()):
+            start = time.time()
+            self.assertFalse(self.backend.has('b' * 64))
+            self.assertFalse(self.backend.has('b' * 64))
+            self.assertLess(time.time() - start, 1)
+            release.set()
+
+
+class TestOverlayCache(CacheConformanceTests, TestCaseWithMerklRepo):
+    def make_cache(self):
+        base = SqliteCache('/tmp/.merkl/base/')
+        base.create_cache()
+        base.add('e' * 64, b'base value', fn_name='module.fn')
+        base.add('f' * 64, os.urandom(BLOB_DB_SIZE_LIMIT_BYTES + 1))
+        base.close()
+        return TieredCache([SqliteCache(), SqliteCache('/tmp/.merkl/base/', immutable=True)], promote=False)
+
+    def test_overlay(self):
+        overlay, base = self.backend.tiers
+        self.assertEqual(self.backend.get('e' * 64), b'base value')
+        self.assertEqual(len(self.backend.get_buffer('f' * 64)), BLOB_DB_SIZE_LIMIT_BYTES + 1)
+        self.assertEqual(self.backend.get_module_function('e' * 64), 'module.fn')
+        self.assertFalse(overlay.has('e' * 64))
+
+        # Writes and clears only go to the overlay
+        self.backend.add('g' * 64, b'value')
+        self.assertTrue(overlay.has('g' * 64))
+        self.assertFalse(base.has('g' * 64))
+        self.backend.clear('e' * 64)
+        self.assertTrue(base.has('e' * 64))
+
+        with self.assertRaises(ReadOnlyCacheError):
+            base.add('h' * 64, b'value')
+        with self.assertRaises(ReadOnlyCacheError):
+            base.clear('e' * 64)
+        self.assertEqual(base.get_task_stats(), [])
+
+
+class HttpServerMixin:
+    """ Runs the reference cache server in a thread, with an empty store for each test """
+    server_path = '/tmp/merkl_http_cache_test/'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = make_server(cls.server_path, port=0)
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.server_path, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        shutil.rmtree(self.server_path, ignore_errors=True)
+        self.server.RequestHandlerClass.cache.create_cache()
+        super().setUp()
+
+
+class TestTieredHttpCache(HttpServerMixin, CacheConformanceTests, TestCaseWithMerklRepo):
+    def make_cache(self):
+        return TieredCache([SqliteCache(), HttpCache(self.url)])
+
+
+class TestHttpCache(HttpServerMixin, TestCaseWithMerklRepo):
+    def setUp(self):
+        super().setUp()
+        self.backend = HttpCache(self.url, compression='zlib')
+
+    def tearDown(self):
+        self.backend.close()
+        super().tearDown()
+
+    def test_add_get(self):
+        text = b'compressible text ' * 10000
+        self.assertFalse(self.backend.has('a' * 64))
+        self.backend.add('a' * 64, text, fn_name='module.fn')
+        self.assertTrue(self.backend.has('a' * 64))
+        self.assertEqual(self.backend.get('a' * 64), text)
+        self.assertIsNone(self.backend.get('b' * 64))
+        self.assertEqual(self.backend.get_module_function('a' * 64), 'module.fn')
+        self.assertEqual(self.backend.get_stats(), [('module.fn', 1, len(text))])
+
+        # Stored compressed by the client
+        header, data = self.server.RequestHandlerClass.cache.get_raw('a' * 64)
+        self.assertEqual(header['codec'], 'zlib')
+        self.assertLess(len(data), len(text))
+
+        self.backend.clear('a' * 64)
+        self.assertFalse(self.backend.has('a' * 64))
+
+        with self.assertRaises(ValueError):
+            self.backend.add('c' * 64, b'', ref=FileRef('/tmp/file.txt'))
+
+    def test_bulk(self):
+        hashes = [f'{i:064x}' for i in range(25)]
+        with self.backend.transaction():
+            for hash in hashes[:20]:
+                self.backend.add(hash, bytes(hash, 'utf-8'))
+            self.assertTrue(self.backend.has(hashes[0]))
+            self.assertFalse(self.server.RequestHandlerClass.cache.has(hashes[0]))
+
+        self.assertEqual(self.backend.has_many(hashes), set(hashes[:20]))
+
+        # Answers of has_many are remembered for has
+        self.server.RequestHandlerClass.cache.clear(hashes[0])
+        self.assertTrue(self.backend.has(hashes[0]))
+        self.backend.has_ttl = 0
+        self.assertFalse(self.backend.has(hashes[0]))
+
+        # Expired answers are dropped, and at most HAS_RESULTS_MAX_ENTRIES are kept
+        self.assertEqual(len(self.backend._has_results), 0)
+        self.backend.has_ttl = 60
+        with patch('merkl.http_cache.HAS_RESULTS_MAX_ENTRIES', 10):
+            self.assertEqual(self.backend.has_many(hashes), set(hashes[1:20]))
+            # The missing hashes were the last answers
+            self.assertEqual(len(self.backend._has_results), 10)
+            self.assertLessEqual(set(hashes[20:]), set(self.backend._has_results))
+
+    def test_get_many(self):
+        hashes = [f'{i:064x}' for i in range(250)]
+        for hash in hashes[:200]:
+            self.backend.add(hash, bytes(hash, 'utf-8') * 100, fn_name='module.fn', format='bytes')
+
+        backend = HttpCache(self.url)
+        with patch.object(backend, '_request', wraps=backend._request) as request:
+            self.assertEqual(backend.get_many(hashes), {hash: bytes(hash, 'utf-8') * 100 for hash in hashes[:200]})
+            # Split into chunks, and the metadata of the values is remembered
+            self.assertEqual([call.args[:2] for call in request.call_args_list], [('POST', '/get')] * 3)
+            self.assertTrue(backend.has(hashes[0]))
+            self.assertFalse(backend.has(hashes[-1]))
+            self.assertEqual(backend.get_format(hashes[0]), 'bytes')
+            self.assertEqual(backend.get_codec(hashes[0]), 'zlib')
+            self.assertEqual(backend.get_module_function(hashes[0]), 'module.fn')
+            self.assertEqual(request.call_count, 3)
+        backend.close()
+
+    def test_prefetch_get_many(self):
+        calls = 0
+
+        def make_task(cache):
+            @task(cache=cache)
+            def task1(arg):
+                nonlocal calls
+                calls += 1
+                return arg * 2
+            return task1
+
+        from merkl.utils import evaluate_futures
+        task1 = make_task(TieredCache([SqliteCache(), self.backend]))
+        self.assertEqual(evaluate_futures([task1(i) for i in range(10)], no_cache=False), [2 * i for i in range(10)])
+
+        # Read by another machine, which only has the shared tier
+        SqliteCache().clear_all_except([])
+        backend = HttpCache(self.url)
+        task1 = make_task(TieredCache([SqliteCache(), backend]))
+        with patch.object(backend, '_request', wraps=backend._request) as request:
+            self.assertEqual(evaluate_futures([task1(i) for i in range(10)], no_cache=False), [2 * i for i in range(10)])
+        self.assertEqual(calls, 10)
+        # The values and their metadata are fetched and promoted without a request per value
+        self.assertEqual([call.args[:2] for call in request.call_args_list], [('POST', '/has'), ('POST', '/get')])
+        self.assertEqual(SqliteCache().has_many([task1(i).hash for i in range(10)]), {task1(i).hash for i in range(10)})
+        backend.close()
+
+    def test_batched_uploads(self):
+        @task(outs=3, cache=self.backend)
+        def multi_out(arg):
+            return arg, arg + 1, arg + 2
+
+        @task(cache=self.backend, write_behind=True)
+        def write_behind(arg):
+            return arg
+
+        # The outputs cached by the sibling writer threads join the upload of the call
+        with patch.object(self.backend, '_upload', wraps=self.backend._upload) as upload:
+            self.assertEqual(multi_out(1)[0].eval(), 1)
+        self.assertEqual([len(call.args[0]) for call in upload.call_args_list], [3])
+
+        # As do the values that queue up for the write-behind thread
+        release = threading.Event()
+        merkl.future.get_write_behind_queue().submit(lambda: release.wait(timeout=5))
+        with patch.object(self.backend, '_upload', wraps=self.backend._upload) as upload:
+            self.assertEqual([write_behind(i).eval() for i in range(3)], [0, 1, 2])
+            release.set()
+            merkl.future.wait_for_writes()
+        self.assertEqual([len(call.args[0]) for call in upload.call_args_list], [3])
+        self.assertEqual(self.backend.has_many([write_behind(i).hash for i in range(3)]), {write_behind(i).hash for i in range(3)})
+
+    def test_reconnect(self):
+        self.backend.add('a' * 64, b'value')
+        # Close the idle pooled connections from the server side
+        for connection in self.backend.pool._idle:
+            connection.sock.close()
+        self.assertEqual(self.backend.get('a' * 64), b'value')
+
+        backend = pickle.loads(pickle.dumps(self.backend))
+        self.assertEqual(backend.get('a' * 64), b'value')
+        backend.close()
+
+    def test_server_killed(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'merkl', 'cache', 'serve', '--path', f'{self.server_path}killed/', '--port', str(port)],
+            cwd='/tmp',
+            env={**os.environ, 'PYTHONPATH': os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))},
+        )
+        try:
+            backend = HttpCache(f'http://127.0.0.1:{port}/', has_ttl=0)
+            for _ in range(100):
+                try:
+                    self.assertFalse(backend.has('a' * 64))
+                    break
+                except CacheServerError:
+                    time.sleep(0.1)
+            else:
+                self.fail('The cache server did not start')
+        finally:
+            server.kill()
+            server.wait()
+
+        # The pooled connection fails, and the one retry on a new connection can't connect
+        errors = []
+
+        def check_has():
+            try:
+                backend.has('a' * 64)
+            except CacheServerError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=check_has, daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(backend.pool._idle, [])
+        backend.close()
+
+    def test_prefetch_has(self):
+        cache = TieredCache([SqliteCache(), self.backend])
+        calls = 0
+
+        @task(cache=cache)
+        def task1(arg):
+            nonlocal calls
+            calls += 1
+            return arg * 2
+
+        from merkl.utils import evaluate_futures
+        self.assertEqual(evaluate_futures([task1(1), task1(2)], no_cache=False), [2, 4])
+        SqliteCache().clear_all_except([])
+        self.assertEqual(evaluate_futures([task1(1), task1(2)], no_cache=False), [2, 4])
+        self.assertEqual(calls, 2)
@@ -13,6 +13,7 @@ from merkl import *
 from merkl.tests import TestCaseWithMerklRepo
 from merkl.utils import get_hash_memory_optimized
 from merkl.io import migrate_output_files
+from merkl.transfer import transfer_file, transfer_dir
 
 
 class TestIO(TestCaseWithMerklRepo):
@@ -200,5 +201,60 @@ class TestIO(TestCaseWithMerklRepo):
         migrated_files = migrate_output_files(out, '/tmp/other_tmpfile.*')
         self.assertEqual(len(migrated_files), 0)
 
+    def test_transfer(self):
+        copy_path = '/tmp/tmpfile_copy.txt'
+        self.addCleanup(lambda: os.path.exists(copy_path) and os.remove(copy_path))
+
+        self.assertEqual(transfer_file(self.tmp_file, copy_path, 'hardlink'), 'hardlink')
+        self.assertTrue(os.path.samefile(self.tmp_file, copy_path))
+
+        # Replaces the destination, and never links unless asked to
+        self.assertIn(transfer_file(self.tmp_file, copy_path), ['reflink', 'copy'])
+        self.assertFalse(os.path.samefile(self.tmp_file, copy_path))
+        with open(copy_path) as f:
+            self.assertEqual(f.read(), 'hello world')
+
+        # Nor when falling back from renaming, which isn't possible if the source is kept
+        os.remove(copy_path)
+        self.assertIn(transfer_file(self.tmp_file, copy_path, 'rename'), ['reflink', 'copy'])
+        self.assertFalse(os.path.samefile(self.tmp_file, copy_path))
+        self.assertTrue(os.path.exists(self.tmp_file))
+
+        # Falls back to the next strategy, e.g. across file systems
+        with patch('os.link', side_effect=OSError(18, 'Invalid cross-device link')):
+            self.assertIn(transfer_file(self.tmp_file, copy_path, 'hardlink'), ['reflink', 'copy'])
+
+        self.assertEqual(transfer_file(copy_path, self.tmp_file2, move=True), 'rename')
+        self.assertFalse(os.path.exists(copy_path))
+
+        src_dir, dst_dir = '/tmp/merkl_transfer_src/', '/tmp/merkl_transfer_dst/'
+        for path in [src_dir, dst_dir]:
+            shutil.rmtree(path, ignore_errors=True)
+            self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+
+        os.makedirs(f'{src_dir}sub/empty/')
+        for i in range(20):
+            with open(f'{src_dir}sub/{i}.txt', 'w') as f:
+                f.write(str(i))
+
+        self.assertEqual(transfer_dir(src_dir, dst_dir, 'copy'), 'copy')
+        self.assertTrue(os.path.exists(f'{src_dir}sub/0.txt'))
+        self.assertTrue(os.path.isdir(f'{dst_dir}sub/empty/'))
+        for i in range(20):
+            with open(f'{dst_dir}sub/{i}.txt') as f:
+                self.assertEqual(f.read(), str(i))
+
+        # A task's FileRef output is linked into the cache
+        @task(transfer='hardlink')
+        def my_task():
+            return FileRef(self.tmp_file)
+
+        self.assertTrue(os.path.samefile(my_task().eval(), self.tmp_file))
+
+        with self.assertRaises(ValueError):
+            @task(transfer='teleport')
+            def my_task():
+                return 1
+
 if __name__ == '__main__':
     unittest.main()
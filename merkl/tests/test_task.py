@@ -1,5 +1,9 @@
+import os
 import sys
 import json
+import subprocess
+import math
+import types
 import unittest
 from io import StringIO
 
@@ -11,7 +15,8 @@ from merkl.tests import TestCaseWithMerklRepo
 from merkl.future import Future
 from merkl.task import task, batch, pipeline, HashMode
 from merkl.exceptions import *
-from merkl.utils import get_hash_memory_optimized, Eval
+from merkl.utils import get_hash_memory_optimized, find_function_deps, Eval
+from merkl.stdlib_modules import STDLIB_MODULES, _FALLBACK_STDLIB_MODULES
 from merkl.io import FileRef, DirRef
 
 
@@ -291,6 +296,52 @@ class TestTask(TestCaseWithMerklRepo):
         self.assertEqual(len(my_pipeline.deps), 2+2)  # +2 is function name and code hash
         self.assertEqual(my_pipeline.deps[1], 'test_dep')
 
+    def test_stdlib_modules(self):
+        # Modules that are not in the standard library, like a user package named `lib`, are dependencies
+        lib = types.ModuleType('lib')
+        exec('def lib_fn():\n    return 1', lib.__dict__)
+        sys.modules['lib'] = lib
+        try:
+            globals()['lib_fn'] = lib.lib_fn
+
+            def uses_lib():
+                return lib_fn() + math.floor(1.5)
+
+            deps = [name for name, _ in find_function_deps(uses_lib)]
+            self.assertEqual(deps, ['lib_fn'])
+        finally:
+            del sys.modules['lib']
+            del globals()['lib_fn']
+
+        self.assertTrue({'os', 'sqlite3', 'concurrent'} <= STDLIB_MODULES)
+        self.assertNotIn('lib', STDLIB_MODULES)
+
+        if not hasattr(sys, 'stdlib_module_names'):
+            return
+
+        # The names listed for Pythons without `sys.stdlib_module_names` are standard library modules, or were until
+        # they were removed. Private test modules are left out of `sys.stdlib_module_names`
+        removed = {
+            'binhex', 'dummy_threading', 'formatter', 'fpectl', 'macpath', 'macurl2path', 'parser', 'symbol',
+            'asynchat', 'asyncore', 'distutils', 'imp', 'smtpd', 'aifc', 'audioop', 'cgi', 'cgitb', 'chunk', 'crypt',
+            'imghdr', 'lib2to3', 'mailcap', 'msilib', 'nis', 'nntplib', 'ossaudiodev', 'pipes', 'sndhdr', 'spwd',
+            'sunau', 'telnetlib', 'uu', 'xdrlib', 'test', 'xxlimited', 'xxsubtype',
+        }
+        unknown = {
+            name for name in _FALLBACK_STDLIB_MODULES - sys.stdlib_module_names
+            if not name.startswith('_') and name not in removed
+        }
+        self.assertEqual(unknown, set())
+
+    def test_lazy_imports(self):
+        # The benchmark fails if `import merkl` or `merkl cache` import any of its LAZY_MODULES
+        benchmark = os.path.join(os.path.dirname(merkl.__file__), '..', 'benchmarks', 'importtime.py')
+        if not os.path.exists(benchmark):
+            self.skipTest('benchmarks are not installed')
+
+        proc = subprocess.run([sys.executable, benchmark, '--repeat', '1', '--top', '0'], capture_output=True, text=True)
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+
     def test_future_operator_access(self):
         # Test that Future cannot be accessed by checking some operators
         future = embed_bert('sentence')
@@ -0,0 +1,384 @@
+import os
+import time
+import sqlite3
+import contextvars
+from contextlib import contextmanager, ExitStack
+
+from merkl.cache import BaseCache
+from merkl.logger import logger, short_hash
+from merkl.memory_cache import MemoryCache
+
+# Reads from the slower tiers of a TieredCache are abandoned after TIER_TIMEOUT seconds and treated as misses, and the
+# tier is then skipped for TIER_RETRY_SECONDS, so that a hanging network file system or server doesn't stall every read
+TIER_TIMEOUT = 30
+TIER_RETRY_SECONDS = 60
+TIER_READ_WORKERS = 8
+
+
+def _tier_errors():
+    """ Errors of the slower tiers that are treated as misses. Imported once a call fails, since http.client and
+    concurrent.futures are slow to import """
+    import http.client
+    # NOTE: OSError includes socket timeouts and the CacheServerError of HttpCache
+    return (OSError, http.client.HTTPException, sqlite3.Error) + _timeout_errors()
+
+
+def _timeout_errors():
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+    return (TimeoutError, FutureTimeoutError)
+
+
+class TieredCache(BaseCache):
+    """ Cache backend that reads through a list of backends, fastest first, e.g. the local SqliteCache followed by a
+    FileSystemCache on a network mounted directory shared by a team or CI runners:
+
+        TieredCache([SqliteCache(), FileSystemCache('/mnt/shared/merkl/')])
+
+    Values found in a slower tier are promoted to the faster tiers, and values are written through to all tiers. If
+    `memory_max_bytes` is set, values that are read are also kept in memory in front of the other tiers (deserialized
+    values of tasks with `cache_in_memory=True` are kept in MEMORY_CACHE regardless).
+
+    The first tier is the local cache. It alone stores FileRef/DirRef outputs, since their serialized value is the path,
+    and it alone is affected by `gc` and pins, which manage local disk usage. Clearing also only applies to the local
+    tier, since the slower tiers are usually shared with others, unless `clear_shared` is set. Values cleared locally
+    are no longer read from the slower tiers by this cache until they are added again, so that they aren't promoted
+    back. Errors from the slower tiers, such as an unreachable file system or server, are logged and treated as misses,
+    and reads from them that take longer than `timeout` seconds are abandoned, see TIER_TIMEOUT. Reads then run in a
+    thread pool, set `timeout=None` to call the tiers directly.
+
+    Tiers that are `read_only`, such as a nightly built team cache opened with SqliteCache(path, read_only=True), are
+    only read from. With `promote=False` values found in slower tiers are not copied into the faster ones, so that a
+    local cache is an overlay that holds only what was computed locally on top of a large read-only base:
+
+        TieredCache([SqliteCache(), SqliteCache('/mnt/shared/.merkl/', immutable=True)], promote=False)
+
+    FileRef/DirRef outputs found in the base are used from the paths they were cached at, so the base should be
+    created with an absolute path """
+
+    def __init__(self, tiers, memory_max_bytes=None, promote=True, clear_shared=False, timeout=TIER_TIMEOUT):
+        if len(tiers) == 0:
+            raise ValueError('TieredCache needs at least one tier')
+
+        self.tiers = list(tiers)
+        self.memory_max_bytes = memory_max_bytes
+        self.promote = promote
+        self.clear_shared = clear_shared
+        self.timeout = timeout
+        self._memory = None
+        # What was cleared locally, to hide from the slower tiers: cleared hashes, the hashes kept by the last
+        # `clear_all_except` (or None), cleared module functions, and the hashes added since (hash -> module function)
+        self._cleared = set()
+        self._kept = None
+        self._cleared_module_functions = set()
+        self._added = {}
+        self._init_state()
+
+    def _init_state(self):
+        self._pid = os.getpid()
+        self._executor = None
+        self._skip_until = {}  # tier index -> time until which the tier is skipped after a timeout
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for key in ['_memory', '_pid', '_executor', '_skip_until']:
+            del state[key]
+        return state
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._memory = None
+        self._init_state()
+
+    @property
+    def executor(self):
+        if self._pid != os.getpid():
+            self._init_state()  # the threads of the pool don't exist in a forked process
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(TIER_READ_WORKERS, thread_name_prefix='merkl-tiered-cache')
+        return self._executor
+
+    @property
+    def bulk_get(self):
+        return any(tier.bulk_get for tier in self.tiers)
+
+    @property
+    def writable_tiers(self):
+        return [(i, tier) for i, tier in enumerate(self.tiers) if not tier.read_only]
+
+    @property
+    def local(self):
+        return self.tiers[0]
+
+    @property
+    def memory(self):
+        if self._memory is None and self.memory_max_bytes is not None:
+            self._memory = MemoryCache(max_bytes=self.memory_max_bytes)
+        return self._memory
+
+    def _try(self, i, fn, default=None, is_read=False):
+        """ Calls `fn`, and if `i` is one of the slower tiers, logs the errors of the backends (which include network
+        errors) and returns `default` instead of raising. Reads are abandoned after `timeout` seconds """
+        if i == 0:
+            return fn()
+
+        if is_read and time.time() < self._skip_until.get(i, 0):
+            return default
+
+        try:
+            if not is_read or self.timeout is None:
+                return fn()
+            # NOTE: runs in a copy of the context, which holds the pending writes of SqliteCache transactions
+            return self.executor.submit(contextvars.copy_context().run, fn).result(timeout=self.timeout)
+        except _tier_errors() as e:
+            logger.warning(f'Cache tier {i} ({type(self.tiers[i]).__name__}) failed: {e!r}')
+            if is_read and isinstance(e, _timeout_errors()):
+                self._skip_until[i] = time.time() + TIER_RETRY_SECONDS
+            return default
+
+    def _read(self, i, fn, default=None):
+        return self._try(i, fn, default, is_read=True)
+
+    def _is_visible(self, i, hash):
+        """ Whether the value of `hash` in tier `i` may be used. The slower tiers still hold the values cleared locally,
+        which are hidden until they are added again """
+        if i == 0 or hash in self._added:
+            return True
+        if hash in self._cleared or (self._kept is not None and hash not in self._kept):
+            return False
+        if len(self._cleared_module_functions) > 0:
+            return self._read(i, lambda: self.tiers[i].get_module_function(hash)) not in self._cleared_module_functions
+        return True
+
+    @property
+    def _clear_tiers(self):
+        return self.writable_tiers if self.clear_shared else [(0, self.local)]
+
+    def create_cache(self):
+        for i, tier in enumerate(self.tiers):
+            self._try(i, tier.create_cache)
+
+    def close(self):
+        for tier in self.tiers:
+            tier.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    @contextmanager
+    def transaction(self):
+        with ExitStack() as stack:
+            for i, tier in enumerate(self.tiers):
+                stack.enter_context(self._tier_transaction(i, tier))
+            yield
+
+    @contextmanager
+    def _tier_transaction(self, i, tier):
+        """ The transaction of a tier, where the slower tiers failing to write the values when it exits is logged """
+        transaction = tier.transaction()
+        transaction.__enter__()
+        try:
+            yield
+        except BaseException as e:
+            if not transaction.__exit__(type(e), e, e.__traceback__):
+                raise
+        else:
+            self._try(i, lambda: transaction.__exit__(None, None, None))
+
+    def has(self, hash):
+        if self.memory is not None and self.memory.is_loaded(hash):
+            return True
+
+        return any(
+            self._read(i, lambda: tier.has(hash), False) and self._is_visible(i, hash)
+            for i, tier in enumerate(self.tiers)
+        )
+
+    def has_many(self, hashes):
+        present = set()
+        if self.memory is not None:
+            present = {hash for hash in hashes if self.memory.is_loaded(hash)}
+
+        remaining = set(hashes) - present
+        for i, tier in enumerate(self.tiers):
+            if len(remaining) == 0:
+                break
+            found = {hash for hash in self._read(i, lambda: tier.has_many(remaining), set()) if self._is_visible(i, hash)}
+            present |= found
+            remaining -= found
+
+        return present
+
+    def get(self, hash):
+        return self._get(hash, as_buffer=False)
+
+    def get_buffer(self, hash):
+        return self._get(hash, as_buffer=True)
+
+    def _get(self, hash, as_buffer):
+        if self.memory is not None and self.memory.is_loaded(hash):
+            return self.memory.get(hash)
+
+        for i, tier in enumerate(self.tiers):
+            if not self._is_visible(i, hash):
+                continue
+            content_bytes = self._read(i, lambda: tier.get_buffer(hash) if as_buffer else tier.get(hash))
+            if content_bytes is None:
+                continue
+
+            if i > 0 and self.promote:
+                self._promote(hash, bytes(content_bytes), i)
+            if self.memory is not None:
+                self.memory.put(hash, content_bytes)
+            return content_bytes
+
+        return None
+
+    def get_many(self, hashes):
+        values = {}
+        if self.memory is not None:
+            values = {hash: self.memory.get(hash) for hash in hashes if self.memory.is_loaded(hash)}
+
+        remaining = set(hashes) - values.keys()
+        for i, tier in enumerate(self.tiers):
+            if len(remaining) == 0:
+                break
+            # NOTE: a copy, since a read that times out keeps running in the background
+            tier_hashes = list(remaining)
+            found = self._read(i, lambda: tier.get_many(tier_hashes), {})
+            for hash, content_bytes in found.items():
+                if not self._is_visible(i, hash):
+                    continue
+                if i > 0 and self.promote:
+                    self._promote(hash, bytes(content_bytes), i)
+                if self.memory is not None:
+                    self.memory.put(hash, content_bytes)
+                values[hash] = content_bytes
+            remaining -= values.keys()
+
+        return values
+
+    def _promote(self, hash, content_bytes, found_tier):
+        logger.debug(f'Promoting {short_hash(hash)} from cache tier {found_tier}')
+        fn_name = self._read(found_tier, lambda: self.tiers[found_tier].get_module_function(hash))
+        # Compressed with the codec it was stored with, rather than the default compression of the faster tiers
+        codec = self._read(found_tier, lambda: self.tiers[found_tier].get_codec(hash))
+        format = self._read(found_tier, lambda: self.tiers[found_tier].get_format(hash))
+        for i, tier in self.writable_tiers:
+            if i < found_tier:
+                self._try(i, lambda: tier.add(hash, content_bytes, fn_name=fn_name, compression=codec, format=format))
+
+    def add(self, hash, content_bytes=None, ref=None, fn_name=None, compression=None, format=None):
+        self.local.add(hash, content_bytes, ref=ref, fn_name=fn_name, compression=compression, format=format)
+        self._cleared.discard(hash)
+        if self._kept is not None or len(self._cleared_module_functions) > 0:
+            self._added[hash] = fn_name
+        if ref is not None:
+            return
+
+        for i, tier in self.writable_tiers:
+            if i == 0:
+                continue
+            self._try(i, lambda: tier.add(hash, content_bytes, fn_name=fn_name, compression=compression, format=format))
+
+    def clear(self, hash):
+        if self.memory is not None:
+            self.memory.discard(hash)
+
+        self._cleared.add(hash)
+        self._added.pop(hash, None)
+        for i, tier in self._clear_tiers:
+            self._try(i, lambda: tier.clear(hash))
+
+    def clear_all_except(self, hashes):
+        if self.memory is not None:
+            self.memory.clear()
+
+        hashes = set(hashes)
+        self._kept = hashes if self._kept is None else hashes & (self._kept | self._added.keys())
+        self._added = {}
+        for i, tier in self._clear_tiers:
+            self._try(i, lambda: tier.clear_all_except(hashes))
+
+    def clear_module_function(self, module_function):
+        if self.memory is not None:
+            self.memory.clear()
+
+        self._cleared_module_functions.add(module_function)
+        self._added = {hash: fn_name for hash, fn_name in self._added.items() if fn_name != module_function}
+        for i, tier in self._clear_tiers:
+            self._try(i, lambda: tier.clear_module_function(module_function))
+
+    def get_stats(self, module_function=None):
+        return self.local.get_stats(module_function)
+
+    def get_module_function(self, hash):
+        for i, tier in enumerate(self.tiers):
+            fn_name = self._read(i, lambda: tier.get_module_function(hash))
+            if fn_name is not None and self._is_visible(i, hash):
+                return fn_name
+        return None
+
+    def get_codec(self, hash):
+        for i, tier in enumerate(self.tiers):
+            if self._read(i, lambda: tier.has(hash), False) and self._is_visible(i, hash):
+                return self._read(i, lambda: tier.get_codec(hash))
+        return None
+
+    def get_format(self, hash):
+        for i, tier in enumerate(self.tiers):
+            if self._read(i, lambda: tier.has(hash), False) and self._is_visible(i, hash):
+                return self._read(i, lambda: tier.get_format(hash))
+        return None
+
+    def get_ref_path(self, hash):
+        for i, tier in enumerate(self.tiers):
+            ref_path, ref_is_dir = self._read(i, lambda: tier.get_ref_path(hash), (None, False))
+            if ref_path is not None and self._is_visible(i, hash):
+                return ref_path, ref_is_dir
+        return None, False
+
+    def record_stats(self, module_function, hits=0, misses=0, bytes_read=0, bytes_written=0, load_seconds=0.0, compute_seconds=0.0, writes=0):
+        self.local.record_stats(module_function, hits, misses, bytes_read, bytes_written, load_seconds, compute_seconds, writes)
+
+    def get_task_stats(self):
+        return self.local.get_task_stats()
+
+    def pin(self, name, hashes):
+        self.local.pin(name, hashes)
+
+    def unpin(self, name):
+        self.local.unpin(name)
+
+    def get_pins(self):
+        return self.local.get_pins()
+
+    def gc(self, max_bytes=None, max_age=None, dry_run=False):
+        return self.local.gc(max_bytes, max_age, dry_run)
+
+    def sweep_orphans(self, dry_run=False):
+        return self.local.sweep_orphans(dry_run)
+
+    def repack(self):
+        return self.local.repack()
+
+    def get_ref_file_path(self, hash, ext):
+        return self.local.get_ref_file_path(hash, ext)
+
+    def get_ref_dir_path(self, hash):
+        return self.local.get_ref_dir_path(hash)
+
+    def transfer_ref(self, ref, hash, transfer=None):
+        return self.local.transfer_ref(ref, hash, transfer)
+
+    def track_file(self, path, modified=None, merkl_hash=None, md5_hash=None):
+        self.local.track_file(path, modified, merkl_hash, md5_hash)
+
+    def get_file_mod_hash(self, path, modified=None):
+        return self.local.get_file_mod_hash(path, modified)
+
+    def get_latest_file(self, path):
+        return self.local.get_latest_file(path)
+
+    def has_file(self, hash):
+        return self.local.has_file(hash)
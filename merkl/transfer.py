@@ -0,0 +1,130 @@
+import os
+import errno
+import shutil
+
+from merkl.logger import logger
+
+# Ways of transferring FileRef/DirRef outputs into the cache and into output files, fastest first. 'auto' tries them
+# in this order, except 'hardlink': a hard linked file shares its content with the original, so modifying either in
+# place modifies both, and it's only used when asked for
+STRATEGIES = ['rename', 'hardlink', 'reflink', 'copy']
+
+# Number of threads that transfer the files of a DirRef, since copying one file at a time leaves fast disks idle
+COPY_WORKERS = 8
+
+# ioctl request that makes a file share the extents of another (copy-on-write), on e.g. Btrfs and XFS
+FICLONE = 0x40049409
+
+# Errors of a strategy that is not supported for the file, e.g. across file systems, after which the next is tried
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EMLINK}
+
+
+def validate_transfer(transfer):
+    if transfer is not None and transfer != 'auto' and transfer not in STRATEGIES:
+        raise ValueError(f"Unknown transfer '{transfer}', expected one of {STRATEGIES}, 'auto' or None")
+
+
+def _strategies(transfer, move):
+    """ The strategies to try in order for `transfer`, the last always works. Renaming removes the source, so it's only
+    tried if `move`, and hard linking only if it's the `transfer` """
+    transfer = transfer or 'auto'
+    strategies = STRATEGIES[STRATEGIES.index('rename' if transfer == 'auto' else transfer):]
+    return [
+        strategy for strategy in strategies
+        if (move or strategy != 'rename') and (transfer == 'hardlink' or strategy != 'hardlink')
+    ]
+
+
+def _reflink(src, dst):
+    """ Clones `src` with the FICLONE ioctl, or else with copy_file_range, which lets the file system share or copy
+    the data without it passing through user space """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            import fcntl
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (ImportError, OSError) as e:
+            if isinstance(e, OSError) and e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+
+        if not hasattr(os, 'copy_file_range'):
+            raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+
+        size = os.fstat(fsrc.fileno()).st_size
+        offset = 0
+        while offset < size:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset, offset, offset)
+            if copied == 0:
+                break
+            offset += copied
+
+    shutil.copystat(src, dst)
+
+
+def _transfer_file(src, dst, strategies):
+    for strategy in strategies:
+        try:
+            if strategy == 'rename':
+                os.rename(src, dst)
+            elif strategy == 'hardlink':
+                os.link(src, dst)
+            elif strategy == 'reflink':
+                _reflink(src, dst)
+            else:
+                shutil.copy2(src, dst)
+            return strategy
+        except OSError as e:
+            if strategy == strategies[-1] or e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            if strategy == 'reflink' and os.path.exists(dst):
+                os.remove(dst)
+
+
+def transfer_file(src, dst, transfer=None, move=False):
+    """ Transfers the file `src` to `dst`, replacing it, with the first strategy of `transfer` that works (see
+    STRATEGIES), and returns the strategy used. If `move`, the source is removed """
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    strategies = _strategies(transfer, move)
+    strategy = _transfer_file(src, dst, strategies)
+    if move and strategy != 'rename':
+        os.remove(src)
+
+    logger.debug(f'Transferred {src} to {dst} with {strategy}')
+    return strategy
+
+
+def transfer_dir(src, dst, transfer=None, move=False, workers=None):
+    """ Like `transfer_file`, for a directory. Unless it can be renamed, the directories are recreated and the files
+    are transferred in parallel, which returns the strategy of the last file """
+    strategies = _strategies(transfer, move)
+    if strategies[0] == 'rename':
+        try:
+            os.rename(src, dst)
+            logger.debug(f'Transferred {src} to {dst} with rename')
+            return 'rename'
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+        strategies = strategies[1:]
+
+    file_paths = []
+    for dir_path, _, file_names in os.walk(src):
+        rel_dir = os.path.relpath(dir_path, src)
+        os.makedirs(os.path.normpath(os.path.join(dst, rel_dir)), exist_ok=True)
+        for file_name in file_names:
+            rel_path = os.path.normpath(os.path.join(rel_dir, file_name))
+            file_paths.append((os.path.join(src, rel_path), os.path.join(dst, rel_path)))
+
+    from concurrent.futures import ThreadPoolExecutor
+    strategy = None
+    with ThreadPoolExecutor(max_workers=workers or COPY_WORKERS) as executor:
+        for strategy in executor.map(lambda paths: _transfer_file(*paths, strategies), file_paths):
+            pass
+
+    if move:
+        shutil.rmtree(src)
+
+    logger.debug(f'Transferred {src} to {dst} with {strategy}')
+    return strategy
@@ -6,21 +6,20 @@ import inspect
 import hashlib
 import textwrap
 import signal
+import threading
 from importlib import import_module
 from functools import wraps, lru_cache
 from inspect import isfunction, ismodule, getmodule
 from typing import NamedTuple
-from stdlib_list import stdlib_list
-from sigtools.specifiers import forwards_to_function, signature
 import merkl
-from merkl import cache
 from merkl.exceptions import TaskOutsError, EvalError
 from merkl.logger import logger
+from merkl.stdlib_modules import STDLIB_MODULES
 
 
 DEBUG = False
 
-BUILTIN_MODULES = stdlib_list()
+BUILTIN_MODULES = STDLIB_MODULES
 
 OPERATORS = [
     '__bool__', '__not__', '__lt__', '__le__', '__ne__', '__ge__', 'truth', 'is_', 'is_not',
@@ -39,7 +38,7 @@ def doublewrap(f):
     or
     @decorator
     """
-    @forwards_to_function(f)
+    @wraps(f)
     def new_dec(*args, **kwargs):
         if len(args) == 1 and len(kwargs) == 0 and callable(args[0]) and not hasattr(args[0], 'type'):
             # Actual decorated function
@@ -156,7 +155,7 @@ def find_function_deps(f):
             # When module is being run directly, name is not representative, have to use this hack:
             dep_module_name = os.path.splitext(os.path.basename(dep_module.__file__))[0]
 
-        if dep_module_name in BUILTIN_MODULES:
+        if dep_module_name is not None and dep_module_name.split('.')[0] in BUILTIN_MODULES:
             continue
 
         deps.append(FunctionDep(node.id, dep))
@@ -220,10 +219,16 @@ def get_function_return_info(f):
 
 
 def evaluate_futures(outs, no_cache):
-    from merkl.future import Future, map_future_to_value
+    from merkl import cache
+    from merkl.future import Future, map_future_to_value, prefetch, wait_for_writes
 
     orig, cache.NO_CACHE = cache.NO_CACHE, no_cache
+    if not no_cache:
+        cache.prefetch_has(outs)
+        prefetch(nested_collect(outs, lambda x: isinstance(x, Future)))
     ret = nested_map(outs, map_future_to_value)
+    # The run ends once the outputs written behind are cached
+    wait_for_writes()
     cache.NO_CACHE = orig
     return ret
 
@@ -242,13 +247,14 @@ def collect_dag_futures(future, out_futures, include_parent_pipelines=False):
 def _dummy(*args, **kwargs):
     return
 
-default_signature = signature(_dummy)
 
 def signature_with_default(f):
+    # NOTE: sigtools is imported here rather than at the top, since it's slow to import and not needed for e.g. `merkl cache`
+    from sigtools.specifiers import signature
     try:
         return signature(f)
     except ValueError:
-        return default_signature
+        return signature(_dummy)
 
 
 def signature_args_kwargs(f):
@@ -272,13 +278,18 @@ def function_descriptive_name(fn, include_module=True):
 class DelayedKeyboardInterrupt():
     def __enter__(self):
         self.signal_received = False
-        self.old_handler = signal.signal(signal.SIGINT, self.handler)
+        self.old_handler = None
+        # NOTE: signal handlers can only be set from the main thread, which is also the one that gets the interrupt
+        if threading.current_thread() is threading.main_thread():
+            self.old_handler = signal.signal(signal.SIGINT, self.handler)
 
     def handler(self, sig, frame):
         self.signal_received = (sig, frame)
         logger.debug('SIGINT received. Delaying KeyboardInterrupt.')
 
     def __exit__(self, type, value, traceback):
+        if self.old_handler is None:
+            return
         signal.signal(signal.SIGINT, self.old_handler)
         if self.signal_received:
             self.old_handler(*self.signal_received)